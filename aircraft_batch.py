@@ -0,0 +1,180 @@
+import codecs
+import json
+import re
+import numpy as np
+from closest_approach import predict_future_position_turning, closest_approach_vectorized, MAX_PREDICTED_TURN
+from geometry import Observer
+
+# The fields we need out of each adsb.fi aircraft record, and the numeric ones among them
+NUMERIC_FIELDS = ('lat', 'lon', 'alt_geom', 'gs', 'track')
+# Fields we use when present but don't require
+OPTIONAL_FIELDS = ('geom_rate', 'baro_rate', 'seen_pos')
+# Everything aircraft_batch_from_json() looks at; the rest of a record is thrown away
+RECORD_FIELDS = frozenset(('hex', 'desc', 'alt_baro') + NUMERIC_FIELDS + OPTIONAL_FIELDS)
+# Once this much of the buffer has been decoded it's dropped
+DECODE_BUFFER_TRIM = 1 << 16
+
+AIRCRAFT_ARRAY_START = re.compile(r'"aircraft"\s*:\s*\[')
+BETWEEN_RECORDS = re.compile(r'[\s,]*')
+
+# A snapshot of aircraft held as parallel arrays, one entry per aircraft.  Only airborne
+# aircraft with every field we need make it into a batch.  vertical_rate (ft/min),
+# turn_rate (degrees/s) and seen_pos (seconds since the position was received) default
+# to zero when not known.
+class AircraftBatch:
+    def __init__(self, hex, desc, lat, lon, alt, gs, track, vertical_rate=None, turn_rate=None, seen_pos=None):
+        self.hex = hex
+        self.desc = desc
+        self.lat = lat
+        self.lon = lon
+        self.alt = alt
+        self.gs = gs
+        self.track = track
+        self.vertical_rate = np.zeros(len(lat)) if vertical_rate is None else vertical_rate
+        self.turn_rate = np.zeros(len(lat)) if turn_rate is None else turn_rate
+        self.seen_pos = np.zeros(len(lat)) if seen_pos is None else seen_pos
+
+    def __len__(self):
+        return len(self.lat)
+
+    # A new batch holding just the aircraft at the given indices (or boolean mask)
+    def subset(self, indices):
+        return AircraftBatch(
+            self.hex[indices], self.desc[indices],
+            self.lat[indices], self.lon[indices], self.alt[indices],
+            self.gs[indices], self.track[indices],
+            self.vertical_rate[indices], self.turn_rate[indices], self.seen_pos[indices]
+        )
+
+    # A copy with every aircraft flown along its predicted path for seconds (a number, or
+    # one per aircraft), e.g. to bring an older snapshot up to the present.  The moved
+    # positions are as of now, so their seen_pos is 0.
+    def advanced(self, seconds):
+        lat, lon, alt = predict_future_position_turning(
+            self.lat, self.lon, self.alt, self.gs, self.track,
+            self.turn_rate, self.vertical_rate, seconds / 60
+        )
+        track = (self.track + np.clip(self.turn_rate * seconds, -MAX_PREDICTED_TURN, MAX_PREDICTED_TURN)) % 360
+        return AircraftBatch(
+            self.hex, self.desc, lat, lon, alt, self.gs, track,
+            self.vertical_rate, self.turn_rate, np.zeros(len(self))
+        )
+
+# Decode the "aircraft" array of an adsb.fi response one record at a time as the bytes
+# arrive, keeping only the fields in RECORD_FIELDS.  chunks is an iterable of bytes,
+# like response.iter_content().  Nothing but the current chunk and the projected
+# records is held, rather than the whole document and a full dict for every aircraft.
+def iter_aircraft(chunks, fields=RECORD_FIELDS):
+    decoder = json.JSONDecoder(object_pairs_hook=lambda pairs: {key: value for key, value in pairs if key in fields})
+    text = codecs.getincrementaldecoder('utf-8')()
+    chunks = iter(chunks)
+    buffer = ''
+    position = None
+
+    def read_more():
+        chunk = next(chunks, None)
+        return None if chunk is None else text.decode(chunk)
+
+    while position is None:
+        match = AIRCRAFT_ARRAY_START.search(buffer)
+        if match:
+            position = match.end()
+        else:
+            more = read_more()
+            if more is None:
+                return
+            buffer += more
+
+    while True:
+        position = BETWEEN_RECORDS.match(buffer, position).end()
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            if position == len(buffer):
+                raise json.JSONDecodeError("Need more data", buffer, position)
+            record, position = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # most likely the record runs past the end of what we have so far
+            more = read_more()
+            if more is None:
+                raise
+            buffer = buffer[position:] + more
+            position = 0
+            continue
+        yield record
+        if position > DECODE_BUFFER_TRIM:
+            buffer = buffer[position:]
+            position = 0
+
+# Turn the adsb.fi JSON aircraft list into an AircraftBatch.  Aircraft on the ground,
+# without alt_geom (potentially on the ground) or missing any other field are dropped.
+# Returns the batch and a dict of how many records were dropped for each reason.
+def aircraft_batch_from_json(aircraft_list):
+    count = len(aircraft_list)
+    columns = {field: np.full(count, np.nan) for field in NUMERIC_FIELDS + OPTIONAL_FIELDS}
+    hex_codes = np.empty(count, dtype=object)
+    desc = np.empty(count, dtype=object)
+    on_ground = np.zeros(count, dtype=bool)
+    has_desc = np.zeros(count, dtype=bool)
+
+    for i, aircraft in enumerate(aircraft_list):
+        for field in NUMERIC_FIELDS + OPTIONAL_FIELDS:
+            value = aircraft.get(field)
+            if value is not None:
+                columns[field][i] = value
+        hex_codes[i] = aircraft.get('hex')
+        desc[i] = aircraft.get('desc')
+        on_ground[i] = aircraft.get('alt_baro') == 'ground'
+        has_desc[i] = desc[i] is not None and hex_codes[i] is not None
+
+    no_geom = ~on_ground & np.isnan(columns['alt_geom'])
+    missing_value = np.isnan(np.column_stack([columns[field] for field in NUMERIC_FIELDS])).any(axis=1)
+    incomplete = ~on_ground & ~no_geom & (missing_value | ~has_desc)
+    keep = ~(on_ground | no_geom | incomplete)
+
+    # prefer the geometric vertical rate, since alt_geom is the altitude we use
+    vertical_rate = np.where(np.isnan(columns['geom_rate']), columns['baro_rate'], columns['geom_rate'])
+
+    batch = AircraftBatch(
+        hex_codes[keep], desc[keep],
+        columns['lat'][keep], columns['lon'][keep], columns['alt_geom'][keep],
+        columns['gs'][keep], columns['track'][keep],
+        np.nan_to_num(vertical_rate[keep]), None, np.nan_to_num(columns['seen_pos'][keep])
+    )
+    dropped = {
+        "on_ground": int(on_ground.sum()),
+        "no_alt_geom": int(no_geom.sum()),
+        "incomplete": int(incomplete.sum())
+    }
+    return batch, dropped
+
+# Compute the predicted path and closest approach of every aircraft in the batch in one
+# pass.  The observer position may be scalars (one observer, results shaped like the
+# batch) or arrays of M observers (results shaped M x len(batch)).  observer may be the
+# location's precomputed Observer, for a single observer.
+def compute_approaches(batch, observer_lat, observer_lon, observer_alt, predict_minutes, observer=None):
+    observer_lat = np.asarray(observer_lat, dtype=float)[..., np.newaxis] if np.ndim(observer_lat) else observer_lat
+    observer_lon = np.asarray(observer_lon, dtype=float)[..., np.newaxis] if np.ndim(observer_lon) else observer_lon
+    observer_alt = np.asarray(observer_alt, dtype=float)[..., np.newaxis] if np.ndim(observer_alt) else observer_alt
+
+    future_lat, future_lon, future_alt = predict_future_position_turning(
+        batch.lat, batch.lon, batch.alt, batch.gs, batch.track,
+        batch.turn_rate, batch.vertical_rate, predict_minutes
+    )
+    observer = observer or Observer(observer_lat, observer_lon, observer_alt)
+    closest_point, t_closest, min_distance = closest_approach_vectorized(
+        observer_lat, observer_lon, observer_alt,
+        batch.lat, batch.lon, batch.alt,
+        future_lat, future_lon, future_alt,
+        observer
+    )
+    closest_lat, closest_lon, closest_alt = closest_point
+    return {
+        "closest_lat": closest_lat,
+        "closest_lon": closest_lon,
+        "closest_alt": closest_alt,
+        "t_closest": t_closest,
+        "time_to_closest": t_closest * predict_minutes * 60,  # seconds to closest approach
+        "min_distance": min_distance,
+        "bearing": observer.bearing_to(closest_lat, closest_lon)
+    }
@@ -1,12 +1,18 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory
 from flask_cors import CORS
 from werkzeug.security import generate_password_hash, check_password_hash
 from models import User, Notification, Filter, Condition, LastLocation
 from config import Session
 from flask_jwt_extended import create_access_token, JWTManager, get_jwt_identity, jwt_required
-from sqlalchemy import desc
-from db import get_user_by_id
+from sqlalchemy import and_, desc, func, or_
+from sqlalchemy.orm import selectinload
+from db import get_user_by_id, get_filters_for_users
+from filter_plan import get_filter_version, invalidate_plan
+from datetime import datetime
+import hashlib
+import json
 import os
+import time
 
 app = Flask(__name__, static_folder='/webapp')
 app.config["JWT_SECRET_KEY"] = "super-secret"  # Change this!
@@ -72,18 +78,57 @@ def user_preferences():
                 "topic": user.topic,
             }), 200
 
+# A user's notification count is recounted at most this often, rather than on every page
+NOTIFICATION_COUNT_TTL = 60  # seconds
+MAX_PAGE_SIZE = 100
+# user_id -> (when counted, count)
+notification_counts = {}
+
+def count_notifications(session, user_id):
+    now = time.monotonic()
+    cached = notification_counts.get(user_id)
+    if cached is not None and now - cached[0] < NOTIFICATION_COUNT_TTL:
+        return cached[1]
+    count = session.query(func.count(Notification.id)).filter(Notification.user_id == user_id).scalar()
+    notification_counts[user_id] = (now, count)
+    return count
+
+# Cursors are the (timestamp, id) of the last notification on a page, newest first
+def encode_cursor(notification):
+    return f"{notification.timestamp.isoformat()}_{notification.id}"
+
+def decode_cursor(cursor):
+    timestamp, _, id = cursor.rpartition('_')
+    return datetime.fromisoformat(timestamp), int(id)
+
+# Pages of the user's notifications, newest first.  Pass the next_cursor of one page as
+# cursor to get the next; each page is an index range scan however long the history is.
+# total_count may be up to NOTIFICATION_COUNT_TTL seconds out of date.  start still
+# works for offset paging, but gets slower the further in it goes.
 @app.route('/api/user/notifications', endpoint="user_notifications", methods=['GET'])
 @jwt_required()  # Ensure the user is logged in
 def user_notifications():
     with Session() as session:
         user = get_user_by_id(session, get_jwt_identity())
 
+        cursor = request.args.get('cursor')
         start = request.args.get('start', 0, type=int)
-        limit = request.args.get('limit', 10, type=int)
-        notifications_query = session.query(Notification).filter_by(user_id=user.id) \
-            .order_by(Notification.timestamp.desc())
-        total_count = notifications_query.count()
-        notifications = notifications_query.offset(start).limit(limit)
+        limit = min(max(1, request.args.get('limit', 10, type=int)), MAX_PAGE_SIZE)
+        notifications_query = session.query(Notification).filter(Notification.user_id == user.id)
+        if cursor:
+            try:
+                timestamp, id = decode_cursor(cursor)
+            except ValueError:
+                return jsonify({"error": "Invalid cursor"}), 400
+            notifications_query = notifications_query.filter(or_(
+                Notification.timestamp < timestamp,
+                and_(Notification.timestamp == timestamp, Notification.id < id)))
+        notifications_query = notifications_query.order_by(Notification.timestamp.desc(), Notification.id.desc())
+        if start and not cursor:
+            notifications_query = notifications_query.offset(start)
+        # one extra row says whether there's another page
+        notifications = notifications_query.limit(limit + 1).all()
+        next_cursor = encode_cursor(notifications[limit - 1]) if len(notifications) > limit else None
 
         return jsonify({
             "notifications": [
@@ -91,11 +136,37 @@ def user_notifications():
                     "timestamp": n.timestamp,
                     "aircraft_hex": n.aircraft_hex,
                     "text": n.notification_text
-                } for n in notifications
+                } for n in notifications[:limit]
             ],
-            "total_count": total_count
+            "total_count": count_notifications(session, user.id),
+            "next_cursor": next_cursor
         }), 200
 
+# The filter list returned by GET, cached per user as (filter version, ETag, body).
+# Entries are checked against the filters' version, so edits made through any process
+# are picked up.
+filter_responses = {}
+
+def filter_etag(version):
+    updated_at, count = version
+    return hashlib.sha1(f"{updated_at}:{count}".encode()).hexdigest()
+
+def serialize_filters(filters):
+    return [
+        {
+            "id": filter.id,
+            "name": filter.name,
+            "evaluation_order": filter.evaluation_order,
+            "conditions": [{"type": cond.condition_type, "value": cond.value}
+                           for cond in sorted(filter.conditions, key=lambda cond: cond.id)]
+        } for filter in filters
+    ]
+
+# After a filter changes, drop the user's cached plan and filter list
+def filters_changed(user_id):
+    invalidate_plan(user_id)
+    filter_responses.pop(user_id, None)
+
 @app.route('/api/user/filters', methods=['POST'])
 @jwt_required()  # Ensure the user is logged in
 def create_filter():
@@ -112,49 +183,41 @@ def create_filter():
         # Determine the next evaluation order
         next_order = session.query(Filter).filter_by(user_id=user.id).count() + 1
 
-        # Create the filter
+        # Create the filter and its conditions in one transaction
         new_filter = Filter(
             user_id=user.id,
             name=name,
-            evaluation_order=next_order
+            evaluation_order=next_order,
+            conditions=[Condition(condition_type=condition['type'], value=condition['value'])
+                        for condition in conditions]
         )
         session.add(new_filter)
         session.commit()
-
-        # Create conditions for the filter
-        for condition in conditions:
-            condition_type = condition['type']
-            value = condition['value']
-            new_condition = Condition(
-                filter_id=new_filter.id,
-                condition_type=condition_type,
-                value=value
-            )
-            session.add(new_condition)
-
-        session.commit()
+        filters_changed(user.id)
 
         return jsonify({"id": new_filter.id, "message": "Filter created successfully"}), 201
 
 
+# Polled by the UI, so answered from the cache, or with a 304 if the client's copy is
+# current, after a single version query
 @app.route('/api/user/filters', methods=['GET'])
 @jwt_required()  # Ensure the user is logged in
 def get_filters():
+    user_id = get_jwt_identity()
     with Session() as session:
-        user = get_user_by_id(session, get_jwt_identity())
-        filters = session.query(Filter).filter_by(user_id=user.id).order_by(Filter.evaluation_order).all()
-
-        response = []
-        for filter in filters:
-            conditions = session.query(Condition).filter_by(filter_id=filter.id).all()
-            response.append({
-                "id": filter.id,
-                "name": filter.name,
-                "evaluation_order": filter.evaluation_order,
-                "conditions": [{"type": cond.condition_type, "value": cond.value} for cond in conditions]
-            })
-
-        return jsonify(response), 200
+        version = get_filter_version(session, user_id)
+        cached = filter_responses.get(user_id)
+        if cached is None or cached[0] != version:
+            body = json.dumps(serialize_filters(get_filters_for_users(session, [user_id])))
+            cached = filter_responses[user_id] = (version, filter_etag(version), body)
+
+    version, etag, body = cached
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(body, mimetype='application/json')
+    response.set_etag(etag)
+    return response
 
 
 @app.route('/api/user/filters/<int:filter_id>', methods=['PUT'])
@@ -167,27 +230,41 @@ def update_filter(filter_id):
 
     with Session() as session:
         user = get_user_by_id(session, get_jwt_identity())
-        filter_to_update = session.query(Filter).filter_by(id=filter_id, user_id=user.id).first()
+        filter_to_update = session.query(Filter).options(selectinload(Filter.conditions)) \
+            .filter_by(id=filter_id, user_id=user.id).first()
 
         if not filter_to_update:
             return jsonify({"error": "Filter not found"}), 404
 
-        if name:
+        changed = False
+        if name and name != filter_to_update.name:
             filter_to_update.name = name
-        if evaluation_order:
+            changed = True
+        if evaluation_order and evaluation_order != filter_to_update.evaluation_order:
             filter_to_update.evaluation_order = evaluation_order
+            changed = True
 
-        # Clear existing conditions and add new ones
-        session.query(Condition).filter_by(filter_id=filter_to_update.id).delete()
+        # Keep the conditions that are unchanged, delete the ones that are gone and add
+        # the new ones
+        unmatched = list(filter_to_update.conditions)
         for condition in conditions:
-            new_condition = Condition(
-                filter_id=filter_to_update.id,
-                condition_type=condition['type'],
-                value=condition['value']
-            )
-            session.add(new_condition)
-
-        session.commit()
+            existing = next((c for c in unmatched
+                             if c.condition_type == condition['type'] and c.value == condition['value']), None)
+            if existing is not None:
+                unmatched.remove(existing)
+            else:
+                filter_to_update.conditions.append(Condition(condition_type=condition['type'], value=condition['value']))
+                changed = True
+        for condition in unmatched:
+            filter_to_update.conditions.remove(condition)
+            changed = True
+
+        if changed:
+            # conditions live in their own table, so bump the filter's updated_at ourselves
+            # to let the monitor loop know this filter's compiled plan is stale
+            filter_to_update.updated_at = datetime.utcnow()
+            session.commit()
+            filters_changed(user.id)
 
         return jsonify({"message": "Filter updated successfully"}), 200
 
@@ -206,6 +283,7 @@ def delete_filter(filter_id):
         session.query(Condition).filter_by(filter_id=filter_to_delete.id).delete()
         session.delete(filter_to_delete)
         session.commit()
+        filters_changed(user.id)
 
         return jsonify({"message": "Filter deleted successfully"}), 200
 
@@ -227,11 +305,22 @@ def get_user_location():
             return jsonify({"message": "Location not found"}), 404
 
 
-# Serve static files for the web app
+# Serve static files for the web app.  The web build names its bundles after their
+# content, so anything under these can be cached for good; everything else, index.html
+# especially, is revalidated on every load.
+IMMUTABLE_STATIC_PREFIXES = ('_expo/static/', 'assets/')
+STATIC_MAX_AGE = 365 * 24 * 3600  # seconds
+
 @app.route('/', defaults={'path': ''})
 @app.route('/<path:path>')
 def serve_static(path):
     if path != "" and os.path.exists(os.path.join(app.static_folder, path)):
-        return send_from_directory(app.static_folder, path)
+        if path.startswith(IMMUTABLE_STATIC_PREFIXES):
+            response = send_from_directory(app.static_folder, path, max_age=STATIC_MAX_AGE)
+            response.cache_control.immutable = True
+            return response
+        response = send_from_directory(app.static_folder, path, max_age=0)
     else:
-        return send_from_directory(app.static_folder, 'index.html')
+        response = send_from_directory(app.static_folder, 'index.html', max_age=0)
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,569 @@
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+from aircraft_batch import aircraft_batch_from_json, iter_aircraft
+from fetch_planner import Region, fan_out, fan_out_indexed, fan_out_scanned, worth_indexing
+from geometry import EARTH_RADIUS_FEET, Observer, haversine, bearing, distance_nm
+
+# A made-up metro area
+CENTER_LAT = 37.62
+CENTER_LON = -122.38
+METRO_RADIUS_NM = 30
+QUERY_RADIUS_NM = 28  # a 3nm filter plus how far a 500kt aircraft flies in 3 minutes
+
+# A random point within radius_nm of the center
+def random_point(rng, radius_nm, lat=CENTER_LAT, lon=CENTER_LON):
+    distance = radius_nm * math.sqrt(rng.random())
+    bearing = rng.uniform(0, 2 * math.pi)
+    return (lat + distance * math.cos(bearing) / 60,
+            lon + distance * math.sin(bearing) / (60 * math.cos(math.radians(lat))))
+
+# adsb.fi-style records for a busy snapshot around the metro area
+def synthetic_aircraft(rng, count, radius_nm=METRO_RADIUS_NM + QUERY_RADIUS_NM):
+    aircraft = []
+    for i in range(count):
+        lat, lon = random_point(rng, radius_nm)
+        aircraft.append({
+            "hex": f"{i:06x}",
+            "desc": f"TEST {i}",
+            "lat": lat,
+            "lon": lon,
+            "alt_baro": rng.randint(500, 40000),
+            "alt_geom": rng.randint(500, 40000),
+            "gs": rng.uniform(80, 480),
+            "track": rng.uniform(0, 360),
+            "geom_rate": rng.choice([0, 0, -640, 1280]),
+            "seen_pos": rng.uniform(0, 5),
+        })
+    return aircraft
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+# How fanning one shared snapshot out to users scales with the number of users,
+# with and without the spatial index, and which of the two fan_out() picks.  Users are
+# spread over args.metro_radius nm and the snapshot covers their query circles.
+def bench_spatial_index(args):
+    rng = random.Random(args.seed)
+    region_radius = args.metro_radius + QUERY_RADIUS_NM
+    batch, dropped = aircraft_batch_from_json(synthetic_aircraft(rng, args.aircraft, region_radius))
+    # warm up, so the first size measured doesn't pay for NumPy's first calls
+    warm_up = Region(CENTER_LAT, CENTER_LON, region_radius)
+    warm_up.members = [(0, CENTER_LAT, CENTER_LON, QUERY_RADIUS_NM)]
+    fan_out_indexed(warm_up, batch)
+    fan_out_scanned(warm_up, batch)
+
+    results = []
+    for user_count in (10, 100, 1000, 10000):
+        region = Region(CENTER_LAT, CENTER_LON, region_radius)
+        region.members = [(i, *random_point(rng, args.metro_radius), QUERY_RADIUS_NM) for i in range(user_count)]
+
+        indexed, indexed_seconds = timed(fan_out_indexed, region, batch)
+        scanned, scanned_seconds = timed(fan_out_scanned, region, batch)
+        chosen, fan_out_seconds = timed(fan_out, region, batch)
+        assert all(np.array_equal(indexed[key].hex, scanned[key].hex) for key in indexed)
+        assert all(np.array_equal(chosen[key].hex, scanned[key].hex) for key in chosen)
+        results.append({
+            "users": user_count,
+            "aircraft": len(batch),
+            "metro_radius_nm": args.metro_radius,
+            "indexed_seconds": indexed_seconds,
+            "full_scan_seconds": scanned_seconds,
+            "speedup": scanned_seconds / indexed_seconds,
+            "fan_out_uses_index": worth_indexing(region, len(batch)),
+            "fan_out_seconds": fan_out_seconds,
+        })
+    return results
+
+# The fields adsb.fi sends that we never look at, so decoded responses are realistically sized
+def with_unused_fields(rng, aircraft):
+    return dict(aircraft, **{
+        "type": "adsb_icao", "flight": f"TST{rng.randint(1, 9999):<5}", "r": "N12345", "t": "B738",
+        "ias": 250, "tas": 270, "mach": 0.41, "wd": 270, "ws": 15, "oat": 5, "tat": 12,
+        "track_rate": 0.0, "roll": 0.2, "mag_heading": 181.3, "true_heading": 183.6,
+        "squawk": "1200", "emergency": "none", "category": "A3", "nav_qnh": 1013.6,
+        "nav_altitude_mcp": 11008, "nav_heading": 180.0, "nav_modes": ["autopilot", "vnav", "tcas"],
+        "nic": 8, "rc": 186, "version": 2, "nic_baro": 1, "nac_p": 9, "nac_v": 1, "sil": 3,
+        "sil_type": "perhour", "gva": 2, "sda": 2, "alert": 0, "spi": 0, "mlat": [], "tisb": [],
+        "messages": rng.randint(1000, 90000), "seen": 0.1, "rssi": -20.5, "dst": 10.2, "dir": 45.0,
+        "lastPosition": {"lat": aircraft["lat"], "lon": aircraft["lon"], "nic": 8, "rc": 186, "seen_pos": 30.1},
+    })
+
+# Decode time and peak memory for one adsb.fi response, through response.json() as
+# before and through the streaming decoder, ending in the same AircraftBatch
+def bench_decode(args):
+    rng = random.Random(args.seed)
+    results = []
+    for count in (100, 1000, args.aircraft, 10000):
+        aircraft = [with_unused_fields(rng, record) for record in synthetic_aircraft(rng, count)]
+        document = json.dumps({"aircraft": aircraft, "msg": "No error", "now": time.time(), "total": count}).encode()
+        chunks = [document[i:i + (1 << 16)] for i in range(0, len(document), 1 << 16)]
+
+        # requests joins the chunks into response.content before response.json() decodes it
+        def whole_document():
+            return aircraft_batch_from_json(json.loads(b''.join(chunks)).get('aircraft', []))
+
+        def streamed():
+            return aircraft_batch_from_json(list(iter_aircraft(chunks)))
+
+        result = {"aircraft": count, "response_bytes": len(document)}
+        batches = {}
+        for name, decode in (("whole_document", whole_document), ("streamed", streamed)):
+            decode()
+            batches[name], result[f"{name}_seconds"] = min((timed(decode) for _ in range(3)), key=lambda run: run[1])
+            tracemalloc.start()
+            decode()
+            result[f"{name}_peak_bytes"] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        assert np.array_equal(batches["whole_document"][0].hex, batches["streamed"][0].hex)
+        result["peak_memory_ratio"] = result["streamed_peak_bytes"] / result["whole_document_peak_bytes"]
+        results.append(result)
+    return results
+
+# The geometry helpers as they were before geometry.py, NumPy calls on every input
+def numpy_haversine(lat1, lon1, lat2, lon2):
+    dlat = np.radians(lat2 - lat1)
+    dlon = np.radians(lon2 - lon1)
+    a = np.sin(dlat / 2)**2 + np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) * np.sin(dlon / 2)**2
+    return EARTH_RADIUS_FEET * 2 * np.arcsin(np.sqrt(a))
+
+def numpy_distance_3d(lat1, lon1, alt1, lat2, lon2, alt2):
+    return np.sqrt(numpy_haversine(lat1, lon1, lat2, lon2)**2 + abs(alt1 - alt2)**2)
+
+def numpy_angle_above_horizon(lat1, lon1, alt1, lat2, lon2, alt2):
+    return np.degrees(np.arctan2(alt2 - alt1, numpy_haversine(lat1, lon1, lat2, lon2)))
+
+def numpy_bearing(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = map(np.radians, [lat1, lon1, lat2, lon2])
+    x = np.sin(lon2 - lon1) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(lon2 - lon1)
+    return (np.degrees(np.arctan2(x, y)) + 360) % 360
+
+def numpy_to_enu(lat1, lon1, alt1, lat2, lon2, alt2):
+    return (np.radians(lon2 - lon1) * EARTH_RADIUS_FEET * np.cos(np.radians(lat1)),
+            np.radians(lat2 - lat1) * EARTH_RADIUS_FEET, alt2 - alt1)
+
+# Seconds per call, the best of a few rounds
+def per_call(function, points, rounds=5):
+    best = float('inf')
+    for _ in range(rounds):
+        start = time.perf_counter()
+        for point in points:
+            function(*point)
+        best = min(best, (time.perf_counter() - start) / len(points))
+    return best
+
+# Each geometry function on single points (the old NumPy version against math with the
+# observer's trig precomputed) and on a whole snapshot (old against new, both NumPy)
+def bench_geometry(args):
+    rng = random.Random(args.seed)
+    observer_lat, observer_lon, observer_alt = CENTER_LAT, CENTER_LON, 50.0
+    observer = Observer(observer_lat, observer_lon, observer_alt)
+    points = [(*random_point(rng, QUERY_RADIUS_NM), rng.uniform(500, 40000)) for _ in range(2000)]
+    lats = np.array([point[0] for point in points * (args.aircraft // len(points) + 1)][:args.aircraft])
+    lons = np.array([point[1] for point in points * (args.aircraft // len(points) + 1)][:args.aircraft])
+    alts = np.array([point[2] for point in points * (args.aircraft // len(points) + 1)][:args.aircraft])
+    origin = (observer_lat, observer_lon, observer_alt)
+
+    functions = {
+        "haversine": (lambda lat, lon, alt: numpy_haversine(observer_lat, observer_lon, lat, lon),
+                      lambda lat, lon, alt: haversine(observer_lat, observer_lon, lat, lon),
+                      lambda lat, lon, alt: observer.distance_2d(lat, lon)),
+        "distance_3d": (lambda lat, lon, alt: numpy_distance_3d(*origin, lat, lon, alt),
+                        None,
+                        observer.distance_3d),
+        "angle_above_horizon": (lambda lat, lon, alt: numpy_angle_above_horizon(*origin, lat, lon, alt),
+                                None,
+                                observer.angle_above_horizon),
+        "bearing": (lambda lat, lon, alt: numpy_bearing(observer_lat, observer_lon, lat, lon),
+                    lambda lat, lon, alt: bearing(observer_lat, observer_lon, lat, lon),
+                    lambda lat, lon, alt: observer.bearing_to(lat, lon)),
+        "to_enu": (lambda lat, lon, alt: numpy_to_enu(*origin, lat, lon, alt),
+                   None,
+                   observer.to_enu),
+    }
+
+    results = []
+    for name, (before, function, with_observer) in functions.items():
+        for point in points[:50]:
+            assert np.allclose(before(*point), with_observer(*point), rtol=1e-9, atol=1e-6)
+        assert np.allclose(before(lats, lons, alts), with_observer(lats, lons, alts), rtol=1e-9, atol=1e-6)
+
+        result = {
+            "function": name,
+            "scalar_numpy_seconds": per_call(before, points),
+            "scalar_observer_seconds": per_call(with_observer, points),
+        }
+        if function is not None:
+            result["scalar_math_seconds"] = per_call(function, points)
+        result["scalar_speedup"] = result["scalar_numpy_seconds"] / result["scalar_observer_seconds"]
+        result["aircraft"] = args.aircraft
+        result["array_numpy_seconds"] = per_call(before, [(lats, lons, alts)] * 20)
+        result["array_observer_seconds"] = per_call(with_observer, [(lats, lons, alts)] * 20)
+        results.append(result)
+    return results
+
+# Aircraft that keep flying their track between ticks, so successive snapshots look like
+# successive adsb.fi responses and the track store sees real motion
+class SyntheticTraffic:
+    def __init__(self, rng, count, radius_nm, tick_seconds):
+        self.aircraft = synthetic_aircraft(rng, count, radius_nm)
+        self.radius_nm = radius_nm
+        self.tick_seconds = tick_seconds
+
+    def fetch(self, lat, lon, radius_nm):
+        return [dict(aircraft) for aircraft in self.aircraft]
+
+    # Move every aircraft along its track, wrapping ones that leave the area back in
+    def tick(self):
+        for aircraft in self.aircraft:
+            distance = aircraft['gs'] * self.tick_seconds / 3600
+            aircraft['lat'] += distance * math.cos(math.radians(aircraft['track'])) / 60
+            aircraft['lon'] += distance * math.sin(math.radians(aircraft['track'])) / (60 * math.cos(math.radians(aircraft['lat'])))
+            aircraft['alt_geom'] = max(100, aircraft['alt_geom'] + aircraft['geom_rate'] * self.tick_seconds / 60)
+            if distance_nm(CENTER_LAT, CENTER_LON, aircraft['lat'], aircraft['lon']) > self.radius_nm:
+                aircraft['track'] = (aircraft['track'] + 180) % 360
+
+# Accepts every ntfy publish and counts them
+class StubNtfyHandler(BaseHTTPRequestHandler):
+    received = 0
+    lock = threading.Lock()
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        with StubNtfyHandler.lock:
+            StubNtfyHandler.received += 1
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+def percentiles(samples):
+    if not samples:
+        return {"count": 0}
+    samples = np.array(samples)
+    return {
+        "count": len(samples),
+        "total_seconds": float(samples.sum()),
+        "p50_ms": float(np.percentile(samples, 50) * 1000),
+        "p90_ms": float(np.percentile(samples, 90) * 1000),
+        "p99_ms": float(np.percentile(samples, 99) * 1000),
+        "max_ms": float(samples.max() * 1000),
+    }
+
+# Users spread over the metro area, each with one to three filters built from the
+# same condition types the UI offers
+def create_synthetic_users(session, rng, count, metro_radius):
+    from models import User, LastLocation, Filter, Condition
+    now = datetime.utcnow()
+    for i in range(count):
+        user = User(email=f"bench{i}@example.com", password_hash="x", topic=f"bench-{i}")
+        lat, lon = random_point(rng, metro_radius)
+        user.location = LastLocation(lat=lat, lon=lon, alt=rng.uniform(0, 500), reported_at=now)
+        for order in range(rng.randint(1, 3)):
+            conditions = [Condition(condition_type='3d_distance', value={"max_distance": rng.choice([1.0, 2.0, 3.0, 5.0])})]
+            if rng.random() < 0.5:
+                conditions.append(Condition(condition_type='angle_above_horizon', value={"min_angle": rng.choice([10, 20, 30])}))
+            if rng.random() < 0.3:
+                conditions.append(Condition(condition_type='altitude_below', value={"max_altitude": rng.choice([3000, 5000, 10000])}))
+            user.filters.append(Filter(name=f"filter {order}", evaluation_order=order, conditions=conditions))
+        session.add(user)
+    session.commit()
+
+# Benchmarks that import config point it at an in-memory database first, since the
+# database is picked (and its tables created) when config is imported
+def use_throwaway_database():
+    os.environ.update({"DB_TYPE": "sqlite", "DB_NAME": ":memory:"})
+
+# Runs the monitor loop's stages end to end for args.ticks ticks against an in-memory
+# SQLite database, a stub ntfy server and either recorded snapshots (--replay) or
+# synthetic traffic.  Stages run one after another on this thread so each can be timed.
+def bench_replay(args):
+    use_throwaway_database()
+    import logging
+    from config import Session, UPDATE_RATE, logger
+    from aircraft import get_query_distance, process_aircraft_for_user, PREDICT_MINUTES
+    from main import notify_user, send_notifications
+    from models import Notification
+    from notifier import Notifier, TopicRateLimiter
+    from schedule import choose_interval
+    from sources import ReplaySource
+    from tick_state import load_tick_state
+    from track_store import track_store
+    from fetch_planner import plan_regions
+    from aircraft_batch import compute_approaches
+    logger.setLevel(getattr(logging, args.log_level))
+
+    rng = random.Random(args.seed)
+    session = Session()
+    create_synthetic_users(session, rng, args.users, args.metro_radius)
+    if args.replay:
+        source = ReplaySource(args.replay)
+    else:
+        source = SyntheticTraffic(rng, args.aircraft, args.metro_radius + QUERY_RADIUS_NM, UPDATE_RATE)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubNtfyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    notifier = Notifier(f"http://127.0.0.1:{server.server_port}")
+    # ticks here are back to back rather than UPDATE_RATE apart, so ntfy's per-topic
+    # limit would only measure how long we wait on it
+    notifier.rate_limiter = TopicRateLimiter(burst=float('inf'))
+    notifier.start()
+
+    stages = {name: [] for name in ("load_state", "plan_regions", "fetch_and_decode", "fan_out", "evaluate_user", "notify_user", "send_notifications", "tick")}
+    evaluated_users = 0
+    evaluated_aircraft = 0
+    allocations = []
+    simulated_now = time.time()
+
+    def stage(name, function, *stage_args):
+        result, seconds = timed(function, *stage_args)
+        stages[name].append(seconds)
+        return result
+
+    for tick in range(args.ticks):
+        if args.allocations:
+            tracemalloc.start()
+        tick_start = time.perf_counter()
+
+        users = stage("load_state", load_tick_state, session)
+        work = [user for user in users if user.filters.max_distance is not None]
+        circles = [(index, user.location.lat, user.location.lon, get_query_distance(user.filters.max_distance))
+                   for index, user in enumerate(work)]
+        regions = stage("plan_regions", plan_regions, circles)
+
+        pending = []
+        for region in regions:
+            def fetch_and_decode():
+                batch, dropped = aircraft_batch_from_json(source.fetch(region.lat, region.lon, region.radius_nm))
+                track_store.update(batch, simulated_now)
+                return batch
+            batch = stage("fetch_and_decode", fetch_and_decode)
+
+            for index, user_batch in stage("fan_out", fan_out, region, batch).items():
+                user = work[index]
+                location = user.location
+
+                def evaluate():
+                    approaches = compute_approaches(user_batch, location.lat, location.lon, location.alt, PREDICT_MINUTES, location.observer)
+                    interval = choose_interval(approaches, user.filters.max_distance, location.reported_at)
+                    return process_aircraft_for_user(user, location, user_batch, user.filters, user.filters.max_distance,
+                                                     approaches=approaches, next_interval=interval)
+                notifications = stage("evaluate_user", evaluate)
+                pending.extend(stage("notify_user", notify_user, user, notifications))
+                evaluated_users += 1
+                evaluated_aircraft += len(user_batch)
+
+        stage("send_notifications", send_notifications, session, notifier, pending)
+        source.tick()
+        simulated_now += UPDATE_RATE
+        stages["tick"].append(time.perf_counter() - tick_start)
+        if args.allocations:
+            allocations.append(tracemalloc.get_traced_memory()[1])
+            tracemalloc.stop()
+
+    delivery_start = time.perf_counter()
+    notifier.stop(timeout=60)
+    delivery_seconds = time.perf_counter() - delivery_start
+    server.shutdown()
+
+    evaluation_seconds = sum(stages["evaluate_user"]) + sum(stages["notify_user"])
+    result = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "users": args.users,
+        "ticks": args.ticks,
+        "source": repr(source) if args.replay else f"synthetic ({args.aircraft} aircraft)",
+        "stages": {name: percentiles(samples) for name, samples in stages.items()},
+        "user_evaluations": evaluated_users,
+        "users_per_second": evaluated_users / evaluation_seconds if evaluation_seconds else None,
+        "aircraft_evaluations": evaluated_aircraft,
+        "aircraft_evaluations_per_second": evaluated_aircraft / evaluation_seconds if evaluation_seconds else None,
+        "notifications_recorded": session.query(Notification).count(),
+        "notifications_delivered": StubNtfyHandler.received,
+        "notifications_failed": notifier.failed,
+        "delivery_drain_seconds": delivery_seconds,
+    }
+    if args.allocations:
+        result["tick_peak_allocated_bytes"] = {
+            "p50": float(np.percentile(allocations, 50)),
+            "max": max(allocations),
+        }
+    session.close()
+    return result
+
+# process_aircraft_for_user() over a busy snapshot with the logging as it was (DEBUG,
+# every aircraft), with per-aircraft lines capped, and at the INFO default
+def bench_logging(args):
+    use_throwaway_database()
+    import io
+    import logging
+    from types import SimpleNamespace
+    import aircraft
+    from aircraft_batch import compute_approaches
+    from config import logger
+    from filter_plan import compile_filters
+    from tick_state import LocationState
+
+    rng = random.Random(args.seed)
+    batch, dropped = aircraft_batch_from_json(synthetic_aircraft(rng, args.aircraft))
+    filters = [SimpleNamespace(name="overhead", conditions=[
+        SimpleNamespace(condition_type='3d_distance', value={"max_distance": 10.0}),
+        SimpleNamespace(condition_type='angle_above_horizon', value={"min_angle": 20.0}),
+    ])]
+    plan = compile_filters(filters)
+    user = SimpleNamespace(id=1, email="bench@example.com", topic="bench")
+    evaluations = []
+    for i in range(200):
+        location = LocationState(*random_point(rng, args.metro_radius), 0.0, datetime.utcnow())
+        evaluations.append((location, compute_approaches(batch, location.lat, location.lon, location.alt, aircraft.PREDICT_MINUTES, location.observer)))
+
+    stream = io.StringIO()
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    logger.addHandler(handler)
+    logger.propagate = False
+    results = []
+    try:
+        for mode, level, limit in (("debug_every_aircraft", logging.DEBUG, None),
+                                   ("debug_sampled", logging.DEBUG, aircraft.AIRCRAFT_LOG_LIMIT),
+                                   ("info", logging.INFO, aircraft.AIRCRAFT_LOG_LIMIT)):
+            logger.setLevel(level)
+            aircraft.AIRCRAFT_LOG_LIMIT = limit
+            stream.seek(0)
+            stream.truncate()
+
+            def evaluate_all():
+                for location, approaches in evaluations:
+                    aircraft.process_aircraft_for_user(user, location, batch, plan, plan.max_distance, approaches=approaches)
+            evaluate_all()
+            log_bytes = stream.tell()
+            seconds = min(timed(evaluate_all)[1] for _ in range(3))
+            results.append({
+                "mode": mode,
+                "aircraft": len(batch),
+                "evaluations": len(evaluations),
+                "seconds_per_evaluation": seconds / len(evaluations),
+                "log_bytes_per_evaluation": log_bytes / len(evaluations),
+            })
+    finally:
+        logger.removeHandler(handler)
+        logger.propagate = True
+    return results
+
+# Resident memory of this process right now, in MB
+def rss_mb():
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20
+    except OSError:
+        import resource
+        # the peak rather than the current size, but still shows growth
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+# Runs the monitor loop's own ticks back to back, every user due every tick, for
+# args.ticks ticks against a SQLite file, synthetic traffic and a stub ntfy server,
+# sampling memory as it goes.  Memory should level off once the caches have filled.
+# --one-session holds one session across every tick, as the loop used to.
+def bench_soak(args):
+    os.environ.update({"DB_TYPE": "sqlite", "DB_NAME": os.path.join(tempfile.mkdtemp(), "soak")})
+    import gc
+    import logging
+    from concurrent.futures import ThreadPoolExecutor
+    from config import Session, UPDATE_RATE, MONITOR_WORKERS, logger
+    from events import snapshot_cache
+    from main import run_tick, run_tick_in_session
+    from notifier import Notifier, TopicRateLimiter
+    from schedule import evaluation_schedule
+    from sharding import ShardCoordinator
+    logger.setLevel(getattr(logging, args.log_level))
+
+    rng = random.Random(args.seed)
+    create_synthetic_users(Session(), rng, args.users, args.metro_radius)
+    Session.remove()
+    source = SyntheticTraffic(rng, args.aircraft, args.metro_radius + QUERY_RADIUS_NM, UPDATE_RATE)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubNtfyHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    notifier = Notifier(f"http://127.0.0.1:{server.server_port}")
+    notifier.rate_limiter = TopicRateLimiter(burst=float('inf'))
+    notifier.start()
+    shards = ShardCoordinator("soak")
+    in_flight = set()
+    session = Session() if args.one_session else None
+    # snapshots are kept for a minute of wall time, which here would be hundreds of ticks
+    # rather than the one or two of the real loop, so keep just the latest tick's
+    snapshot_cache.max_age = 0
+
+    samples = []
+    sample_every = max(1, args.ticks // 20)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=MONITOR_WORKERS, thread_name_prefix="monitor") as executor:
+        for tick in range(args.ticks):
+            evaluation_schedule.retain(set())
+            deadline = time.monotonic() + UPDATE_RATE
+            if session is not None:
+                run_tick(session, executor, source, notifier, in_flight, deadline, shards)
+            else:
+                run_tick_in_session(executor, source, notifier, in_flight, deadline, shards)
+            if tick % sample_every == 0 or tick == args.ticks - 1:
+                gc.collect()
+                samples.append({
+                    "tick": tick,
+                    "rss_mb": round(rss_mb(), 1),
+                    "objects": len(gc.get_objects()),
+                    "identity_map": len(session.identity_map) if session is not None else None,
+                })
+    elapsed = time.perf_counter() - start
+    notifier.stop(timeout=60)
+    server.shutdown()
+
+    # growth over the second half, once the caches have had time to fill
+    settled = samples[len(samples) // 2]
+    return {
+        "users": args.users,
+        "ticks": args.ticks,
+        "session": "one for every tick" if args.one_session else "one per tick",
+        "ticks_per_second": args.ticks / elapsed,
+        "notifications_delivered": StubNtfyHandler.received,
+        "rss_growth_mb_second_half": round(samples[-1]["rss_mb"] - settled["rss_mb"], 1),
+        "object_growth_second_half": samples[-1]["objects"] - settled["objects"],
+        "samples": samples,
+    }
+
+BENCHMARKS = {
+    "spatial_index": bench_spatial_index,
+    "decode": bench_decode,
+    "geometry": bench_geometry,
+    "replay": bench_replay,
+    "logging": bench_logging,
+    "soak": bench_soak,
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmarks for the detection pipeline")
+    parser.add_argument('benchmark', choices=sorted(BENCHMARKS))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--aircraft', type=int, default=3000, help="aircraft in the synthetic snapshot")
+    parser.add_argument('--metro-radius', type=float, default=METRO_RADIUS_NM, help="radius users are spread over, in nm")
+    parser.add_argument('--users', type=int, default=500, help="synthetic users, for replay")
+    parser.add_argument('--ticks', type=int, default=10, help="monitor loop ticks, for replay and soak")
+    parser.add_argument('--replay', help="recorded snapshots, one JSON document per line, instead of synthetic traffic")
+    parser.add_argument('--allocations', action='store_true', help="trace allocations during replay ticks (slower)")
+    parser.add_argument('--log-level', default='WARNING', help="airshow log level during replay and soak")
+    parser.add_argument('--one-session', action='store_true', help="soak with one session held across ticks")
+    args = parser.parse_args()
+    print(json.dumps({"benchmark": args.benchmark, "results": BENCHMARKS[args.benchmark](args)}, indent=2))
@@ -1,10 +1,7 @@
 import numpy as np
-import math
+from geometry import EARTH_RADIUS_FEET, Observer, haversine, bearing
 
 
-# Earth's radius in feet
-EARTH_RADIUS_FEET = 6371 * 3280.84  # Convert from km to feet
-
 # Helper function to convert degrees to radians
 def deg_to_rad(deg):
     return deg * np.pi / 180.0
@@ -15,37 +12,18 @@ def rad_to_deg(rad):
 
 # Haversine formula to compute the 2D distance between two lat/lon points
 def haversine_distance(lat1, lon1, lat2, lon2):
-    dlat = deg_to_rad(lat2 - lat1)
-    dlon = deg_to_rad(lon2 - lon1)
-    lat1 = deg_to_rad(lat1)
-    lat2 = deg_to_rad(lat2)
-
-    a = np.sin(dlat / 2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon / 2)**2
-    c = 2 * np.arcsin(np.sqrt(a))
-    return EARTH_RADIUS_FEET * c
+    return haversine(lat1, lon1, lat2, lon2)
 
 # Helper function to compute the 3D distance between two points considering altitude
 def compute_3d_distance(lat1, lon1, alt1, lat2, lon2, alt2):
-    surface_distance = haversine_distance(lat1, lon1, lat2, lon2)
-    altitude_difference = abs(alt1 - alt2)
-    return np.sqrt(surface_distance**2 + altitude_difference**2)
+    return Observer(lat1, lon1, alt1).distance_3d(lat2, lon2, alt2)
 
 def compute_2d_distance(lat1, lon1, lat2, lon2):
     return haversine_distance(lat1, lon1, lat2, lon2)
 
 def calculate_bearing(lat1, lon1, lat2, lon2):
-    # Convert from degrees to radians
-    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
-
-    dlon = lon2 - lon1
-    x = math.sin(dlon) * math.cos(lat2)
-    y = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(dlon)
-    initial_bearing = math.atan2(x, y)
+    return bearing(lat1, lon1, lat2, lon2)
 
-    # Convert radians to degrees
-    initial_bearing = math.degrees(initial_bearing)
-    bearing = (initial_bearing + 360) % 360
-    return bearing
 
 def bearing_to_compass(bearing):
     compass_sectors = [
@@ -59,10 +37,7 @@ def bearing_to_compass(bearing):
 
 # Function to compute the angle above the horizon
 def compute_angle_above_horizon(user_pos, aircraft_pos):
-    horizontal_distance = haversine_distance(user_pos[0], user_pos[1], aircraft_pos[0], aircraft_pos[1])
-    vertical_distance = aircraft_pos[2] - user_pos[2]
-    angle_radians = np.arctan2(vertical_distance, horizontal_distance)
-    return rad_to_deg(angle_radians)
+    return Observer(*user_pos).angle_above_horizon(*aircraft_pos)
 
 # Function to predict the future position of the aircraft
 def predict_future_position(lat, lon, altitude, groundspeed, track, minutes):
@@ -81,25 +56,69 @@ def predict_future_position(lat, lon, altitude, groundspeed, track, minutes):
 
     return new_lat, new_lon, altitude
 
+# The most an aircraft is assumed to keep turning over the prediction window; a turn rate
+# held for several minutes would have it flying circles
+MAX_PREDICTED_TURN = 90.0  # degrees
+
+# Like predict_future_position(), but following a constant-rate turn (degrees/s) and
+# climb or descent (feet/min).  Works on scalars or NumPy arrays.
+def predict_future_position_turning(lat, lon, altitude, groundspeed, track, turn_rate, vertical_rate, minutes):
+    seconds = minutes * 60
+    turn = np.clip(turn_rate * seconds, -MAX_PREDICTED_TURN, MAX_PREDICTED_TURN)
+
+    # Convert groundspeed from knots to feet per minute, and work out how far we go
+    distance_traveled = groundspeed * 6076.12 / 60 * minutes
+
+    # On a turn the aircraft ends up along the chord of the arc, at the average of the
+    # starting and ending track and a little short of the full distance flown
+    half_turn = deg_to_rad(turn) / 2
+    safe_half_turn = np.where(half_turn == 0, 1.0, half_turn)
+    chord = np.where(half_turn == 0, distance_traveled, distance_traveled * np.sin(safe_half_turn) / safe_half_turn)
+    chord_track = track + turn / 2
+
+    delta_lat = chord * np.cos(deg_to_rad(chord_track)) / EARTH_RADIUS_FEET
+    delta_lon = chord * np.sin(deg_to_rad(chord_track)) / (EARTH_RADIUS_FEET * np.cos(deg_to_rad(lat)))
+
+    new_lat = lat + rad_to_deg(delta_lat)
+    new_lon = lon + rad_to_deg(delta_lon)
+    new_alt = np.maximum(altitude + vertical_rate * minutes, 0)
+
+    return new_lat, new_lon, new_alt
+
+# Closest point of approach solved analytically.  The aircraft's path is treated as a
+# straight line in the user's local tangent plane, so the time of closest approach is the
+# projection of the user onto that line, clamped to the prediction window.  The distance at
+# that time is then measured with the same haversine-based 3D distance as everywhere else.
+# Works on scalars or NumPy arrays of aircraft (one user per call), returning
+# closest_point as a tuple of (lat, lon, alt), t_closest as a fraction of the prediction
+# window, and min_distance in nautical miles.  Pass the user's Observer if there is one.
+def closest_approach_vectorized(user_lat, user_lon, user_alt, aircraft_lat, aircraft_lon, aircraft_alt, future_lat, future_lon, future_alt, observer=None):
+    observer = observer or Observer(user_lat, user_lon, user_alt)
+    start_e, start_n, start_u = observer.to_enu(aircraft_lat, aircraft_lon, aircraft_alt)
+    end_e, end_n, end_u = observer.to_enu(future_lat, future_lon, future_alt)
+
+    delta_e = end_e - start_e
+    delta_n = end_n - start_n
+    delta_u = end_u - start_u
+    path_length_sq = delta_e**2 + delta_n**2 + delta_u**2
+    along_path = -(start_e * delta_e + start_n * delta_n + start_u * delta_u)
+
+    # aircraft that aren't moving are closest right now
+    safe_length_sq = np.where(path_length_sq > 0, path_length_sq, 1.0)
+    t_closest = np.clip(np.where(path_length_sq > 0, along_path / safe_length_sq, 0.0), 0.0, 1.0)
+
+    closest_lat = aircraft_lat + t_closest * (future_lat - aircraft_lat)
+    closest_lon = aircraft_lon + t_closest * (future_lon - aircraft_lon)
+    closest_alt = aircraft_alt + t_closest * (future_alt - aircraft_alt)
+
+    min_distance = observer.distance_3d(closest_lat, closest_lon, closest_alt)
+    return (closest_lat, closest_lon, closest_alt), t_closest, min_distance / 6076.12
+
 # Function to find the closest point of approach, returns minimum distance in nautical miles and time in fraction of prediction window
 def closest_approach(user_lat, user_lon, user_alt, aircraft_lat, aircraft_lon, aircraft_alt, future_lat, future_lon, future_alt):
-    # Sampling points along the aircraft's path to estimate closest approach
-    num_samples = 100
-    min_distance = float('inf')
-    closest_point = None
-    t_closest = 0
-
-    for i in range(num_samples + 1):
-        t = i / num_samples
-        interp_lat = aircraft_lat + t * (future_lat - aircraft_lat)
-        interp_lon = aircraft_lon + t * (future_lon - aircraft_lon)
-        interp_alt = aircraft_alt + t * (future_alt - aircraft_alt)
-
-        distance = compute_3d_distance(user_lat, user_lon, user_alt, interp_lat, interp_lon, interp_alt)
-
-        if distance < min_distance:
-            min_distance = distance
-            closest_point = (interp_lat, interp_lon, interp_alt)
-            t_closest = t
-
-    return closest_point, t_closest, min_distance / 6076.12
+    closest_point, t_closest, min_distance = closest_approach_vectorized(
+        user_lat, user_lon, user_alt,
+        aircraft_lat, aircraft_lon, aircraft_alt,
+        future_lat, future_lon, future_alt
+    )
+    return tuple(float(v) for v in closest_point), float(t_closest), float(min_distance)
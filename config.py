@@ -1,11 +1,52 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect, select, delete
 from sqlalchemy.orm import sessionmaker, scoped_session
-from models import Base
+from sqlalchemy.pool import StaticPool
+from models import Base, LastLocation
+from metrics import instrument_engine
 import os
+import socket
 
 import logging
 
 UPDATE_RATE = 60 # seconds
+# How many users (and regional fetches) the monitor loop works on at once
+MONITOR_WORKERS = int(os.getenv('MONITOR_WORKERS', '8'))
+# Users whose last reported location is older than this aren't evaluated
+LOCATION_MAX_AGE_HOURS = float(os.getenv('LOCATION_MAX_AGE_HOURS', '24'))
+# Where aircraft data comes from, see sources.py
+AIRCRAFT_SOURCE = os.getenv('AIRCRAFT_SOURCE', 'adsbfi')
+# Where notifications are published, one topic per user
+NTFY_URL = os.getenv('NTFY_URL', 'https://ntfy.sh')
+# Users are split into this many shards, which monitor workers hold leases on.  Every
+# worker sharing a database must use the same count.
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '16'))
+# This monitor worker's name in the shard leases, unique per process
+WORKER_ID = os.getenv('WORKER_ID') or f"{socket.gethostname()}-{os.getpid()}"
+# Notifications older than this are rolled up into daily counts and deleted, 0 keeps them forever
+NOTIFICATION_RETENTION_DAYS = int(os.getenv('NOTIFICATION_RETENTION_DAYS', '90'))
+# Port the monitor serves /metrics on, 0 for none
+METRICS_PORT = int(os.getenv('METRICS_PORT', '9108'))
+# gunicorn's API workers each serve their own /metrics on the first free port from this
+# one, up to one port per worker, 0 for none
+API_METRICS_PORT = int(os.getenv('API_METRICS_PORT', '9200'))
+# Profile one monitor loop tick in this many with the sampling profiler, 0 to never profile
+PROFILE_EVERY_TICKS = int(os.getenv('PROFILE_EVERY_TICKS', '0'))
+
+# Connections each process keeps open, and how many more it may open under load.  The
+# monitor's workers, the retention and location threads and each API worker thread can
+# all hold one, so size these for the busier of the monitor and an API worker.
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+# Test connections before handing them out, so a database restart doesn't fail the next queries
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes')
+# Reopen connections older than this many seconds, before a server or proxy idle timeout
+# drops them; -1 never does
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+# How many compiled SQL statements SQLAlchemy keeps, so the loop's queries aren't
+# recompiled every tick
+DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '500'))
+# An optional read replica for the monitor loop's reads, as a full database URL
+DB_READ_URL = os.getenv('DB_READ_URL')
 
 def get_database_url():
     db_type = os.getenv('DB_TYPE', 'postgresql')
@@ -20,15 +61,77 @@ def get_database_url():
     elif db_type == 'mysql':
         return f'mysql+pymysql://{user}:{password}@{host}:{port}/{db_name}'
     elif db_type == 'sqlite':
-        return f'sqlite:///{db_name}.db'
+        # DB_NAME=:memory: for a throwaway database, e.g. for benchmarks
+        return 'sqlite://' if db_name == ':memory:' else f'sqlite:///{db_name}.db'
     else:
         raise ValueError("Unsupported database type")
 
-engine = create_engine(get_database_url())
-Base.metadata.create_all(engine)
-Session = scoped_session(sessionmaker(bind=engine))
+def get_engine_options(url):
+    options = {"query_cache_size": DB_STATEMENT_CACHE_SIZE}
+    # an in-memory SQLite database lives on one connection, so every thread has to share it
+    if url == 'sqlite://':
+        return {**options, "poolclass": StaticPool, "connect_args": {"check_same_thread": False}}
+    if url.startswith('sqlite'):
+        return options
+    return {**options, "pool_size": DB_POOL_SIZE, "max_overflow": DB_MAX_OVERFLOW,
+            "pool_pre_ping": DB_POOL_PRE_PING, "pool_recycle": DB_POOL_RECYCLE}
+
+# The engine for read-only sessions: the replica if there is one, otherwise the main
+# engine, and on Postgres in read-only transactions either way
+def create_read_engine(engine):
+    read_engine = engine
+    if DB_READ_URL:
+        read_engine = create_engine(DB_READ_URL, **get_engine_options(DB_READ_URL))
+        instrument_engine(read_engine)
+    if read_engine.dialect.name == 'postgresql':
+        read_engine = read_engine.execution_options(postgresql_readonly=True)
+    return read_engine
 
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
+# Set up logging.  DEBUG logs every tick's working, per user and per aircraft.
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+logging.basicConfig(level=LOG_LEVEL)
 logger = logging.getLogger("airshow")
 
+# Databases from before last_locations had a unique index on user_id can hold several
+# rows for a user, which would stop the index being created.  Keep each user's newest
+# report (the highest id among equally new ones) and delete the rest.  Returns how many
+# rows were deleted.
+def remove_duplicate_locations(engine):
+    table = LastLocation.__table__
+    inspector = inspect(engine)
+    if not inspector.has_table(table.name):
+        return 0
+    if any(index['name'] == 'ix_last_locations_user_id' for index in inspector.get_indexes(table.name)):
+        return 0
+    with engine.begin() as connection:
+        # newest first within each user, so every row after a user's first is a duplicate
+        rows = connection.execute(select(table.c.id, table.c.user_id)
+                                  .order_by(table.c.user_id, table.c.reported_at.desc(), table.c.id.desc()))
+        seen = set()
+        duplicates = []
+        for id, user_id in rows:
+            if user_id in seen:
+                duplicates.append(id)
+            seen.add(user_id)
+        for i in range(0, len(duplicates), 1000):
+            connection.execute(delete(table).where(table.c.id.in_(duplicates[i:i + 1000])))
+    if duplicates:
+        logger.warning(f"Deleted {len(duplicates)} older last_locations rows so each user has one, "
+                       f"before creating the unique index on user_id")
+    return len(duplicates)
+
+database_url = get_database_url()
+engine = create_engine(database_url, **get_engine_options(database_url))
+instrument_engine(engine)
+remove_duplicate_locations(engine)
+Base.metadata.create_all(engine)
+# create_all skips tables that already exist, so add any indexes they're missing
+for table in Base.metadata.sorted_tables:
+    for index in table.indexes:
+        index.create(engine, checkfirst=True)
+Session = scoped_session(sessionmaker(bind=engine))
+# For the monitor loop's reads: nothing is written through these, so there's nothing to
+# flush before a query, and they may be served by a replica
+read_engine = create_read_engine(engine)
+ReadSession = scoped_session(sessionmaker(bind=read_engine, autoflush=False))
+
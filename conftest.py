@@ -0,0 +1,5 @@
+import os
+
+# config creates the engine and tables when it's imported, so tests get a throwaway database
+os.environ.setdefault('DB_TYPE', 'sqlite')
+os.environ.setdefault('DB_NAME', ':memory:')
@@ -1,13 +1,12 @@
-from sqlalchemy.orm import Session
-from models import User, LastLocation
+from sqlalchemy.orm import selectinload
+from models import User, LastLocation, Filter
 from config import Session
 
-def update_users_from_db(session):
-    return session.query(User).all()
-
-# Lookup user's current location
-def get_location_for_user(session, user):
-    return session.query(LastLocation).filter_by(user_id=user.id).first()
+# Load the filters of several users at once, ordered by user and evaluation order
+def get_filters_for_users(session, user_ids):
+    return session.query(Filter).options(selectinload(Filter.conditions)) \
+        .filter(Filter.user_id.in_(user_ids)) \
+        .order_by(Filter.user_id, Filter.evaluation_order).all()
 
 def get_user_by_email(session, email):
     return session.query(User).filter(User.email == email).first()
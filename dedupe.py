@@ -0,0 +1,53 @@
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from models import Notification
+
+# Don't notify a user about the same aircraft more than once in this window
+DEDUPE_WINDOW = timedelta(minutes=15)
+
+# Remembers when each (user_id, aircraft_hex) was last notified, so deciding whether
+# to send an alert never needs the database.  Entries older than the window are evicted.
+class NotificationDedupe:
+    def __init__(self, window=DEDUPE_WINDOW):
+        self.window = window
+        self.last_sent = {}
+        self.lock = threading.Lock()
+
+    # Load the notifications sent within the window, e.g. after a restart or after
+    # taking over users from another worker
+    def warm(self, session):
+        since = datetime.utcnow() - self.window
+        rows = session.query(Notification.user_id, Notification.aircraft_hex, func.max(Notification.timestamp)) \
+            .filter(Notification.timestamp >= since) \
+            .group_by(Notification.user_id, Notification.aircraft_hex)
+        with self.lock:
+            for user_id, aircraft_hex, timestamp in rows:
+                key = (user_id, aircraft_hex)
+                self.last_sent[key] = max(timestamp, self.last_sent.get(key, timestamp))
+        return len(self.last_sent)
+
+    # Returns True, and records the notification as sent, if the user hasn't been
+    # notified about this aircraft within the window
+    def claim(self, user_id, aircraft_hex, now=None):
+        now = now or datetime.utcnow()
+        key = (user_id, aircraft_hex)
+        with self.lock:
+            last_sent = self.last_sent.get(key)
+            if last_sent is not None and last_sent >= now - self.window:
+                return False
+            self.last_sent[key] = now
+            return True
+
+    def evict(self, now=None):
+        cutoff = (now or datetime.utcnow()) - self.window
+        with self.lock:
+            expired = [key for key, last_sent in self.last_sent.items() if last_sent < cutoff]
+            for key in expired:
+                del self.last_sent[key]
+        return len(expired)
+
+    def __len__(self):
+        return len(self.last_sent)
+
+notification_dedupe = NotificationDedupe()
@@ -0,0 +1,72 @@
+import threading
+import time
+from fetch_planner import Region
+from geometry import distance_nm
+from http_fetch import CACHE_TTL
+
+# How long to keep collecting location updates after the first one arrives, so a
+# device posting in bursts is evaluated once
+EVENT_COALESCE_SECONDS = 2.0
+# Snapshots older than this aren't used for event evaluations; the user waits for the
+# next tick.  Younger ones are flown forward to the present before they're used.
+SNAPSHOT_MAX_AGE = CACHE_TTL
+
+# Users waiting for an immediate evaluation.  Requests for a user already waiting
+# are coalesced into one.
+class EvaluationQueue:
+    def __init__(self):
+        self.pending = set()
+        self.condition = threading.Condition()
+
+    def request(self, user_id):
+        with self.condition:
+            self.pending.add(user_id)
+            self.condition.notify()
+
+    # Block until at least one user is waiting, keep collecting for coalesce_seconds,
+    # then return every waiting user id
+    def take(self, coalesce_seconds=EVENT_COALESCE_SECONDS):
+        with self.condition:
+            while not self.pending:
+                self.condition.wait()
+        time.sleep(coalesce_seconds)
+        with self.condition:
+            user_ids = self.pending
+            self.pending = set()
+        return user_ids
+
+    def __len__(self):
+        return len(self.pending)
+
+# The most recent AircraftBatch fetched for each region, so a user can be evaluated
+# between ticks without another upstream request
+class SnapshotCache:
+    def __init__(self, max_age=SNAPSHOT_MAX_AGE):
+        self.max_age = max_age
+        self.snapshots = []
+        self.lock = threading.Lock()
+
+    def store(self, region, batch):
+        now = time.monotonic()
+        with self.lock:
+            self.snapshots = [s for s in self.snapshots if now - s[2] <= self.max_age]
+            self.snapshots.append((region, batch, now))
+
+    # The freshest snapshot whose region covers the whole query circle, as a single-member
+    # Region, its batch and when it was fetched (time.monotonic()), or None if no recent
+    # snapshot covers it
+    def find(self, lat, lon, radius_nm):
+        now = time.monotonic()
+        with self.lock:
+            snapshots = list(self.snapshots)
+        for region, batch, fetched_at in reversed(snapshots):
+            if now - fetched_at > self.max_age:
+                continue
+            if distance_nm(region.lat, region.lon, lat, lon) + radius_nm <= region.radius_nm:
+                covering = Region(region.lat, region.lon, region.radius_nm)
+                covering.members.append((None, lat, lon, radius_nm))
+                return covering, batch, fetched_at
+        return None
+
+evaluation_queue = EvaluationQueue()
+snapshot_cache = SnapshotCache()
@@ -0,0 +1,156 @@
+import math
+import numpy as np
+from geometry import EARTH_RADIUS_NM, distance_nm
+from spatial_index import SpatialIndex
+
+# Regions are capped well below the 250nm adsb.fi allows so a merged
+# region over busy airspace doesn't turn into a multi-megabyte response
+REGION_MAX_RADIUS_NM = 100
+# Indexing a snapshot only pays when it lets many members each skip most of a big
+# batch.  From python benchmark.py spatial_index over 1,000-6,000 aircraft: with
+# fewer than 10 members, or circles covering more than about 15% of the region's
+# area (a 30nm metro's 28nm circles cover 23% of their region), or under ~2,000
+# aircraft, the index is 0.3-1.0x the speed of measuring every aircraft.  At 10+
+# members, 2,000+ aircraft and 8% coverage it's 1.1-2.5x.
+INDEX_MIN_MEMBERS = 10
+INDEX_MIN_AIRCRAFT = 2000
+INDEX_MAX_COVERAGE = 0.15
+
+# A regional fetch covering one or more users' query circles
+class Region:
+    def __init__(self, lat, lon, radius_nm):
+        self.lat = lat
+        self.lon = lon
+        self.radius_nm = radius_nm
+        # (key, lat, lon, radius_nm) for every query circle this region covers
+        self.members = []
+
+    def __repr__(self):
+        return f"Region({self.lat:.4f}, {self.lon:.4f}, {self.radius_nm:.1f}nm, {len(self.members)} members)"
+
+# Point at the given fraction of the way along the great circle from point 1 to point 2
+def intermediate_point(lat1, lon1, lat2, lon2, fraction):
+    d = distance_nm(lat1, lon1, lat2, lon2) / EARTH_RADIUS_NM
+    if d == 0:
+        return lat1, lon1
+    lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+    a = math.sin((1 - fraction) * d) / math.sin(d)
+    b = math.sin(fraction * d) / math.sin(d)
+    x = a * math.cos(lat1) * math.cos(lon1) + b * math.cos(lat2) * math.cos(lon2)
+    y = a * math.cos(lat1) * math.sin(lon1) + b * math.cos(lat2) * math.sin(lon2)
+    z = a * math.sin(lat1) + b * math.sin(lat2)
+    return math.degrees(math.atan2(z, math.sqrt(x**2 + y**2))), math.degrees(math.atan2(y, x))
+
+# Smallest circle containing both circles, returned as (lat, lon, radius_nm)
+def covering_circle(lat1, lon1, r1, lat2, lon2, r2):
+    d = distance_nm(lat1, lon1, lat2, lon2)
+    if d + r2 <= r1:
+        return lat1, lon1, r1
+    if d + r1 <= r2:
+        return lat2, lon2, r2
+    radius = (d + r1 + r2) / 2
+    lat, lon = intermediate_point(lat1, lon1, lat2, lon2, (radius - r1) / d)
+    return lat, lon, radius
+
+# Regions bucketed by the grid cell their center is in, so placing a circle only
+# measures it against the regions near enough to take it
+class RegionGrid:
+    def __init__(self, cell_nm):
+        self.step = cell_nm / 60
+        # (row, column) -> {region number: region}
+        self.cells = {}
+        self.count = 0
+
+    def cell(self, lat, lon):
+        return math.floor(lat / self.step), math.floor(lon / self.step)
+
+    def add(self, number, region):
+        self.cells.setdefault(self.cell(region.lat, region.lon), {})[number] = region
+        self.count += 1
+
+    def move(self, number, region, lat, lon):
+        old_cell = self.cell(region.lat, region.lon)
+        new_cell = self.cell(lat, lon)
+        if new_cell != old_cell:
+            del self.cells[old_cell][number]
+            self.cells.setdefault(new_cell, {})[number] = region
+
+    # Every region whose center may be within distance_nm of the point, as
+    # (region number, region) in the order they were added
+    def near(self, lat, lon, distance_nm):
+        if distance_nm < 0:
+            return []
+        dlat = distance_nm / 60
+        dlon = distance_nm / (60 * max(0.01, math.cos(math.radians(min(89.0, abs(lat) + dlat)))))
+        first_row, first_column = self.cell(lat - dlat, lon - dlon)
+        last_row, last_column = self.cell(lat + dlat, lon + dlon)
+        # near the poles or the antimeridian, or when the neighbourhood has more cells
+        # than there are regions, just check everything
+        if lon - dlon < -180 or lon + dlon > 180 or lat + dlat > 89 or lat - dlat < -89 or \
+                (last_row - first_row + 1) * (last_column - first_column + 1) > self.count:
+            found = [item for cell in self.cells.values() for item in cell.items()]
+        else:
+            found = []
+            for row in range(first_row, last_row + 1):
+                for column in range(first_column, last_column + 1):
+                    cell = self.cells.get((row, column))
+                    if cell:
+                        found.extend(cell.items())
+        found.sort(key=lambda item: item[0])
+        return found
+
+# Group the users' query circles into a small set of covering regions.
+# circles is a list of (key, lat, lon, radius_nm); each circle ends up in
+# exactly one region.  Larger circles are placed first so small ones tend to
+# fall inside them without growing the region at all.
+#
+# Every region is at least as big as the circle being placed, and the circle covering
+# both has radius (distance + r1 + r2) / 2, so only regions centered within
+# 2 * (max_radius_nm - radius_nm) can take it.  Those are found on a grid of region
+# centers rather than by measuring the circle against every region.
+def plan_regions(circles, max_radius_nm=REGION_MAX_RADIUS_NM):
+    regions = []
+    grid = RegionGrid(max_radius_nm)
+    for key, lat, lon, radius_nm in sorted(circles, key=lambda c: -c[3]):
+        best = None
+        for number, region in grid.near(lat, lon, 2 * (max_radius_nm - radius_nm) + 1):
+            merged = covering_circle(region.lat, region.lon, region.radius_nm, lat, lon, radius_nm)
+            if merged[2] <= max_radius_nm and (best is None or merged[2] < best[2][2]):
+                best = (number, region, merged)
+
+        if best is None:
+            region = Region(lat, lon, radius_nm)
+            grid.add(len(regions), region)
+            regions.append(region)
+        else:
+            number, region, merged = best
+            grid.move(number, region, merged[0], merged[1])
+            region.lat, region.lon, region.radius_nm = merged
+        region.members.append((key, lat, lon, radius_nm))
+    return regions
+
+# Whether fanning a batch of aircraft_count aircraft out to the region's members is
+# faster through a SpatialIndex than by measuring every aircraft for every member
+def worth_indexing(region, aircraft_count):
+    if len(region.members) < INDEX_MIN_MEMBERS or aircraft_count < INDEX_MIN_AIRCRAFT or not region.radius_nm:
+        return False
+    largest = max(radius_nm for key, lat, lon, radius_nm in region.members)
+    return (largest / region.radius_nm)**2 <= INDEX_MAX_COVERAGE
+
+def fan_out_indexed(region, batch):
+    index = SpatialIndex(batch.lat, batch.lon)
+    return {key: batch.subset(index.query(lat, lon, radius_nm)) for key, lat, lon, radius_nm in region.members}
+
+def fan_out_scanned(region, batch):
+    return {key: batch.subset(np.flatnonzero(distance_nm(lat, lon, batch.lat, batch.lon) <= radius_nm))
+            for key, lat, lon, radius_nm in region.members}
+
+# Split a region's AircraftBatch back into each member's own query circle, so every
+# user sees exactly what a fetch centered on them would have returned.  Big batches
+# shared by many small circles are indexed once, so each member only looks at the
+# aircraft near it; otherwise every member measures every aircraft.
+# Returns a dict of key -> AircraftBatch.
+def fan_out(region, batch):
+    if worth_indexing(region, len(batch)):
+        return fan_out_indexed(region, batch)
+    return fan_out_scanned(region, batch)
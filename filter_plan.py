@@ -0,0 +1,141 @@
+import threading
+import numpy as np
+from sqlalchemy import func
+from models import Filter
+from db import get_filters_for_users
+from geometry import observer_for
+
+# Relative cost of evaluating each condition type over a batch; cheaper
+# conditions run first so the expensive ones see fewer aircraft
+CONDITION_COSTS = {
+    '3d_distance': 0,
+    'altitude_below': 0,
+    '2d_distance': 1,
+    'angle_above_horizon': 2,
+}
+
+# Predicates take the batch, its approaches, the user's location and the indices of the
+# aircraft still under consideration, and return a boolean mask over those indices
+def within_3d_distance(max_distance):
+    def predicate(batch, approaches, location, indices):
+        return approaches['min_distance'][indices] <= max_distance
+    return predicate
+
+def within_2d_distance(max_distance):
+    def predicate(batch, approaches, location, indices):
+        distance = observer_for(location).distance_2d(approaches['closest_lat'][indices], approaches['closest_lon'][indices])
+        return distance <= max_distance
+    return predicate
+
+def above_angle(min_angle):
+    def predicate(batch, approaches, location, indices):
+        angle = observer_for(location).angle_above_horizon(
+            approaches['closest_lat'][indices], approaches['closest_lon'][indices], approaches['closest_alt'][indices]
+        )
+        return angle >= min_angle
+    return predicate
+
+def below_altitude(max_altitude):
+    def predicate(batch, approaches, location, indices):
+        return batch.alt[indices] < max_altitude
+    return predicate
+
+# A user's filters compiled into predicates, in evaluation order
+class FilterPlan:
+    def __init__(self, filters, max_distance):
+        # list of (filter name, [predicates cheapest first])
+        self.filters = filters
+        # the largest 2d/3d distance across all filters, or None if no filter has one
+        self.max_distance = max_distance
+
+    # Match candidate aircraft (an array of batch indices) against the filters.  Returns a
+    # list of (index, filter name) for each aircraft matching a filter; each aircraft is
+    # matched against the first filter, in evaluation order, whose conditions it meets.
+    def evaluate(self, batch, approaches, location, candidates):
+        matches = []
+        unmatched = np.asarray(candidates, dtype=int)
+        for name, predicates in self.filters:
+            remaining = unmatched
+            for predicate in predicates:
+                if not len(remaining):
+                    break
+                remaining = remaining[predicate(batch, approaches, location, remaining)]
+            matches.extend((int(i), name) for i in remaining)
+            unmatched = np.setdiff1d(unmatched, remaining, assume_unique=True)
+            if not len(unmatched):
+                break
+        return sorted(matches)
+
+def compile_condition(condition):
+    if condition.condition_type == '3d_distance':
+        return within_3d_distance(float(condition.value['max_distance']))
+    elif condition.condition_type == '2d_distance':
+        return within_2d_distance(float(condition.value['max_distance']))
+    elif condition.condition_type == 'angle_above_horizon':
+        return above_angle(float(condition.value['min_angle']))
+    elif condition.condition_type == 'altitude_below':
+        return below_altitude(float(condition.value['max_altitude']))
+    # unknown condition types never stop a filter from matching
+    return None
+
+# Compile Filter rows (with their conditions loaded, in evaluation order) into a FilterPlan
+def compile_filters(filters):
+    compiled = []
+    max_distance = None
+    for user_filter in filters:
+        conditions = sorted(user_filter.conditions, key=lambda c: CONDITION_COSTS.get(c.condition_type, 0))
+        predicates = []
+        for condition in conditions:
+            predicate = compile_condition(condition)
+            if predicate is not None:
+                predicates.append(predicate)
+            if condition.condition_type in ('3d_distance', '2d_distance'):
+                distance = condition.value['max_distance']
+                if max_distance is None or distance > max_distance:
+                    max_distance = distance
+        compiled.append((user_filter.name, predicates))
+    return FilterPlan(compiled, max_distance)
+
+# Compiled plans by user id, stored as (version, plan)
+_plans = {}
+_plans_lock = threading.Lock()
+
+# A version for every user's filters in one query: (newest updated_at, filter count).
+# The API touches a filter's updated_at whenever its conditions change, so any edit,
+# addition or deletion changes the version.
+def get_filter_versions(session):
+    rows = session.query(Filter.user_id, func.max(Filter.updated_at), func.count(Filter.id)).group_by(Filter.user_id)
+    return {user_id: (updated_at, count) for user_id, updated_at, count in rows}
+
+# The same version for one user's filters
+def get_filter_version(session, user_id):
+    updated_at, count = session.query(func.max(Filter.updated_at), func.count(Filter.id)) \
+        .filter(Filter.user_id == user_id).one()
+    return (updated_at, count)
+
+# Return compiled plans for every user in versions (a dict of user id -> filter version),
+# reloading the filters of all users whose version changed in a single query
+def get_plans(session, versions):
+    plans = {}
+    stale = []
+    with _plans_lock:
+        for user_id, version in versions.items():
+            cached = _plans.get(user_id)
+            if cached is not None and cached[0] == version:
+                plans[user_id] = cached[1]
+            else:
+                stale.append(user_id)
+
+    if stale:
+        filters_by_user = {user_id: [] for user_id in stale}
+        for user_filter in get_filters_for_users(session, stale):
+            filters_by_user[user_filter.user_id].append(user_filter)
+        with _plans_lock:
+            for user_id, filters in filters_by_user.items():
+                plans[user_id] = compile_filters(filters)
+                _plans[user_id] = (versions[user_id], plans[user_id])
+    return plans
+
+def invalidate_plan(user_id):
+    with _plans_lock:
+        _plans.pop(user_id, None)
@@ -0,0 +1,133 @@
+import math
+import numpy as np
+
+# Earth's radius in feet
+EARTH_RADIUS_FEET = 6371 * 3280.84  # Convert from km to feet
+FEET_PER_DEGREE = EARTH_RADIUS_FEET * math.pi / 180
+# and in nautical miles, for query circles and regions
+EARTH_RADIUS_NM = 3440.07
+
+# Every function here takes either plain numbers or NumPy arrays.  Plain numbers go through
+# the math module, since NumPy's per-call overhead on scalars is many times the cost of
+# the arithmetic; arrays go through NumPy.  The check has to be cheap or it eats the
+# saving, so it's an isinstance (NumPy's float64 is a float) rather than np.ndim().
+def is_scalar(*values):
+    for value in values:
+        if not isinstance(value, (float, int)):
+            return False
+    return True
+
+def haversine_scalar(lat1, lon1, lat2, lon2, radius=EARTH_RADIUS_FEET):
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2)**2 + math.cos(math.radians(lat1)) * math.cos(math.radians(lat2)) * math.sin(dlon / 2)**2
+    return radius * 2 * math.asin(math.sqrt(min(1.0, a)))
+
+def haversine_array(lat1, lon1, lat2, lon2, radius=EARTH_RADIUS_FEET):
+    dlat = np.radians(lat2 - lat1)
+    dlon = np.radians(lon2 - lon1)
+    a = np.sin(dlat / 2)**2 + np.cos(np.radians(lat1)) * np.cos(np.radians(lat2)) * np.sin(dlon / 2)**2
+    return radius * 2 * np.arcsin(np.sqrt(np.minimum(1.0, a)))
+
+# Great-circle distance in feet, or in whatever unit radius is given in
+def haversine(lat1, lon1, lat2, lon2, radius=EARTH_RADIUS_FEET):
+    if is_scalar(lat1, lon1, lat2, lon2):
+        return haversine_scalar(lat1, lon1, lat2, lon2, radius)
+    return haversine_array(lat1, lon1, lat2, lon2, radius)
+
+# Great-circle distance in nautical miles
+def distance_nm(lat1, lon1, lat2, lon2):
+    return haversine(lat1, lon1, lat2, lon2, EARTH_RADIUS_NM)
+
+def bearing_scalar(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = math.radians(lat1), math.radians(lon1), math.radians(lat2), math.radians(lon2)
+    dlon = lon2 - lon1
+    x = math.sin(dlon) * math.cos(lat2)
+    y = math.cos(lat1) * math.sin(lat2) - math.sin(lat1) * math.cos(lat2) * math.cos(dlon)
+    return (math.degrees(math.atan2(x, y)) + 360) % 360
+
+def bearing_array(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = np.radians(lat1), np.radians(lon1), np.radians(lat2), np.radians(lon2)
+    dlon = lon2 - lon1
+    x = np.sin(dlon) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - np.sin(lat1) * np.cos(lat2) * np.cos(dlon)
+    return (np.degrees(np.arctan2(x, y)) + 360) % 360
+
+# Initial bearing in degrees from the first point to the second
+def bearing(lat1, lon1, lat2, lon2):
+    if is_scalar(lat1, lon1, lat2, lon2):
+        return bearing_scalar(lat1, lon1, lat2, lon2)
+    return bearing_array(lat1, lon1, lat2, lon2)
+
+# A user's position with the trig that every measurement from it needs worked out once.
+# Build one per location per tick and measure all the aircraft against it.  lat/lon/alt
+# may also be arrays of observers, in which case everything goes through NumPy.
+class Observer:
+    def __init__(self, lat, lon, alt):
+        self.scalar = is_scalar(lat, lon, alt)
+        if self.scalar:
+            self.lat, self.lon, self.alt = float(lat), float(lon), float(alt)
+            lat_radians = math.radians(self.lat)
+            self.sin_lat = math.sin(lat_radians)
+            self.cos_lat = math.cos(lat_radians)
+        else:
+            self.lat, self.lon, self.alt = lat, lon, alt
+            lat_radians = np.radians(lat)
+            self.sin_lat = np.sin(lat_radians)
+            self.cos_lat = np.cos(lat_radians)
+        # feet per degree of longitude at the observer, for the local tangent plane
+        self.feet_per_degree_lon = FEET_PER_DEGREE * self.cos_lat
+
+    def use_math(self, *values):
+        return self.scalar and is_scalar(*values)
+
+    # Great-circle distance in feet to the point(s)
+    def distance_2d(self, lat, lon):
+        if self.use_math(lat, lon):
+            a = math.sin(math.radians(lat - self.lat) / 2)**2 + \
+                self.cos_lat * math.cos(math.radians(lat)) * math.sin(math.radians(lon - self.lon) / 2)**2
+            return EARTH_RADIUS_FEET * 2 * math.asin(math.sqrt(min(1.0, a)))
+        a = np.sin(np.radians(lat - self.lat) / 2)**2 + \
+            self.cos_lat * np.cos(np.radians(lat)) * np.sin(np.radians(lon - self.lon) / 2)**2
+        return EARTH_RADIUS_FEET * 2 * np.arcsin(np.sqrt(np.minimum(1.0, a)))
+
+    # Straight-line distance in feet, from the surface distance and the altitude difference
+    def distance_3d(self, lat, lon, alt):
+        surface_distance = self.distance_2d(lat, lon)
+        if self.use_math(lat, lon, alt):
+            return math.hypot(surface_distance, alt - self.alt)
+        return np.hypot(surface_distance, alt - self.alt)
+
+    # Degrees above the horizon
+    def angle_above_horizon(self, lat, lon, alt):
+        surface_distance = self.distance_2d(lat, lon)
+        if self.use_math(lat, lon, alt):
+            return math.degrees(math.atan2(alt - self.alt, surface_distance))
+        return np.degrees(np.arctan2(alt - self.alt, surface_distance))
+
+    # Initial bearing in degrees to the point(s)
+    def bearing_to(self, lat, lon):
+        if self.use_math(lat, lon):
+            lat_radians = math.radians(lat)
+            dlon = math.radians(lon - self.lon)
+            x = math.sin(dlon) * math.cos(lat_radians)
+            y = self.cos_lat * math.sin(lat_radians) - self.sin_lat * math.cos(lat_radians) * math.cos(dlon)
+            return (math.degrees(math.atan2(x, y)) + 360) % 360
+        lat_radians = np.radians(lat)
+        dlon = np.radians(lon - self.lon)
+        x = np.sin(dlon) * np.cos(lat_radians)
+        y = self.cos_lat * np.sin(lat_radians) - self.sin_lat * np.cos(lat_radians) * np.cos(dlon)
+        return (np.degrees(np.arctan2(x, y)) + 360) % 360
+
+    # Project points onto the observer's local east/north/up tangent plane, in feet.
+    # Longitudes are measured the short way round, so points across the antimeridian
+    # land next to the observer rather than 360 degrees away.
+    def to_enu(self, lat, lon, alt):
+        return ((lon - self.lon + 180) % 360 - 180) * self.feet_per_degree_lon, (lat - self.lat) * FEET_PER_DEGREE, alt - self.alt
+
+# The precomputed Observer for a location, if it carries one, otherwise a new one
+def observer_for(location):
+    observer = getattr(location, 'observer', None)
+    if observer is None:
+        observer = Observer(location.lat, location.lon, location.alt)
+    return observer
@@ -0,0 +1,32 @@
+import os
+
+# gunicorn settings for serving wsgi:app, see wsgi.py
+bind = f"0.0.0.0:{os.getenv('PORT', '7878')}"
+workers = int(os.getenv('API_WORKERS', '4'))
+worker_class = 'gthread'
+threads = int(os.getenv('API_THREADS', '4'))
+# Load the app once before forking, so the tables and indexes are only created once
+preload_app = True
+# On SIGTERM, workers get this long to finish their requests and flush their locations
+graceful_timeout = 30
+accesslog = '-'
+
+def post_fork(server, worker):
+    from config import engine, API_METRICS_PORT
+    from location_buffer import location_buffer
+    from metrics import serve_metrics_on_free_port
+    # connections opened before the fork belong to the parent
+    engine.dispose(close=False)
+    location_buffer.start()
+    # each worker keeps its own metrics, so each is scraped on a port of its own rather
+    # than through the API port, where every scrape would land on whichever worker
+    if API_METRICS_PORT:
+        worker.metrics_server = serve_metrics_on_free_port(API_METRICS_PORT, workers)
+
+def worker_exit(server, worker):
+    from location_buffer import location_buffer
+    location_buffer.stop()
+    # free the worker's metrics port for the worker that replaces it
+    if getattr(worker, 'metrics_server', None):
+        worker.metrics_server.shutdown()
+        worker.metrics_server.server_close()
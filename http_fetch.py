@@ -0,0 +1,164 @@
+import math
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from aircraft_batch import iter_aircraft
+from config import logger
+from metrics import Counter, upstream_fetch_seconds
+
+ADSBFI_URL = "https://opendata.adsb.fi/api/v2"
+REQUEST_TIMEOUT = 15  # seconds
+# Responses are decoded as they arrive, this many bytes at a time
+DECODE_CHUNK_SIZE = 1 << 16
+# Responses are reused for this long; aircraft move about a mile in 10 seconds
+CACHE_TTL = 10  # seconds
+CACHE_MAX_ENTRIES = 256
+# Query centers are snapped to this grid (about 0.6nm) so nearby requests share a URL
+QUANTUM_DEG = 0.01
+# Backoff after a 429 without a Retry-After, doubled on each 429 in a row
+BACKOFF_BASE = 5.0  # seconds
+BACKOFF_MAX = 300.0
+
+# Raised instead of calling upstream while we're backing off after a 429
+class UpstreamBackoff(requests.exceptions.RequestException):
+    pass
+
+# Snap a query circle onto the grid, growing the radius to whole miles so the snapped
+# circle still covers the original one
+def quantize(lat, lon, radius_nm):
+    snapped_lat = round(round(lat / QUANTUM_DEG) * QUANTUM_DEG, 6)
+    snapped_lon = round(round(lon / QUANTUM_DEG) * QUANTUM_DEG, 6)
+    shift_nm = math.hypot((snapped_lat - lat) * 60, (snapped_lon - lon) * 60 * math.cos(math.radians(lat)))
+    return snapped_lat, snapped_lon, math.ceil(radius_nm + shift_nm * 1.01)
+
+# Copies of the records as they'd have come back seconds after they were fetched, so a
+# cached answer doesn't pass its positions off as fresher than they are
+def aged(aircraft, seconds):
+    return [dict(record, seen_pos=record.get('seen_pos', 0) + seconds) for record in aircraft]
+
+# Fetches aircraft from adsb.fi over a pooled keep-alive session.  Identical requests
+# within CACHE_TTL are answered from a cache, identical requests already in flight are
+# joined instead of repeated, and a 429 pauses all requests for a while.  Cached
+# answers have their seen_pos moved on by the time since they were fetched.
+class AircraftFetcher:
+    def __init__(self, base_url=ADSBFI_URL, cache_ttl=CACHE_TTL):
+        self.base_url = base_url
+        self.cache_ttl = cache_ttl
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        # key -> (fetched at, aircraft list)
+        self.cache = {}
+        # key -> (Event, [aircraft list or exception]) for requests in flight
+        self.in_flight = {}
+        self.backoff_until = 0.0
+        self.consecutive_429s = 0
+        self.counters = {"hits": 0, "misses": 0, "coalesced": 0, "errors": 0, "throttled": 0}
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    # Aircraft within (at least) radius_nm of the point.  The circle is snapped to the
+    # grid, so the result can include a little more than was asked for.
+    def fetch(self, lat, lon, radius_nm):
+        key = quantize(lat, lon, radius_nm)
+        now = time.monotonic()
+        with self.lock:
+            cached = self.cache.get(key)
+            if cached is not None and now - cached[0] <= self.cache_ttl:
+                self.counters['hits'] += 1
+            else:
+                cached = None
+                waiting = self.in_flight.get(key)
+                if waiting is not None:
+                    self.counters['coalesced'] += 1
+                else:
+                    if now < self.backoff_until:
+                        self.counters['throttled'] += 1
+                        raise UpstreamBackoff(f"Backing off for {self.backoff_until - now:.0f}s after a 429 from adsb.fi")
+                    self.counters['misses'] += 1
+                    self.in_flight[key] = (threading.Event(), [])
+
+        if cached is not None:
+            return aged(cached[1], now - cached[0])
+        if waiting is not None:
+            event, result = waiting
+            event.wait()
+            if isinstance(result[0], Exception):
+                raise result[0]
+            return result[0]
+
+        event, result = self.in_flight[key]
+        try:
+            aircraft = self.request(*key)
+            result.append(aircraft)
+            with self.lock:
+                self.cache[key] = (time.monotonic(), aircraft)
+                self.prune(time.monotonic())
+            return aircraft
+        except Exception as e:
+            result.append(e)
+            raise
+        finally:
+            with self.lock:
+                del self.in_flight[key]
+            event.set()
+
+    def request(self, lat, lon, radius_nm):
+        url = f"{self.base_url}/lat/{lat}/lon/{lon}/dist/{radius_nm}"
+        logger.debug(f"Fetching aircraft data with URL: {url}")
+        start = time.monotonic()
+        try:
+            with self.session.get(url, timeout=REQUEST_TIMEOUT, stream=True) as response:
+                if response.status_code == 429:
+                    self.throttle(response.headers.get('Retry-After'))
+                response.raise_for_status()
+                with self.lock:
+                    self.consecutive_429s = 0
+                return list(iter_aircraft(response.iter_content(DECODE_CHUNK_SIZE)))
+        except Exception:
+            with self.lock:
+                self.counters['errors'] += 1
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            upstream_fetch_seconds.observe(elapsed)
+            with self.lock:
+                self.latency_total += elapsed
+                self.latency_max = max(self.latency_max, elapsed)
+
+    def throttle(self, retry_after):
+        with self.lock:
+            self.consecutive_429s += 1
+            if retry_after is not None and retry_after.isdigit():
+                delay = float(retry_after)
+            else:
+                delay = min(BACKOFF_MAX, BACKOFF_BASE * 2 ** (self.consecutive_429s - 1)) * random.uniform(1, 1.25)
+            self.backoff_until = max(self.backoff_until, time.monotonic() + delay)
+        logger.warning(f"adsb.fi returned 429, backing off for {delay:.0f}s")
+
+    # Drop expired responses, and the oldest ones if there are still too many
+    def prune(self, now):
+        for key in [key for key, (fetched_at, _) in self.cache.items() if now - fetched_at > self.cache_ttl]:
+            del self.cache[key]
+        while len(self.cache) > CACHE_MAX_ENTRIES:
+            del self.cache[min(self.cache, key=lambda key: self.cache[key][0])]
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            requests_made = stats['misses']
+            stats['latency_avg'] = self.latency_total / requests_made if requests_made else 0.0
+            stats['latency_max'] = self.latency_max
+            stats['cache_entries'] = len(self.cache)
+        return stats
+
+aircraft_fetcher = AircraftFetcher()
+
+upstream_requests = Counter(
+    'airshow_upstream_requests_total', "Upstream aircraft queries by outcome", labels=('outcome',),
+    function=lambda: dict(aircraft_fetcher.counters)
+)
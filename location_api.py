@@ -1,10 +1,63 @@
-from models import User, LastLocation
+import threading
+import time
+from collections import OrderedDict
+from models import User
 from flask import request, jsonify
-from sqlalchemy.orm import sessionmaker
 from api import app
 from config import Session
 from datetime import datetime
+from location_buffer import location_buffer, location_updates
 
+# Emails nobody has signed up with are looked up again after this long
+UNKNOWN_EMAIL_TTL = 60  # seconds
+# /pub isn't authenticated, so anyone can make up emails; remember at most this many
+UNKNOWN_EMAIL_MAX_ENTRIES = 10000
+
+# Maps the email a device reports as to the user's id, so a location report needs no
+# query.  Users can't change their email, so known emails are kept for good.
+class UserIdCache:
+    def __init__(self, unknown_ttl=UNKNOWN_EMAIL_TTL, unknown_max_entries=UNKNOWN_EMAIL_MAX_ENTRIES):
+        self.unknown_ttl = unknown_ttl
+        self.unknown_max_entries = unknown_max_entries
+        self.user_ids = {}
+        # email -> when it was found not to belong to anyone, oldest first
+        self.unknown = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, email):
+        now = time.monotonic()
+        with self.lock:
+            user_id = self.user_ids.get(email)
+            if user_id is not None:
+                return user_id
+            checked_at = self.unknown.get(email)
+            if checked_at is not None and now - checked_at < self.unknown_ttl:
+                return None
+
+        with Session() as session:
+            user_id = session.query(User.id).filter_by(email=email).scalar()
+        with self.lock:
+            if user_id is None:
+                self.unknown[email] = now
+                self.unknown.move_to_end(email)
+                self.prune_unknown(now)
+            else:
+                self.user_ids[email] = user_id
+                self.unknown.pop(email, None)
+        return user_id
+
+    # Forget unknown emails that have expired, and the oldest ones beyond the cap
+    def prune_unknown(self, now):
+        while self.unknown:
+            email, checked_at = next(iter(self.unknown.items()))
+            if now - checked_at < self.unknown_ttl and len(self.unknown) <= self.unknown_max_entries:
+                break
+            del self.unknown[email]
+
+user_id_cache = UserIdCache()
+
+# OwnTracks location reports.  The position goes into the location buffer, which writes
+# it and triggers an evaluation within a second or so; the device isn't kept waiting.
 @app.route('/pub', methods=['POST'])
 def receive_location():
     user_email = request.headers.get('X-Limit-U')
@@ -17,25 +70,14 @@ def receive_location():
     lon = data['lon']
     alt = data['alt'] * 3.28084  # Convert meters to feet
 
-    with Session() as session:
-        # Map email to user ID and update location
-        user = session.query(User).filter_by(email=user_email).first()
-        if user:
-            location = session.query(LastLocation).filter_by(user_id=user.id).first()
-            if location:
-                location.lat = lat
-                location.lon = lon
-                location.alt = alt
-                location.reported_at = datetime.utcnow()
-            else:
-                new_location = LastLocation(user_id=user.id, lat=lat, lon=lon, alt=alt, reported_at=datetime.utcnow())
-                session.add(new_location)
-
-            session.commit()
-
-        # when you publish your location, the server is supposed to return an array with
-        # the location of all of your friends.  We don't have any friends, so always
-        # return an empty array
-        return jsonify([])
-
+    # Map email to user ID and buffer the location
+    user_id = user_id_cache.get(user_email)
+    if user_id is not None:
+        location_buffer.put(user_id, lat, lon, alt, datetime.utcnow())
+    else:
+        location_updates.inc('unknown_user')
 
+    # when you publish your location, the server is supposed to return an array with
+    # the location of all of your friends.  We don't have any friends, so always
+    # return an empty array
+    return jsonify([])
@@ -0,0 +1,121 @@
+import threading
+from sqlalchemy import insert, update
+from models import LastLocation
+from config import Session, logger
+from events import evaluation_queue
+from metrics import Counter, Gauge, Histogram
+
+# How often buffered locations are written to the database
+FLUSH_INTERVAL = 1.0  # seconds
+# Rows per upsert statement, to stay well inside the databases' bound parameter limits
+UPSERT_CHUNK = 1000
+
+location_updates = Counter('airshow_location_updates_total', "Location reports received on /pub, by what happened to them", labels=('outcome',))
+location_flush_seconds = Histogram('airshow_location_flush_seconds', "Time to write one batch of buffered locations")
+
+# The latest reported position of each user, waiting to be written.  A device that
+# reports again before the next flush just replaces its earlier position, and each flush
+# writes every waiting user with one bulk upsert, then asks for them to be evaluated.
+class LocationBuffer:
+    def __init__(self, flush_interval=FLUSH_INTERVAL):
+        self.flush_interval = flush_interval
+        # user_id -> the row to write: user_id, lat, lon, alt, reported_at
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+
+    def put(self, user_id, lat, lon, alt, reported_at):
+        with self.lock:
+            replaced = user_id in self.pending
+            self.pending[user_id] = {"user_id": user_id, "lat": lat, "lon": lon, "alt": alt, "reported_at": reported_at}
+        location_updates.inc('coalesced' if replaced else 'buffered')
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.run, name="location-buffer", daemon=True)
+        self.thread.start()
+
+    # Stop flushing, after writing whatever is still waiting
+    def stop(self, timeout=None):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join(timeout)
+        self.thread = None
+
+    def run(self):
+        while not self.stopping.wait(self.flush_interval):
+            self.flush_safely()
+        self.flush_safely()
+
+    def flush_safely(self):
+        session = Session()
+        try:
+            self.flush(session)
+        except Exception as e:
+            session.rollback()
+            logger.error(f"Error writing buffered locations, error was {e}")
+        finally:
+            Session.remove()
+
+    # Write every waiting position.  Returns how many were written.
+    def flush(self, session):
+        with self.lock:
+            rows = list(self.pending.values())
+            self.pending = {}
+        if not rows:
+            return 0
+
+        with location_flush_seconds.time():
+            try:
+                for i in range(0, len(rows), UPSERT_CHUNK):
+                    upsert_locations(session, rows[i:i + UPSERT_CHUNK])
+                session.commit()
+            except Exception:
+                # put them back, unless a newer position came in meanwhile
+                with self.lock:
+                    for row in rows:
+                        self.pending.setdefault(row['user_id'], row)
+                raise
+        location_updates.inc('written', amount=len(rows))
+
+        # evaluate these users right away rather than waiting for the next tick
+        for row in rows:
+            evaluation_queue.request(row['user_id'])
+        return len(rows)
+
+    def __len__(self):
+        return len(self.pending)
+
+# Insert or update the LastLocation of every row, keyed on the unique user_id
+def upsert_locations(session, rows):
+    dialect = session.get_bind().dialect.name
+    if dialect in ('postgresql', 'sqlite'):
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert as dialect_insert
+        else:
+            from sqlalchemy.dialects.sqlite import insert as dialect_insert
+        statement = dialect_insert(LastLocation).values(rows)
+        statement = statement.on_conflict_do_update(
+            index_elements=[LastLocation.user_id],
+            set_={column: statement.excluded[column] for column in ('lat', 'lon', 'alt', 'reported_at')}
+        )
+        session.execute(statement)
+        return
+
+    # elsewhere, one query for which users already have a row, then a bulk update and a bulk insert
+    existing = dict(session.query(LastLocation.user_id, LastLocation.id)
+                    .filter(LastLocation.user_id.in_([row['user_id'] for row in rows])))
+    updates = [{**row, "id": existing[row['user_id']]} for row in rows if row['user_id'] in existing]
+    inserts = [row for row in rows if row['user_id'] not in existing]
+    if updates:
+        session.execute(update(LastLocation), updates)
+    if inserts:
+        session.execute(insert(LastLocation), inserts)
+
+location_buffer = LocationBuffer()
+
+location_buffer_depth = Gauge('airshow_location_buffer_depth', "Users with a reported location waiting to be written",
+                              function=lambda: len(location_buffer))
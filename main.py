@@ -1,50 +1,352 @@
+import argparse
+import signal
 import time
-from flask import Flask
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 from api import app  # Import the Flask app from api.py
-from db import update_users_from_db, get_location_for_user, update_user_location
-from aircraft import get_aircraft_data, process_aircraft_for_user, get_max_distance_from_filters, get_filters_for_user
+from aircraft import get_query_distance, process_aircraft_for_user, PREDICT_MINUTES
+from schedule import evaluation_schedule, choose_interval, MIN_INTERVAL
+from tick_state import load_tick_state
+from fetch_planner import Region, plan_regions, fan_out
+from aircraft_batch import aircraft_batch_from_json, compute_approaches
 from closest_approach import bearing_to_compass
-from config import Session, logger, UPDATE_RATE
-from models import User, Notification, Filter, Condition
+from config import Session, ReadSession, logger, UPDATE_RATE, MONITOR_WORKERS, AIRCRAFT_SOURCE, PROFILE_EVERY_TICKS, METRICS_PORT
+from sources import create_source
+from models import User, Notification, Filter, Condition, LastLocation
+from notifier import Notifier
+from dedupe import notification_dedupe
+from track_store import track_store
+from events import evaluation_queue, snapshot_cache
+from http_fetch import aircraft_fetcher
+from sharding import ShardCoordinator
+from retention import run_retention_loop
+from location_buffer import location_buffer
+import metrics
+from threading import Event, Thread
+from sqlalchemy import insert
 import requests
 import location_api
 from datetime import datetime, timedelta
 from werkzeug.security import generate_password_hash
 
-def should_send_notification(session, user, aircraft_hex):
-    fifteen_minutes_ago = datetime.utcnow() - timedelta(minutes=15)
-
-    recent_notifications = session.query(Notification).filter(
-        Notification.user_id == user.id,
-        Notification.aircraft_hex == aircraft_hex,
-        Notification.timestamp >= fifteen_minutes_ago
-    ).count()
-
-    return recent_notifications == 0
-
-def send_notification(session, user, aircraft_hex, filter_name, notification_text):
-    # Insert the notification into the database
-    new_notification = Notification(
-        user_id=user.id,
-        timestamp=datetime.utcnow(),
-        aircraft_hex=aircraft_hex,
-        notification_text=notification_text,
-        filter_name=filter_name
-    )
-    session.add(new_notification)
+# How often the location watcher looks for new location reports
+LOCATION_WATCH_SECONDS = 2.0
+# Reports are written by the API's location buffer a little after they're received, so
+# the watcher looks back this far past the newest report it has seen
+LOCATION_WATCH_LAG = timedelta(seconds=10)
+# How long shutdown waits for queued notifications to go out
+SHUTDOWN_TIMEOUT = 10  # seconds
+
+# Set on SIGTERM; the monitor loop finishes its tick and shuts down
+stopping = Event()
+
+def should_send_notification(user, aircraft_hex):
+    return notification_dedupe.claim(user.id, aircraft_hex)
+
+# Record notifications with one bulk insert, then hand them to the notifier for delivery.
+# pending is a list of rows from notify_user().  With owns_user, notifications for users
+# this worker no longer holds the shard of are dropped; their new owner will send them.
+def send_notifications(session, notifier, pending, owns_user=None):
+    if owns_user is not None:
+        kept = [row for row in pending if owns_user(row['user_id'])]
+        if len(kept) < len(pending):
+            logger.warning(f"Dropping {len(pending) - len(kept)} notifications for users on shards this worker no longer holds")
+        pending = kept
+    if not pending:
+        return
+
+    # Insert the notifications into the database
+    session.execute(insert(Notification), [
+        {key: value for key, value in row.items() if key != 'topic'} for row in pending
+    ])
     session.commit()
 
-    headers = {"Title": filter_name}
+    for row in pending:
+        notifier.enqueue(row['topic'], row['filter_name'], row['notification_text'])
+
+# Work out which of a user's alerts should be sent, returning a notification row for each
+def notify_user(user, notifications):
+    if not user.topic:
+        logger.debug(f"Not sending notifications for user {user.email} because they have no topic set")
+        return []
+
+    pending = []
+    for notification in notifications:
+        if should_send_notification(user, notification['hex']):
+            compass_direction = bearing_to_compass(notification['bearing'])
+            message = f"Aircraft {notification['description']} is approaching: " \
+                      f"{notification['distance']:.2f} miles away, " \
+                      f"{notification['time_to_closest']:.0f} seconds to closest approach, " \
+                      f"bearing {compass_direction}."
+            pending.append({
+                "user_id": user.id,
+                "topic": user.topic,
+                "timestamp": datetime.utcnow(),
+                "aircraft_hex": notification['hex'],
+                "notification_text": message,
+                "filter_name": notification['filter_name']
+            })
+    return pending
+
+# Per-tick counts of what happened to each user, and of the work done for them
+class TickStats:
+    def __init__(self):
+        self.processed = 0
+        self.skipped = 0
+        self.late = 0
+        self.not_due = 0
+        self.regions = 0
+        self.aircraft = 0
+        self.notifications = 0
+
+    # One key=value line per tick, easy to grep and to parse
+    def summary(self, elapsed, queued):
+        return f"tick elapsed={elapsed:.2f}s processed={self.processed} skipped={self.skipped} late={self.late} " \
+               f"not_due={self.not_due} regions={self.regions} aircraft_checked={self.aircraft} " \
+               f"notifications={self.notifications} queued={queued}"
+
+    # A tick overruns when it leaves users late, or takes longer than the gap between ticks
+    def record_metrics(self, elapsed):
+        metrics.tick_seconds.observe(elapsed)
+        for outcome in ('processed', 'skipped', 'late', 'not_due'):
+            metrics.users.inc(outcome, amount=getattr(self, outcome))
+        if self.late or elapsed > MIN_INTERVAL:
+            metrics.tick_overruns.inc()
+
+def fetch_region(source, region):
+    region_aircraft = source.fetch(region.lat, region.lon, region.radius_nm)
+    batch, dropped = aircraft_batch_from_json(region_aircraft)
+    changed = track_store.update(batch)
+    logger.debug(f"{region}: {len(batch)} airborne aircraft, {changed.sum()} with new positions, dropped {dropped}")
+    return batch
+
+# Runs on a worker thread.  Returns the user's pending notification rows.
+# fetched_at is the monotonic time batch was fetched, when it comes from an earlier snapshot.
+def evaluate_user(user, location, filters, max_filter_distance, batch, fetched_at=None):
+    # decide when to look at this user next first, since that decides how far out we alert
+    with metrics.cpa_seconds.time():
+        approaches = compute_approaches(batch, location.lat, location.lon, location.alt, PREDICT_MINUTES, location.observer)
+    interval = choose_interval(approaches, max_filter_distance, location.reported_at)
+    evaluation_schedule.set_next(user.id, interval, start=fetched_at)
+
+    notifications = process_aircraft_for_user(user, location, batch, filters, max_filter_distance,
+                                              approaches=approaches, next_interval=interval)
+    return notify_user(user, notifications)
+
+# Done callback for user evaluations whose results aren't collected by a tick
+def send_notifications_when_done(future, notifier, owns_user=None):
+    if future.cancelled() or future.exception() is not None:
+        return
+    session = Session()
+    try:
+        send_notifications(session, notifier, future.result(), owns_user)
+    finally:
+        Session.remove()
+
+# shards, if given, is this worker's ShardCoordinator, and only users on the shards it
+# holds are evaluated
+def run_tick(session, executor, source, notifier, in_flight, deadline, shards=None):
+    stats = TickStats()
+    notification_dedupe.evict()
+    track_store.evict()
+
+    owns_user = None
+    if shards is not None:
+        if shards.refresh(session):
+            # the previous owner may have notified these users recently
+            notification_dedupe.warm(session)
+        owns_user = shards.owns_user
+
+    # Load the users worth evaluating, with their locations and compiled filters
+    read_session = ReadSession()
+    try:
+        users = load_tick_state(read_session, owns_user=owns_user)
+    finally:
+        ReadSession.remove()
+    evaluation_schedule.retain({user.id for user in users})
+
+    # Work out what each user needs before fetching anything, so users
+    # whose query circles overlap can share one upstream request
+    work = []
+    now = time.monotonic()
+    for user in users:
+        if not evaluation_schedule.is_due(user.id, now):
+            stats.not_due += 1
+            continue
+
+        if user.id in in_flight:
+            logger.warning(f"User {user.email} is still being processed from the previous tick, skipping")
+            stats.skipped += 1
+            continue
 
-    # Send the notification using ntfy.sh
-    ntfy_url = f"https://ntfy.sh/{user.topic}"
-    response = requests.post(ntfy_url, data=notification_text.encode('utf-8'), headers=headers)
-    if response.status_code == 200:
-        logger.info(f"Sent notification to {user.topic}")
+        max_filter_distance = user.filters.max_distance
+        if max_filter_distance is None:
+            logger.warning(f"Filters for user {user.email} did not include a distance, skipping this user")
+            stats.skipped += 1
+            continue
+
+        work.append((user, user.location, user.filters, max_filter_distance))
+
+    circles = [(index, location.lat, location.lon, get_query_distance(max_filter_distance))
+               for index, (user, location, filters, max_filter_distance) in enumerate(work)]
+    regions = plan_regions(circles)
+    stats.regions = len(regions)
+    logger.debug(f"Planned {len(regions)} regional fetches for {len(work)} users")
+
+    # Fetch every region concurrently, and hand each user their share of a
+    # region's snapshot as soon as it arrives
+    region_futures = {executor.submit(fetch_region, source, region): region for region in regions}
+    user_futures = {}
+    try:
+        for future in as_completed(region_futures, timeout=max(0, deadline - time.monotonic())):
+            region = region_futures[future]
+            try:
+                batch = future.result()
+                snapshot_cache.store(region, batch)
+            except requests.exceptions.RequestException as e:
+                logger.error(f"Network error getting aircraft list for {region}, error was {e}, skipping")
+                stats.skipped += len(region.members)
+                continue
+            except Exception as e:
+                logger.error(f"Error getting aircraft list for {region}, error was {e}, skipping")
+                stats.skipped += len(region.members)
+                continue
+
+            for index, user_batch in fan_out(region, batch).items():
+                user, location, filters, max_filter_distance = work[index]
+                in_flight.add(user.id)
+                user_future = executor.submit(evaluate_user, user, location, filters, max_filter_distance, user_batch)
+                user_future.add_done_callback(lambda f, user_id=user.id: in_flight.discard(user_id))
+                user_futures[user_future] = user
+                stats.aircraft += len(user_batch)
+    except FuturesTimeoutError:
+        for future, region in region_futures.items():
+            if not future.done():
+                future.cancel()
+                logger.warning(f"Fetching {region} did not finish before the tick deadline")
+                stats.late += len(region.members)
+
+    pending = []
+    done, not_done = wait(user_futures, timeout=max(0, deadline - time.monotonic()))
+    for future in done:
+        if future.exception() is not None:
+            logger.error(f"Error processing user {user_futures[future].email}, error was {future.exception()}")
+            stats.skipped += 1
+        else:
+            pending.extend(future.result())
+            stats.processed += 1
+    for future in not_done:
+        # users already running finish in the background and are skipped next tick
+        if not future.cancel():
+            future.add_done_callback(lambda f: send_notifications_when_done(f, notifier, owns_user))
+        logger.warning(f"Processing user {user_futures[future].email} did not finish before the tick deadline")
+        stats.late += 1
+
+    stats.notifications = len(pending)
+    send_notifications(session, notifier, pending, owns_user)
+    source.tick()
+
+    return stats
+
+# One tick in a session of its own, so nothing loaded during a tick stays in the
+# session's identity map or goes stale waiting for the next one
+def run_tick_in_session(executor, source, notifier, in_flight, deadline, shards=None):
+    session = Session()
+    try:
+        return run_tick(session, executor, source, notifier, in_flight, deadline, shards)
+    finally:
+        Session.remove()
+
+# Runs on a worker thread for a user who just reported a location.  snapshot is what
+# snapshot_cache.find() returned for them; without one (they've moved out of every
+# recent region, or there's been no tick for a while) their own query circle is
+# fetched from the source, which for adsb.fi answers from its cache when it can.
+# Returns the user's pending notification rows.
+def evaluate_after_report(source, user, snapshot):
+    location = user.location
+    if snapshot is None:
+        radius_nm = get_query_distance(user.filters.max_distance)
+        region = Region(location.lat, location.lon, radius_nm)
+        region.members.append((None, location.lat, location.lon, radius_nm))
+        try:
+            user_batch = fetch_region(source, region)
+        except Exception as e:
+            logger.error(f"Error getting aircraft list for user {user.email} after a location update, error was {e}, "
+                         f"leaving them for the next tick")
+            return []
+        snapshot_cache.store(region, user_batch)
+        fetched_at = None
     else:
-        logger.error(f"Failed to send notification to {user.topic}: {response.status_code}")
+        region, batch, fetched_at = snapshot
+        # fly the aircraft forward from when their positions were received to now, so
+        # closest approaches and the alert cutoff are measured from the present
+        user_batch = fan_out(region, batch)[None]
+        user_batch = user_batch.advanced(time.monotonic() - fetched_at + user_batch.seen_pos)
+    return evaluate_user(user, location, user.filters, user.filters.max_distance, user_batch, fetched_at)
 
-def main():
+# Evaluate users as soon as they report a new location, against the latest cached
+# snapshot covering them or else a fetch of their own.  Every reported user is made
+# due, so the regular tick picks up anyone this misses.
+def run_event_loop(executor, source, notifier, in_flight, shards=None):
+    owns_user = shards.owns_user if shards is not None else None
+    while True:
+        user_ids = evaluation_queue.take()
+        for user_id in user_ids:
+            evaluation_schedule.make_due(user_id)
+        session = ReadSession()
+        try:
+            users = load_tick_state(session, user_ids, owns_user=owns_user)
+        except Exception as e:
+            logger.error(f"Error loading users {user_ids} for evaluation, error was {e}")
+            continue
+        finally:
+            ReadSession.remove()
+
+        for user in users:
+            if user.id in in_flight or user.filters.max_distance is None:
+                continue
+
+            snapshot = snapshot_cache.find(user.location.lat, user.location.lon, get_query_distance(user.filters.max_distance))
+            if snapshot is None:
+                logger.debug(f"No recent snapshot covers user {user.email}, fetching their query circle")
+            logger.debug(f"Evaluating user {user.email} after a location update")
+            in_flight.add(user.id)
+            future = executor.submit(evaluate_after_report, source, user, snapshot)
+            future.add_done_callback(lambda f, user_id=user.id: in_flight.discard(user_id))
+            future.add_done_callback(lambda f: send_notifications_when_done(f, notifier, owns_user))
+
+# When the API runs in processes of its own, location reports reach this process through
+# the database rather than the evaluation queue, so poll for new ones and queue those users
+def run_location_watcher():
+    since = datetime.utcnow()
+    # user_id -> reported_at of the last report queued
+    seen = {}
+    while not stopping.wait(LOCATION_WATCH_SECONDS):
+        session = ReadSession()
+        try:
+            rows = session.query(LastLocation.user_id, LastLocation.reported_at) \
+                .filter(LastLocation.reported_at > since - LOCATION_WATCH_LAG).all()
+        except Exception as e:
+            logger.error(f"Error checking for location reports, error was {e}")
+            continue
+        finally:
+            ReadSession.remove()
+
+        for user_id, reported_at in rows:
+            if seen.get(user_id) != reported_at:
+                seen[user_id] = reported_at
+                evaluation_queue.request(user_id)
+            since = max(since, reported_at)
+        cutoff = since - LOCATION_WATCH_LAG
+        seen = {user_id: reported_at for user_id, reported_at in seen.items() if reported_at > cutoff}
+
+def request_stop(signum, frame):
+    logger.info("Received SIGTERM, shutting down after this tick")
+    stopping.set()
+
+# standalone is for when the API isn't in this process: it starts the location watcher
+def main(standalone=False):
+    signal.signal(signal.SIGTERM, request_stop)
     with Session() as session:
         if not session.query(User).filter_by(email="foo@bar.com").first():
             # Create the user
@@ -82,53 +384,64 @@ def main():
 
             # Commit the transaction
             session.commit()
-        while True:
-            # Update users from the database
-            users = update_users_from_db(session)
-
-            # Fetch and process aircraft data for each user
-            for user in users:
-                location = get_location_for_user(session, user)
-                if not location:
-                    logger.debug(f"No location on file for user {user.email}, skipping")
-                    continue
-
-                filters = get_filters_for_user(session, user)
-                max_filter_distance = get_max_distance_from_filters(filters)
-                if max_filter_distance is None:
-                    logger.warning(f"Filters for user {user.email} did not include a distance, skipping this user")
-                    continue
+        warmed = notification_dedupe.warm(session)
+        logger.info(f"Loaded {warmed} recent notifications into the dedupe cache")
 
+    # Users still being evaluated by a worker; they're skipped until that finishes
+    in_flight = set()
+    source = create_source(AIRCRAFT_SOURCE)
+    logger.info(f"Reading aircraft from {source}")
+    notifier = Notifier()
+    notifier.start()
+    location_buffer.start()
+    metrics.notification_queue_depth.function = notifier.depth
+    profiler = metrics.TickProfiler(PROFILE_EVERY_TICKS)
+    shards = ShardCoordinator()
+    with ThreadPoolExecutor(max_workers=MONITOR_WORKERS, thread_name_prefix="monitor") as executor:
+        Thread(target=run_event_loop, args=(executor, source, notifier, in_flight, shards), name="event-loop", daemon=True).start()
+        Thread(target=run_retention_loop, args=(shards,), name="retention", daemon=True).start()
+        if standalone:
+            Thread(target=run_location_watcher, name="location-watcher", daemon=True).start()
+        if METRICS_PORT:
+            metrics.serve_metrics(METRICS_PORT)
+        try:
+            while not stopping.is_set():
+                tick_start = time.monotonic()
+                profiler.start()
                 try:
-                    aircraft_list = get_aircraft_data(user, location, max_filter_distance)
-                except requests.exceptions.RequestException as e:
-                    logger.error(f"Network error getting aircraft list for user {user.email}, error was {e}, skipping")
-                    continue
-                except Exception as e:
-                    logger.error(f"Error getting aircraft list for user {user.email}, error was {e}, skipping")
-                    continue
-                notifications = process_aircraft_for_user(session, user, location, aircraft_list, filters, max_filter_distance)
-
-                if user.topic:
-                    for notification in notifications:
-                        if should_send_notification(session, user, notification['hex']):
-                            compass_direction = bearing_to_compass(notification['bearing'])
-                            message = f"Aircraft {notification['description']} is approaching: " \
-                                      f"{notification['distance']:.2f} miles away, " \
-                                      f"{notification['time_to_closest']:.0f} seconds to closest approach, " \
-                                      f"bearing {compass_direction}."
-                            send_notification(session, user, notification['hex'], notification['filter_name'], message)
-                else:
-                    logger.debug(f"Not sending notifications for user {user.email} because they have no topic set")
-
-            # Sleep for a while before the next loop iteration
-            time.sleep(UPDATE_RATE)  # Adjust the sleep time as needed
+                    stats = run_tick_in_session(executor, source, notifier, in_flight, tick_start + UPDATE_RATE, shards)
+                finally:
+                    profiler.stop()
+                elapsed = time.monotonic() - tick_start
+                stats.record_metrics(elapsed)
+                logger.info(stats.summary(elapsed, notifier.depth()))
+                logger.debug(f"Upstream fetches: {aircraft_fetcher.stats()}")
+
+                # Sleep until it's time to look for due users again
+                stopping.wait(max(0, MIN_INTERVAL - elapsed))
+        finally:
+            session = Session()
+            try:
+                shards.release_all(session)
+            finally:
+                Session.remove()
+    # the executor has finished the evaluations still running, so all that's left is
+    # writing buffered locations and delivering what's queued
+    location_buffer.stop()
+    notifier.stop(timeout=SHUTDOWN_TIMEOUT)
+    logger.info(f"Shut down with {notifier.depth()} notifications undelivered")
 
 if __name__ == '__main__':
-    # Start Flask server in a separate thread
-    from threading import Thread
-    flask_thread = Thread(target=app.run, kwargs={'host': '0.0.0.0', 'port': 7878})
-    flask_thread.start()
+    parser = argparse.ArgumentParser(description="Airshow monitor loop and API")
+    parser.add_argument('--worker', action='store_true',
+                        help="only run the monitor loop, with the API served separately (see wsgi.py), "
+                             "or as an extra worker sharing the users' shards")
+    args = parser.parse_args()
+
+    if not args.worker:
+        # Start Flask's development server in a separate thread
+        flask_thread = Thread(target=app.run, kwargs={'host': '0.0.0.0', 'port': 7878}, daemon=True)
+        flask_thread.start()
 
     # Start the main monitoring loop
-    main()
+    main(standalone=args.worker)
@@ -0,0 +1,259 @@
+import bisect
+import collections
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Counters, gauges and histograms for the monitor loop, rendered in the Prometheus text
+# format at /metrics.  Recording a value is a lock and a few additions, cheap enough to
+# leave on everywhere.  Metrics may have labels; values are recorded with the label
+# values in the order the labels were declared, e.g. users.inc('processed').
+
+# Upper bounds, in seconds, of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PROFILE_SAMPLE_SECONDS = 0.005
+PROFILE_TOP = 15
+
+logger = logging.getLogger("airshow")
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def render(self):
+        return ''.join(metric.render() for metric in list(self.metrics.values()))
+
+registry = Registry()
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{escape_label(value)}"' for name, value in pairs) + '}'
+
+def format_value(value):
+    return repr(float(value)) if value != float('inf') else '+Inf'
+
+# A counter or gauge.  function, if given, is called at render time for the current
+# value, or a dict of label values to values.
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=(), function=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def current(self):
+        if self.function is None:
+            with self.lock:
+                return dict(self.values)
+        values = self.function()
+        if not isinstance(values, dict):
+            return {(): values}
+        return {key if isinstance(key, tuple) else (key,): value for key, value in values.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, value in sorted(self.current().items()):
+            lines.append(f"{self.name}{format_labels(self.labels, label_values)} {format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def set(self, value, *label_values):
+        with self.lock:
+            self.values[label_values] = value
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # label values -> [count per bucket (the last is +Inf), sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+        registry.register(self)
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            state = self.values.get(label_values)
+            if state is None:
+                state = self.values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    # with histogram.time(): ... records how long the block took
+    @contextmanager
+    def time(self, *label_values):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            values = {key: (list(counts), total, count) for key, (counts, total, count) in self.values.items()}
+        for label_values, (counts, total, count) in sorted(values.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(self.labels, label_values, [('le', format_value(bound))])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labels, label_values)} {format_value(total)}")
+            lines.append(f"{self.name}_count{format_labels(self.labels, label_values)} {count}")
+        return '\n'.join(lines) + '\n'
+
+upstream_fetch_seconds = Histogram('airshow_upstream_fetch_seconds', "Time for an upstream aircraft query, including decoding")
+cpa_seconds = Histogram('airshow_cpa_seconds', "Time to predict paths and closest approaches for one user's aircraft")
+filter_evaluation_seconds = Histogram('airshow_filter_evaluation_seconds', "Time to match one user's candidate aircraft against their filters")
+db_query_seconds = Histogram('airshow_db_query_seconds', "Database statement time", labels=('operation',))
+notification_delivery_seconds = Histogram('airshow_notification_delivery_seconds', "Time to publish one notification to ntfy")
+notifications = Counter('airshow_notifications_total', "Notification deliveries by outcome", labels=('outcome',))
+notification_queue_depth = Gauge('airshow_notification_queue_depth', "Notifications waiting to be delivered, including retries")
+tick_seconds = Histogram('airshow_tick_seconds', "Monitor loop tick duration")
+tick_overruns = Counter('airshow_tick_overruns_total', "Ticks that left users late, or ran past the time the next tick was due")
+users = Counter('airshow_users_total', "Users looked at by the monitor loop, by what happened to them", labels=('outcome',))
+
+# Time every statement run on the engine, labelled by its first keyword (SELECT, INSERT, ...).
+# The start time goes on the statement's execution context, so a statement that raises
+# leaves nothing behind on the pooled connection.
+def instrument_engine(engine):
+    from sqlalchemy import event
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        if context is not None:
+            context.airshow_query_start = time.perf_counter()
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+        start = getattr(context, 'airshow_query_start', None)
+        if start is None:
+            return
+        operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'UNKNOWN'
+        db_query_seconds.observe(time.perf_counter() - start, operation)
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = registry.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+# Serve /metrics from a background thread, for processes that don't run the API
+def serve_metrics(port):
+    server = ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    return server
+
+# Serve /metrics on the first free port of count ports from first_port, for processes
+# that run side by side, like gunicorn's workers, so each is scraped on a port of its
+# own.  Returns the server, or None if every port is taken.
+def serve_metrics_on_free_port(first_port, count):
+    for port in range(first_port, first_port + count):
+        try:
+            server = serve_metrics(port)
+        except OSError:
+            continue
+        logger.info(f"Serving /metrics on port {port}")
+        return server
+    logger.warning(f"No free port for /metrics between {first_port} and {first_port + count - 1}")
+    return None
+
+# A sampling profiler for the monitor loop.  Every every_ticks ticks it samples
+# the stacks of the monitor thread and its workers (threads whose name starts with one
+# of thread_prefixes) while the tick runs, then logs the functions of ours that were
+# most often on top of the stack, and on the stack at all.
+class TickProfiler:
+    def __init__(self, every_ticks, thread_prefixes=('MainThread', 'monitor'),
+                 sample_seconds=PROFILE_SAMPLE_SECONDS, top=PROFILE_TOP):
+        self.every_ticks = every_ticks
+        self.thread_prefixes = thread_prefixes
+        self.sample_seconds = sample_seconds
+        self.top = top
+        self.package_dir = os.path.dirname(os.path.abspath(__file__))
+        self.ticks = 0
+        self.thread = None
+        self.stopping = threading.Event()
+        self.own = collections.Counter()
+        self.cumulative = collections.Counter()
+        self.samples = 0
+
+    def start(self):
+        self.ticks += 1
+        if not self.every_ticks or self.ticks % self.every_ticks:
+            return
+        self.own.clear()
+        self.cumulative.clear()
+        self.samples = 0
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self.run, name="tick-profiler", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopping.wait(self.sample_seconds):
+            self.sample()
+
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if not names.get(ident, '').startswith(self.thread_prefixes):
+                continue
+            ours = []
+            while frame is not None:
+                if frame.f_code.co_filename.startswith(self.package_dir):
+                    ours.append((frame.f_code.co_name, os.path.basename(frame.f_code.co_filename), frame.f_lineno))
+                frame = frame.f_back
+            if ours:
+                self.samples += 1
+                name, filename, line = ours[0]
+                self.own[f"{name} ({filename}:{line})"] += 1
+                for function in set(f"{name} ({filename})" for name, filename, line in ours):
+                    self.cumulative[function] += 1
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stopping.set()
+        self.thread.join()
+        self.thread = None
+        if not self.samples:
+            return
+        lines = [f"Profile of tick {self.ticks}, {self.samples} samples.  Most often running:"]
+        lines += [f"  {count / self.samples:6.1%} {location}" for location, count in self.own.most_common(self.top)]
+        lines.append("On the stack:")
+        lines += [f"  {count / self.samples:6.1%} {function}" for function, count in self.cumulative.most_common(self.top)]
+        logger.info('\n'.join(lines))
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Float, Text, DateTime, ForeignKey, JSON
+from sqlalchemy import Column, Integer, String, Float, Text, Date, DateTime, ForeignKey, JSON, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -28,6 +28,13 @@ class LastLocation(Base):
     reported_at = Column(DateTime, nullable=False, default=datetime.utcnow)
     user = relationship("User", back_populates="location")
 
+    __table_args__ = (
+        # one location per user, which location updates upsert on
+        Index('ix_last_locations_user_id', 'user_id', unique=True),
+        # recent reports, for the monitor's location watcher and each tick's user list
+        Index('ix_last_locations_reported_at', 'reported_at'),
+    )
+
 class Notification(Base):
     __tablename__ = 'notifications'
 
@@ -40,6 +47,25 @@ class Notification(Base):
 
     user = relationship('User', back_populates='notifications')
 
+    __table_args__ = (
+        # recent notifications for a user/aircraft, used to warm the dedupe cache
+        Index('ix_notifications_user_hex_timestamp', 'user_id', 'aircraft_hex', 'timestamp'),
+        # a user's notification history, newest first, paged by (timestamp, id)
+        Index('ix_notifications_user_timestamp_id', 'user_id', 'timestamp', 'id'),
+        # everything older or newer than a time, for expiring old notifications in
+        # timestamp order and warming the dedupe cache
+        Index('ix_notifications_timestamp', 'timestamp'),
+    )
+
+# How many notifications each user got per day and filter, for notifications older than
+# the retention period.  retention.py adds them up here before deleting them.
+class NotificationRollup(Base):
+    __tablename__ = 'notification_rollups'
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    day = Column(Date, primary_key=True)
+    filter_name = Column(String, primary_key=True)
+    count = Column(Integer, nullable=False)
+
 class Filter(Base):
     __tablename__ = 'filters'
     id = Column(Integer, primary_key=True)
@@ -61,3 +87,17 @@ class Condition(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     filter = relationship("Filter", back_populates="conditions")
+
+# Monitor loop processes that are alive, so each knows how many shards are its fair share
+class MonitorWorker(Base):
+    __tablename__ = 'monitor_workers'
+    id = Column(String, primary_key=True)
+    heartbeat_at = Column(DateTime, nullable=False)
+
+# Which monitor worker evaluates the users of each shard, until when.  A shard whose
+# lease has expired, or that has no owner, may be claimed by any worker.
+class ShardLease(Base):
+    __tablename__ = 'shard_leases'
+    shard = Column(Integer, primary_key=True)
+    owner = Column(String, nullable=True)
+    expires_at = Column(DateTime, nullable=True)
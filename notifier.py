@@ -0,0 +1,159 @@
+import itertools
+import queue
+import random
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from config import logger, NTFY_URL
+from metrics import notifications, notification_delivery_seconds
+
+NOTIFY_WORKERS = 4
+REQUEST_TIMEOUT = 10  # seconds
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 1.0  # seconds, doubled on every retry
+# ntfy.sh lets a client burst a handful of messages and then refills slowly, so each
+# topic gets a small token bucket of its own
+TOPIC_BURST = 5
+TOPIC_REFILL_SECONDS = 5.0
+
+# How long to wait between checks when the next queued message isn't due yet
+IDLE_POLL = 0.5
+
+# A single message to deliver to a ntfy topic
+class Delivery:
+    def __init__(self, topic, title, text):
+        self.topic = topic
+        self.title = title
+        self.text = text
+        self.attempts = 0
+
+# Token bucket rate limiter, one bucket per topic
+class TopicRateLimiter:
+    def __init__(self, burst=TOPIC_BURST, refill_seconds=TOPIC_REFILL_SECONDS):
+        self.burst = burst
+        self.refill_seconds = refill_seconds
+        self.buckets = {}
+        self.lock = threading.Lock()
+
+    # Take a token for the topic if one is available.  Returns 0 if the message may go
+    # out now, otherwise how many seconds until the next token.
+    def acquire(self, topic):
+        now = time.monotonic()
+        with self.lock:
+            tokens, updated = self.buckets.get(topic, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) / self.refill_seconds)
+            if tokens >= 1:
+                self.buckets[topic] = (tokens - 1, now)
+                return 0
+            self.buckets[topic] = (tokens, now)
+            return (1 - tokens) * self.refill_seconds
+
+# Delivers notifications to ntfy in the background so the detection loop never waits on
+# it.  Messages are queued by due time, sent over a pooled keep-alive session by a small
+# pool of workers, and retried with exponential backoff on network errors, 429s and 5xx.
+class Notifier:
+    def __init__(self, base_url=NTFY_URL, workers=NOTIFY_WORKERS):
+        self.base_url = base_url.rstrip('/')
+        self.workers = workers
+        self.queue = queue.PriorityQueue()
+        self.sequence = itertools.count()
+        self.rate_limiter = TopicRateLimiter()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.threads = []
+        self.stopping = threading.Event()
+        self.counts_lock = threading.Lock()
+        self.sent = 0
+        self.failed = 0
+
+    def start(self):
+        for i in range(self.workers):
+            thread = threading.Thread(target=self.run, name=f"notifier-{i}", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # Stop the workers once everything already queued has been attempted, or the timeout runs out
+    def stop(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.queue.unfinished_tasks and (deadline is None or time.monotonic() < deadline):
+            time.sleep(0.1)
+        self.stopping.set()
+        for thread in self.threads:
+            thread.join(timeout=None if deadline is None else max(0, deadline - time.monotonic()))
+        self.session.close()
+
+    def enqueue(self, topic, title, text):
+        self.schedule(Delivery(topic, title, text), 0)
+
+    def schedule(self, delivery, delay):
+        self.queue.put((time.monotonic() + delay, next(self.sequence), delivery))
+
+    # Number of messages waiting to be delivered, including ones waiting on a retry
+    def depth(self):
+        return self.queue.qsize()
+
+    def count(self, outcome):
+        with self.counts_lock:
+            setattr(self, outcome, getattr(self, outcome) + 1)
+        notifications.inc(outcome)
+
+    def run(self):
+        while not self.stopping.is_set():
+            try:
+                due, sequence, delivery = self.queue.get(timeout=IDLE_POLL)
+            except queue.Empty:
+                continue
+
+            wait = due - time.monotonic()
+            if wait <= 0:
+                wait = self.rate_limiter.acquire(delivery.topic)
+            if wait > 0:
+                self.queue.put((time.monotonic() + wait, sequence, delivery))
+                self.queue.task_done()
+                time.sleep(min(wait, IDLE_POLL))
+                continue
+
+            try:
+                self.deliver(delivery)
+            finally:
+                self.queue.task_done()
+
+    def deliver(self, delivery):
+        delivery.attempts += 1
+        retry_after = None
+        start = time.perf_counter()
+        try:
+            response = self.session.post(
+                f"{self.base_url}/{delivery.topic}",
+                data=delivery.text.encode('utf-8'),
+                headers={"Title": delivery.title},
+                timeout=REQUEST_TIMEOUT
+            )
+        except requests.exceptions.RequestException as e:
+            error = str(e)
+        else:
+            notification_delivery_seconds.observe(time.perf_counter() - start)
+            if response.status_code == 200:
+                logger.info(f"Sent notification to {delivery.topic}")
+                self.count('sent')
+                return
+            error = response.status_code
+            if response.status_code != 429 and response.status_code < 500:
+                logger.error(f"Failed to send notification to {delivery.topic}: {error}")
+                self.count('failed')
+                return
+            if response.headers.get('Retry-After', '').isdigit():
+                retry_after = int(response.headers['Retry-After'])
+
+        if delivery.attempts >= MAX_ATTEMPTS:
+            logger.error(f"Failed to send notification to {delivery.topic} after {delivery.attempts} attempts: {error}")
+            self.count('failed')
+            return
+
+        delay = retry_after if retry_after is not None else BACKOFF_BASE * 2 ** (delivery.attempts - 1) * random.uniform(1, 1.5)
+        logger.warning(f"Failed to send notification to {delivery.topic}: {error}, retrying in {delay:.1f}s")
+        notifications.inc('retried')
+        self.schedule(delivery, delay)
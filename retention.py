@@ -0,0 +1,181 @@
+import argparse
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta
+from sqlalchemy import text
+from models import Notification, NotificationRollup
+from config import Session, logger, NOTIFICATION_RETENTION_DAYS, UPDATE_RATE
+
+# Notifications older than the retention period are added to per user, day and filter
+# counts in notification_rollups and then deleted, so the table only holds recent
+# history.  Rows go in batches, each rolled up and deleted in one short transaction.
+#
+# On Postgres the notifications table can be partitioned by month instead (run
+# python retention.py --partition once, with the monitor stopped).  Months that are
+# entirely past the retention period are then rolled up and dropped whole, and the
+# monitor creates partitions ahead of time.
+
+RETENTION_BATCH_SIZE = 5000
+# How often the monitor expires old notifications
+RETENTION_INTERVAL = 3600  # seconds
+# Partitions are created this many months ahead of the current one
+PARTITION_MONTHS_AHEAD = 2
+# Housekeeping is done by whichever worker holds this shard, so only one does it at once
+HOUSEKEEPING_SHARD = 0
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+def next_month(day):
+    return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+
+def partition_name(month):
+    return f"notifications_{month:%Y_%m}"
+
+# Add counts, keyed by (user_id, day, filter_name), to the rollups
+def add_to_rollups(session, counts):
+    if not counts:
+        return
+    user_ids = {user_id for user_id, day, filter_name in counts}
+    days = {day for user_id, day, filter_name in counts}
+    existing = {(rollup.user_id, rollup.day, rollup.filter_name): rollup
+                for rollup in session.query(NotificationRollup)
+                .filter(NotificationRollup.user_id.in_(user_ids), NotificationRollup.day.in_(days))}
+    for key, count in counts.items():
+        rollup = existing.get(key)
+        if rollup is None:
+            user_id, day, filter_name = key
+            session.add(NotificationRollup(user_id=user_id, day=day, filter_name=filter_name, count=count))
+        else:
+            rollup.count += count
+
+# Roll up and delete the oldest batch of notifications from before the cutoff.
+# Returns how many were deleted.
+def expire_batch(session, cutoff, batch_size=RETENTION_BATCH_SIZE):
+    rows = session.query(Notification.id, Notification.user_id, Notification.timestamp, Notification.filter_name) \
+        .filter(Notification.timestamp < cutoff) \
+        .order_by(Notification.timestamp) \
+        .limit(batch_size).all()
+    if not rows:
+        return 0
+    add_to_rollups(session, Counter((row.user_id, row.timestamp.date(), row.filter_name) for row in rows))
+    session.query(Notification).filter(Notification.id.in_([row.id for row in rows])) \
+        .delete(synchronize_session=False)
+    session.commit()
+    return len(rows)
+
+def is_partitioned(session):
+    if session.get_bind().dialect.name != 'postgresql':
+        return False
+    return session.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = 'notifications'")).first() is not None
+
+# The first day of the month each partition of notifications holds
+def list_partitions(session):
+    names = session.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent "
+        "WHERE p.relname = 'notifications'")).scalars()
+    return {datetime.strptime(name, "notifications_%Y_%m").date(): name for name in names}
+
+# Make sure there are partitions from the month of start to PARTITION_MONTHS_AHEAD months after now
+def create_partitions(session, now, start=None):
+    month = month_start(start or now)
+    last = month_start(now)
+    for _ in range(PARTITION_MONTHS_AHEAD):
+        last = next_month(last)
+    while month <= last:
+        session.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(month)} PARTITION OF notifications "
+            f"FOR VALUES FROM ('{month}') TO ('{next_month(month)}')"))
+        month = next_month(month)
+
+# Roll up and drop the partitions whose whole month is before the cutoff
+def drop_expired_partitions(session, cutoff):
+    dropped = 0
+    for month, name in sorted(list_partitions(session).items()):
+        if next_month(month) > cutoff.date():
+            continue
+        rows = session.execute(text(
+            f"SELECT user_id, CAST(timestamp AS date), filter_name, count(*) FROM {name} GROUP BY 1, 2, 3"))
+        add_to_rollups(session, {(user_id, day, filter_name): count for user_id, day, filter_name, count in rows})
+        session.execute(text(f"DROP TABLE {name}"))
+        session.commit()
+        logger.info(f"Rolled up and dropped notification partition {name}")
+        dropped += 1
+    return dropped
+
+# Roll up and delete every notification older than the retention period.  Returns how
+# many rows were deleted one by one, not counting dropped partitions.
+def expire_notifications(session, now=None, retention=timedelta(days=NOTIFICATION_RETENTION_DAYS)):
+    now = now or datetime.utcnow()
+    cutoff = now - retention
+    if is_partitioned(session):
+        create_partitions(session, now)
+        session.commit()
+        drop_expired_partitions(session, cutoff)
+
+    deleted = 0
+    while True:
+        batch = expire_batch(session, cutoff)
+        deleted += batch
+        if batch < RETENTION_BATCH_SIZE:
+            break
+    if deleted:
+        logger.info(f"Rolled up and deleted {deleted} notifications from before {cutoff:%Y-%m-%d %H:%M}")
+    return deleted
+
+# Runs on its own thread in the monitor.  shards, if given, is the worker's
+# ShardCoordinator, and only the worker holding HOUSEKEEPING_SHARD expires notifications.
+def run_retention_loop(shards=None):
+    # give the first tick time to claim the worker's shards
+    time.sleep(UPDATE_RATE)
+    while True:
+        if NOTIFICATION_RETENTION_DAYS and (shards is None or shards.holds(HOUSEKEEPING_SHARD)):
+            session = Session()
+            try:
+                expire_notifications(session)
+            except Exception as e:
+                session.rollback()
+                logger.error(f"Error expiring old notifications, error was {e}")
+            finally:
+                Session.remove()
+        time.sleep(RETENTION_INTERVAL)
+
+# One-off conversion of an existing Postgres notifications table into a table
+# partitioned by month.  Rows are copied across, so stop the monitor and API first.
+def partition_notifications(session):
+    if is_partitioned(session):
+        logger.info("The notifications table is already partitioned")
+        return
+    sequence = session.execute(text("SELECT pg_get_serial_sequence('notifications', 'id')")).scalar()
+    oldest = session.execute(text("SELECT min(timestamp) FROM notifications")).scalar()
+    session.execute(text("ALTER TABLE notifications RENAME TO notifications_unpartitioned"))
+    # a partitioned table's primary key has to include the partition key, and the old
+    # table still has the usual key name until it's dropped
+    session.execute(text(
+        "CREATE TABLE notifications (LIKE notifications_unpartitioned INCLUDING DEFAULTS, "
+        "CONSTRAINT notifications_partitioned_pkey PRIMARY KEY (id, timestamp)) PARTITION BY RANGE (timestamp)"))
+    session.execute(text("ALTER TABLE notifications ADD FOREIGN KEY (user_id) REFERENCES users (id)"))
+    # keep the id sequence when the old table goes
+    session.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY notifications.id"))
+    create_partitions(session, datetime.utcnow(), oldest)
+    session.execute(text("INSERT INTO notifications SELECT * FROM notifications_unpartitioned"))
+    session.execute(text("DROP TABLE notifications_unpartitioned"))
+    for index in Notification.__table__.indexes:
+        index.create(session.connection())
+    session.commit()
+    logger.info(f"Partitioned the notifications table by month, {len(list_partitions(session))} partitions")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Expire old notifications")
+    parser.add_argument('--partition', action='store_true',
+                        help="convert the Postgres notifications table to monthly partitions first")
+    args = parser.parse_args()
+
+    with Session() as session:
+        if args.partition:
+            partition_notifications(session)
+        if NOTIFICATION_RETENTION_DAYS:
+            expire_notifications(session)
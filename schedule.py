@@ -0,0 +1,64 @@
+import threading
+import time
+from datetime import datetime
+import numpy as np
+from config import UPDATE_RATE
+from aircraft import PREDICT_MINUTES, ALERT_LEAD
+
+# How often the monitor loop wakes up to look for users that are due
+MIN_INTERVAL = 15  # seconds
+# With nothing in the query circle, the fastest aircraft outside it needs the whole
+# prediction window to reach the filter radius, so we can wait until it could be
+# just ALERT_LEAD away
+EMPTY_SKY_INTERVAL = PREDICT_MINUTES * 60 - ALERT_LEAD
+# Users who haven't reported a location in this long are probably not out looking
+STALE_LOCATION_SECONDS = 30 * 60
+STALE_LOCATION_INTERVAL = 5 * 60
+
+# Pick how long until a user should be evaluated again, from what their latest
+# evaluation saw.  approaches are from compute_approaches() over the user's batch.
+def choose_interval(approaches, max_filter_distance, reported_at):
+    if reported_at is not None and (datetime.utcnow() - reported_at).total_seconds() > STALE_LOCATION_SECONDS:
+        return STALE_LOCATION_INTERVAL
+
+    min_distances = approaches['min_distance']
+    if not len(min_distances):
+        return EMPTY_SKY_INTERVAL
+
+    inside = min_distances <= max_filter_distance
+    if inside.any():
+        # look again just before the soonest one is within ALERT_LEAD of closest approach
+        soonest = float(np.min(approaches['time_to_closest'][inside]))
+        return int(min(UPDATE_RATE, max(MIN_INTERVAL, soonest - ALERT_LEAD)))
+    return UPDATE_RATE
+
+# When each user is next due for an evaluation.  Users we haven't seen are due now.
+class EvaluationSchedule:
+    def __init__(self):
+        self.next_due = {}
+        self.lock = threading.Lock()
+
+    def is_due(self, user_id, now=None):
+        now = now or time.monotonic()
+        with self.lock:
+            return self.next_due.get(user_id, 0) <= now
+
+    # The interval counts from start, the monotonic time the aircraft data behind the
+    # evaluation was fetched, so an evaluation from an older snapshot can't push the
+    # user's next look later than fresh data would have
+    def set_next(self, user_id, interval, start=None):
+        with self.lock:
+            self.next_due[user_id] = (start or time.monotonic()) + interval
+
+    # A new location report ends whatever situation the last interval was chosen for
+    # (a stale location, an empty sky), so the user is due again straight away
+    def make_due(self, user_id):
+        with self.lock:
+            self.next_due.pop(user_id, None)
+
+    # Forget users that no longer show up in the tick state
+    def retain(self, user_ids):
+        with self.lock:
+            self.next_due = {user_id: due for user_id, due in self.next_due.items() if user_id in user_ids}
+
+evaluation_schedule = EvaluationSchedule()
@@ -0,0 +1,113 @@
+import math
+import zlib
+from datetime import datetime, timedelta
+from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
+from models import MonitorWorker, ShardLease
+from config import logger, SHARD_COUNT, WORKER_ID, UPDATE_RATE
+
+# Several monitor workers can share a database.  Users are hashed onto SHARD_COUNT
+# shards, and each worker holds leases on its fair share of them (the shard count over
+# the number of live workers), renewed every tick.  A worker that stops renewing loses
+# its shards when the leases expire, and a worker that has more than its share hands the
+# extras back so new workers can pick them up.  Claims are compare-and-set UPDATEs, so
+# this works the same on SQLite and Postgres.  Lease times come from each worker's own
+# clock, so workers on different hosts need their clocks in sync.
+
+# Long enough to survive a slow tick; a dead worker's users wait this long for a new owner
+LEASE_DURATION = timedelta(seconds=2 * UPDATE_RATE)
+# A worker stops treating a lease as its own this long before it expires, so a late
+# notification can't go out after another worker may have taken the shard over
+LEASE_SAFETY_MARGIN = timedelta(seconds=10)
+
+# The shard a user belongs to.  This never changes for a given SHARD_COUNT, so adding or
+# removing workers only moves whole shards between them.
+def shard_for_user(user_id, shard_count=SHARD_COUNT):
+    return zlib.crc32(str(user_id).encode()) % shard_count
+
+class ShardCoordinator:
+    def __init__(self, worker_id=WORKER_ID, shard_count=SHARD_COUNT, lease_duration=LEASE_DURATION):
+        self.worker_id = worker_id
+        self.shard_count = shard_count
+        self.lease_duration = lease_duration
+        # shard -> when our lease on it runs out
+        self.leases = {}
+
+    # Make sure every shard has a lease row, so claiming is always an UPDATE
+    def ensure_shards(self, session):
+        existing = {shard for (shard,) in session.query(ShardLease.shard)}
+        missing = [ShardLease(shard=shard) for shard in range(self.shard_count) if shard not in existing]
+        if not missing:
+            return
+        session.add_all(missing)
+        try:
+            session.commit()
+        except IntegrityError:
+            # another worker created them at the same time
+            session.rollback()
+
+    # Heartbeat, renew our leases, hand back shards beyond our fair share and claim free
+    # or expired ones up to it.  Call once per tick.  Returns the shards newly claimed.
+    def refresh(self, session, now=None):
+        now = now or datetime.utcnow()
+        expires_at = now + self.lease_duration
+        self.ensure_shards(session)
+
+        worker = session.get(MonitorWorker, self.worker_id)
+        if worker is None:
+            session.add(MonitorWorker(id=self.worker_id, heartbeat_at=now))
+        else:
+            worker.heartbeat_at = now
+        session.flush()
+        session.query(MonitorWorker).filter(MonitorWorker.heartbeat_at < now - self.lease_duration) \
+            .delete(synchronize_session=False)
+        live_workers = session.query(MonitorWorker).count()
+        fair_share = math.ceil(self.shard_count / max(1, live_workers))
+
+        # a lease that ran out and was taken over no longer has us as its owner
+        held = sorted(shard for (shard,) in session.query(ShardLease.shard)
+                      .filter(ShardLease.owner == self.worker_id, ShardLease.shard < self.shard_count))
+        extra = held[fair_share:]
+        held = held[:fair_share]
+        if extra:
+            session.query(ShardLease).filter(ShardLease.owner == self.worker_id, ShardLease.shard.in_(extra)) \
+                .update({ShardLease.owner: None, ShardLease.expires_at: None}, synchronize_session=False)
+        if held:
+            session.query(ShardLease).filter(ShardLease.owner == self.worker_id, ShardLease.shard.in_(held)) \
+                .update({ShardLease.expires_at: expires_at}, synchronize_session=False)
+
+        claimed = []
+        if len(held) < fair_share:
+            available = [shard for (shard,) in session.query(ShardLease.shard)
+                         .filter(ShardLease.shard < self.shard_count,
+                                 or_(ShardLease.owner.is_(None), ShardLease.expires_at < now))
+                         .order_by(ShardLease.shard)]
+            for shard in available[:fair_share - len(held)]:
+                # only succeeds if nobody else claimed it since we looked
+                updated = session.query(ShardLease) \
+                    .filter(ShardLease.shard == shard, or_(ShardLease.owner.is_(None), ShardLease.expires_at < now)) \
+                    .update({ShardLease.owner: self.worker_id, ShardLease.expires_at: expires_at}, synchronize_session=False)
+                if updated:
+                    claimed.append(shard)
+        session.commit()
+
+        self.leases = {shard: expires_at for shard in held + claimed}
+        if extra or claimed:
+            logger.info(f"Worker {self.worker_id} of {live_workers} released shards {extra}, claimed {claimed}, "
+                        f"now holds {len(self.leases)} of {self.shard_count}")
+        return claimed
+
+    def holds(self, shard, now=None):
+        expires_at = self.leases.get(shard)
+        return expires_at is not None and (now or datetime.utcnow()) < expires_at - LEASE_SAFETY_MARGIN
+
+    def owns_user(self, user_id, now=None):
+        return self.holds(shard_for_user(user_id, self.shard_count), now)
+
+    # Give up every lease and the heartbeat, e.g. on shutdown, so other workers take over at once
+    def release_all(self, session):
+        session.query(ShardLease).filter(ShardLease.owner == self.worker_id) \
+            .update({ShardLease.owner: None, ShardLease.expires_at: None}, synchronize_session=False)
+        session.query(MonitorWorker).filter(MonitorWorker.id == self.worker_id).delete(synchronize_session=False)
+        session.commit()
+        self.leases = {}
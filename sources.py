@@ -0,0 +1,189 @@
+import json
+import os
+import socket
+import threading
+import time
+from aircraft import fetch_aircraft_in_region
+from spatial_index import within_radius
+from config import logger
+
+# Where aircraft data comes from.  Every source has fetch(lat, lon, radius_nm), which
+# returns adsb.fi-style aircraft records within radius_nm of the point - the same
+# records process_aircraft_for_user() consumes - and tick(), called after every
+# monitor loop tick.
+#
+# AIRCRAFT_SOURCE picks one:
+#   adsbfi                  the opendata.adsb.fi API (the default)
+#   file:/path/aircraft.json a local readsb/dump1090 aircraft.json
+#   sbs:host:port           a SBS/BaseStation TCP feed, e.g. readsb on port 30003
+#   replay:/path/snapshots  recorded responses, one JSON document per line
+
+# How long an aircraft heard on a SBS feed is kept after its last message
+SBS_STALE_SECONDS = 60
+SBS_RECONNECT_SECONDS = 5
+
+# readsb and dump1090 don't know aircraft descriptions the way adsb.fi does, so fall
+# back to the callsign, then the type, then the hex code
+def with_description(aircraft):
+    if not aircraft.get('desc'):
+        aircraft['desc'] = (aircraft.get('flight') or '').strip() or aircraft.get('t') or aircraft.get('hex', '').upper()
+    return aircraft
+
+class AdsbFiSource:
+    def fetch(self, lat, lon, radius_nm):
+        return fetch_aircraft_in_region(lat, lon, radius_nm)
+
+    def tick(self):
+        pass
+
+    def __repr__(self):
+        return "AdsbFiSource()"
+
+# A local aircraft.json, only re-read when its mtime changes
+class AircraftJsonSource:
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.aircraft = []
+        self.lock = threading.Lock()
+
+    def load(self):
+        mtime = os.stat(self.path).st_mtime
+        with self.lock:
+            if mtime != self.mtime:
+                with open(self.path, 'rb') as f:
+                    self.aircraft = [with_description(aircraft) for aircraft in json.load(f).get('aircraft', [])]
+                self.mtime = mtime
+            return self.aircraft
+
+    def fetch(self, lat, lon, radius_nm):
+        return within_radius(self.load(), lat, lon, radius_nm)
+
+    def tick(self):
+        pass
+
+    def __repr__(self):
+        return f"AircraftJsonSource({self.path!r})"
+
+# Aircraft state built up from a SBS/BaseStation feed by a background reader thread
+class SbsSource:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.aircraft = {}
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self.run, name="sbs-reader", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                with socket.create_connection((self.host, self.port), timeout=30) as connection:
+                    logger.info(f"Connected to SBS feed at {self.host}:{self.port}")
+                    for line in connection.makefile('r', encoding='ascii', errors='replace'):
+                        self.handle_message(line, time.time())
+            except OSError as e:
+                logger.error(f"SBS feed at {self.host}:{self.port} failed, error was {e}, reconnecting")
+            time.sleep(SBS_RECONNECT_SECONDS)
+
+    # Fold one BaseStation MSG line into the aircraft's state
+    def handle_message(self, line, now):
+        fields = line.strip().split(',')
+        if len(fields) < 22 or fields[0] != 'MSG' or not fields[4]:
+            return
+
+        def number(index):
+            try:
+                return float(fields[index]) if fields[index] else None
+            except ValueError:
+                return None
+
+        hex = fields[4].lower()
+        with self.lock:
+            aircraft = self.aircraft.setdefault(hex, {"hex": hex})
+            aircraft['last_seen'] = now
+            if fields[10].strip():
+                aircraft['flight'] = fields[10].strip()
+            altitude = number(11)
+            if altitude is not None:
+                aircraft['alt_baro'] = altitude
+                # SBS only carries barometric altitude, which is what we have to go on
+                aircraft['alt_geom'] = altitude
+            if fields[21] == '-1':
+                aircraft['alt_baro'] = 'ground'
+            for field, index in (('gs', 12), ('track', 13), ('baro_rate', 16)):
+                value = number(index)
+                if value is not None:
+                    aircraft[field] = value
+            lat, lon = number(14), number(15)
+            if lat is not None and lon is not None:
+                aircraft['lat'] = lat
+                aircraft['lon'] = lon
+                aircraft['position_time'] = now
+
+    def snapshot(self):
+        now = time.time()
+        with self.lock:
+            for hex in [hex for hex, aircraft in self.aircraft.items() if now - aircraft['last_seen'] > SBS_STALE_SECONDS]:
+                del self.aircraft[hex]
+            records = []
+            for aircraft in self.aircraft.values():
+                record = {key: value for key, value in aircraft.items() if key not in ('last_seen', 'position_time')}
+                if 'position_time' in aircraft:
+                    record['seen_pos'] = now - aircraft['position_time']
+                records.append(with_description(record))
+        return records
+
+    def fetch(self, lat, lon, radius_nm):
+        self.start()
+        return within_radius(self.snapshot(), lat, lon, radius_nm)
+
+    def tick(self):
+        pass
+
+    def __repr__(self):
+        return f"SbsSource({self.host!r}, {self.port})"
+
+# Plays back recorded responses, one per tick, for running offline.  Each line of the
+# file is a JSON document with an "aircraft" list, like an adsb.fi response or a
+# readsb aircraft.json.  Playback starts over at the end of the file.
+class ReplaySource:
+    def __init__(self, path):
+        self.path = path
+        with open(path) as f:
+            self.snapshots = [json.loads(line).get('aircraft', []) for line in f if line.strip()]
+        if not self.snapshots:
+            raise ValueError(f"No snapshots in {path}")
+        self.position = 0
+        self.lock = threading.Lock()
+
+    # Move on to the next recorded snapshot
+    def tick(self):
+        with self.lock:
+            self.position = (self.position + 1) % len(self.snapshots)
+
+    def fetch(self, lat, lon, radius_nm):
+        with self.lock:
+            snapshot = self.snapshots[self.position]
+        return within_radius([with_description(dict(aircraft)) for aircraft in snapshot], lat, lon, radius_nm)
+
+    def __repr__(self):
+        return f"ReplaySource({self.path!r}, {len(self.snapshots)} snapshots)"
+
+def create_source(spec):
+    kind, _, target = spec.partition(':')
+    if kind == 'adsbfi':
+        return AdsbFiSource()
+    elif kind == 'file':
+        return AircraftJsonSource(target)
+    elif kind == 'sbs':
+        host, _, port = target.rpartition(':')
+        return SbsSource(host or 'localhost', int(port or 30003))
+    elif kind == 'replay':
+        return ReplaySource(target)
+    else:
+        raise ValueError(f"Unsupported aircraft source {spec}")
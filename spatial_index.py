@@ -0,0 +1,60 @@
+import math
+import numpy as np
+from geometry import distance_nm
+
+# Roughly the size of a grid cell; small enough that a query circle only touches the
+# cells near it, big enough that a busy snapshot doesn't spread over thousands of cells
+CELL_NM = 10
+# Cell keys are row * KEY_STRIDE + column
+KEY_STRIDE = 1 << 32
+
+# Keep only the aircraft with a position within radius_nm of the point
+def within_radius(aircraft_list, lat, lon, radius_nm):
+    positioned = [aircraft for aircraft in aircraft_list if 'lat' in aircraft and 'lon' in aircraft]
+    if not positioned:
+        return []
+    lats = np.array([aircraft['lat'] for aircraft in positioned], dtype=float)
+    lons = np.array([aircraft['lon'] for aircraft in positioned], dtype=float)
+    inside = distance_nm(lat, lon, lats, lons) <= radius_nm
+    return [positioned[i] for i in np.flatnonzero(inside)]
+
+# A lat/lon grid over one snapshot's aircraft, built once and then queried by many users.
+# Aircraft are sorted by cell key (row * KEY_STRIDE + column), so the cells of one row
+# that a query circle touches are a single contiguous slice of self.order.
+class SpatialIndex:
+    def __init__(self, lats, lons, cell_nm=CELL_NM):
+        self.count = len(lats)
+        self.lats = np.asarray(lats, dtype=float)
+        self.lons = np.asarray(lons, dtype=float)
+        self.lat_step = cell_nm / 60
+        # size columns for the middle of the snapshot; this only affects speed, not results
+        reference_lat = float(np.median(lats)) if len(lats) else 0.0
+        self.lon_step = self.lat_step / max(0.01, math.cos(math.radians(min(89.0, abs(reference_lat)))))
+
+        rows = np.floor(self.lats / self.lat_step).astype(np.int64)
+        columns = np.floor(self.lons / self.lon_step).astype(np.int64)
+        keys = rows * KEY_STRIDE + columns
+        self.order = np.argsort(keys, kind='stable')
+        self.sorted_keys = keys[self.order]
+
+    # Indices (into the arrays the index was built from) of the aircraft within
+    # radius_nm of the point, in ascending order
+    def query(self, lat, lon, radius_nm):
+        dlat = radius_nm / 60
+        dlon = radius_nm / (60 * max(0.01, math.cos(math.radians(min(89.0, abs(lat) + dlat)))))
+
+        # near the poles or the antimeridian just check everything
+        if lon - dlon < -180 or lon + dlon > 180 or lat + dlat > 89 or lat - dlat < -89:
+            candidates = np.arange(self.count)
+        else:
+            rows = np.arange(math.floor((lat - dlat) / self.lat_step), math.floor((lat + dlat) / self.lat_step) + 1, dtype=np.int64)
+            first_column = math.floor((lon - dlon) / self.lon_step)
+            last_column = math.floor((lon + dlon) / self.lon_step)
+            starts = np.searchsorted(self.sorted_keys, rows * KEY_STRIDE + first_column)
+            ends = np.searchsorted(self.sorted_keys, rows * KEY_STRIDE + last_column + 1)
+            slices = [self.order[start:end] for start, end in zip(starts.tolist(), ends.tolist()) if end > start]
+            if not slices:
+                return np.zeros(0, dtype=np.int64)
+            candidates = np.sort(np.concatenate(slices))
+
+        return candidates[distance_nm(lat, lon, self.lats[candidates], self.lons[candidates]) <= radius_nm]
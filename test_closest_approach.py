@@ -0,0 +1,124 @@
+import numpy as np
+import pytest
+from closest_approach import closest_approach, closest_approach_vectorized, compute_3d_distance, predict_future_position_turning
+
+PREDICT_MINUTES = 3
+TRACKS = 500
+
+# The original sampling implementation, as the reference the analytic solver is checked
+# against.  It steps along the straight line between the two positions, num_samples steps.
+def closest_approach_sampled(user_lat, user_lon, user_alt, aircraft_lat, aircraft_lon, aircraft_alt, future_lat, future_lon, future_alt, num_samples=100):
+    min_distance = float('inf')
+    closest_point = None
+    t_closest = 0
+
+    for i in range(num_samples + 1):
+        t = i / num_samples
+        interp_lat = aircraft_lat + t * (future_lat - aircraft_lat)
+        interp_lon = aircraft_lon + t * (future_lon - aircraft_lon)
+        interp_alt = aircraft_alt + t * (future_alt - aircraft_alt)
+
+        distance = compute_3d_distance(user_lat, user_lon, user_alt, interp_lat, interp_lon, interp_alt)
+
+        if distance < min_distance:
+            min_distance = distance
+            closest_point = (interp_lat, interp_lon, interp_alt)
+            t_closest = t
+
+    return closest_point, t_closest, min_distance / 6076.12
+
+# Users around the world, with aircraft up to 20 nm away doing anything from loitering
+# to 600 knots, climbing, descending and turning
+def random_tracks(seed, count=TRACKS):
+    rng = np.random.default_rng(seed)
+    for _ in range(count):
+        user_lat = rng.uniform(-70, 70)
+        user_lon = rng.uniform(-180, 180)
+        user_alt = rng.uniform(0, 3000)
+        lat = user_lat + rng.uniform(-1 / 3, 1 / 3)
+        lon = user_lon + rng.uniform(-1 / 3, 1 / 3) / np.cos(np.radians(user_lat))
+        alt = rng.uniform(0, 40000)
+        future_lat, future_lon, future_alt = predict_future_position_turning(
+            lat, lon, alt, rng.uniform(0, 600), rng.uniform(0, 360), rng.uniform(-3, 3), rng.uniform(-3000, 3000), PREDICT_MINUTES)
+        yield (user_lat, user_lon, user_alt), (lat, lon, alt, float(future_lat), float(future_lon), float(future_alt))
+
+# random_tracks() moved to users within a few miles of the antimeridian, on either side
+# of it, with the aircraft's longitudes wrapped into -180..180 as adsb.fi reports them
+def antimeridian_tracks(seed, count=TRACKS):
+    rng = np.random.default_rng(seed)
+    for (user_lat, user_lon, user_alt), (lat, lon, alt, future_lat, future_lon, future_alt) in random_tracks(seed, count):
+        shift = rng.choice([180.0, -180.0]) + rng.uniform(-0.1, 0.1) - user_lon
+        wrapped_lon = (lon + shift + 180) % 360 - 180
+        # the prediction carries on from wherever the aircraft is, without wrapping
+        future_lon = wrapped_lon + (future_lon - lon)
+        yield (user_lat, (user_lon + shift + 180) % 360 - 180, user_alt), (lat, wrapped_lon, alt, future_lat, future_lon, future_alt)
+
+# The distance from the user at t along the reference's path
+def distance_along(user, track, t):
+    lat, lon, alt, future_lat, future_lon, future_alt = track
+    return compute_3d_distance(*user, lat + t * (future_lat - lat), lon + t * (future_lon - lon), alt + t * (future_alt - alt)) / 6076.12
+
+@pytest.mark.parametrize('seed', [1, 2, 3])
+def test_matches_sampled_reference(seed):
+    for user, track in random_tracks(seed):
+        closest_point, t_closest, min_distance = closest_approach(*user, *track)
+        # fine enough steps that the reference's own error is well inside the tolerance
+        sampled_point, sampled_t, sampled_distance = closest_approach_sampled(*user, *track, num_samples=2000)
+        assert min_distance == pytest.approx(sampled_distance, abs=0.01), (user, track)
+        # the solver flies a straight line in the user's tangent plane and the reference a
+        # straight line in lat/lon, so far from the user at high latitudes the minimum can be
+        # too flat to pin down t; there it's enough that t is as close along the reference path
+        if t_closest != pytest.approx(sampled_t, abs=0.02):
+            assert distance_along(user, track, t_closest) == pytest.approx(sampled_distance, abs=0.001), (user, track)
+        # the analytic answer is never meaningfully further than any sampled point
+        assert min_distance <= sampled_distance + 0.001, (user, track)
+
+def test_matches_sampled_reference_at_default_resolution():
+    for user, track in random_tracks(4, count=100):
+        _, t_closest, min_distance = closest_approach(*user, *track)
+        _, sampled_t, sampled_distance = closest_approach_sampled(*user, *track)
+        assert min_distance <= sampled_distance + 0.001, (user, track)
+        # 100 steps over a 30 nm path are 0.3 nm apart, so the reference can be off by half that
+        assert min_distance == pytest.approx(sampled_distance, abs=0.15), (user, track)
+
+def test_vectorized_matches_one_at_a_time():
+    users, tracks = zip(*random_tracks(5, count=50))
+    # one user, many aircraft
+    user = users[0]
+    columns = [np.array(column) for column in zip(*tracks)]
+    (closest_lat, closest_lon, closest_alt), t_closest, min_distance = closest_approach_vectorized(*user, *columns)
+    for i, track in enumerate(tracks):
+        closest_point, t, distance = closest_approach(*user, *track)
+        assert closest_point == pytest.approx((closest_lat[i], closest_lon[i], closest_alt[i]))
+        assert t == pytest.approx(t_closest[i])
+        assert distance == pytest.approx(min_distance[i])
+
+def test_stationary_aircraft_is_closest_now():
+    closest_point, t_closest, min_distance = closest_approach(37.0, -122.0, 0, 37.1, -122.0, 5000, 37.1, -122.0, 5000)
+    assert t_closest == 0
+    assert closest_point == (37.1, -122.0, 5000)
+    assert min_distance == pytest.approx(compute_3d_distance(37.0, -122.0, 0, 37.1, -122.0, 5000) / 6076.12)
+
+def test_receding_aircraft_is_closest_now():
+    # due north of the user and flying further north
+    _, t_closest, _ = closest_approach(37.0, -122.0, 0, 37.1, -122.0, 5000, 37.2, -122.0, 5000)
+    assert t_closest == 0
+
+def test_overflight():
+    # flies straight over the user, halfway through the window
+    closest_point, t_closest, min_distance = closest_approach(37.0, -122.0, 0, 36.9, -122.0, 3000, 37.1, -122.0, 3000)
+    assert t_closest == pytest.approx(0.5, abs=0.01)
+    assert min_distance == pytest.approx(3000 / 6076.12, abs=0.01)
+
+def test_across_the_antimeridian():
+    # aircraft just across the antimeridian from the user, flying east away from them
+    _, t_closest, min_distance = closest_approach(0.0, 179.99, 0, 0.0, -179.99, 0, 0.0, -179.9, 0)
+    _, sampled_t, sampled_distance = closest_approach_sampled(0.0, 179.99, 0, 0.0, -179.99, 0, 0.0, -179.9, 0)
+    assert t_closest == sampled_t == 0
+    assert min_distance == pytest.approx(sampled_distance, abs=0.01)
+
+    for user, track in antimeridian_tracks(6, count=200):
+        _, t_closest, min_distance = closest_approach(*user, *track)
+        _, sampled_t, sampled_distance = closest_approach_sampled(*user, *track, num_samples=2000)
+        assert min_distance == pytest.approx(sampled_distance, abs=0.01), (user, track)
+        assert min_distance <= sampled_distance + 0.001, (user, track)
@@ -0,0 +1,81 @@
+import time
+import pytest
+import main
+from events import SnapshotCache
+from fetch_planner import Region
+from filter_plan import FilterPlan, within_3d_distance
+from aircraft import get_query_distance
+from aircraft_batch import aircraft_batch_from_json
+from schedule import EvaluationSchedule
+from dedupe import NotificationDedupe
+from tick_state import UserState, LocationState
+
+# One aircraft a little north of wherever the user is
+def aircraft_near(lat, lon):
+    return [{'hex': 'abc123', 'desc': 'TEST', 'lat': lat + 0.03, 'lon': lon, 'alt_baro': 3000, 'alt_geom': 3000,
+             'gs': 120.0, 'track': 180.0, 'seen_pos': 0.0}]
+
+class RecordingSource:
+    def __init__(self):
+        self.fetches = []
+
+    def fetch(self, lat, lon, radius_nm):
+        self.fetches.append((lat, lon, radius_nm))
+        return aircraft_near(lat, lon)
+
+    def tick(self):
+        pass
+
+def user_at(lat, lon):
+    plan = FilterPlan([('nearby', [within_3d_distance(3.0)])], 3.0)
+    return UserState(1, 'user@example.com', 'topic', LocationState(lat, lon, 0.0, None), plan)
+
+@pytest.fixture
+def cache(monkeypatch):
+    cache = SnapshotCache()
+    monkeypatch.setattr(main, 'snapshot_cache', cache)
+    monkeypatch.setattr(main, 'evaluation_schedule', EvaluationSchedule())
+    monkeypatch.setattr(main, 'notification_dedupe', NotificationDedupe())
+    return cache
+
+# What the last tick fetched for a user at (lat, lon): a region that is exactly their circle
+def store_tick_snapshot(cache, lat, lon):
+    radius_nm = get_query_distance(3.0)
+    region = Region(lat, lon, radius_nm)
+    region.members.append((0, lat, lon, radius_nm))
+    batch, dropped = aircraft_batch_from_json(aircraft_near(lat, lon))
+    cache.store(region, batch)
+
+def test_unmoved_user_uses_the_snapshot(cache):
+    store_tick_snapshot(cache, 37.0, -122.0)
+    user = user_at(37.0, -122.0)
+    snapshot = cache.find(37.0, -122.0, get_query_distance(3.0))
+    assert snapshot is not None
+
+    source = RecordingSource()
+    main.evaluate_after_report(source, user, snapshot)
+    assert source.fetches == []
+
+def test_moved_user_is_fetched(cache):
+    store_tick_snapshot(cache, 37.0, -122.0)
+    # a mile south of where the tick saw them
+    user = user_at(37.0 - 1 / 60, -122.0)
+    snapshot = cache.find(user.location.lat, user.location.lon, get_query_distance(3.0))
+    assert snapshot is None
+
+    source = RecordingSource()
+    pending = main.evaluate_after_report(source, user, snapshot)
+    assert source.fetches == [(user.location.lat, user.location.lon, get_query_distance(3.0))]
+    assert [row['aircraft_hex'] for row in pending] == ['abc123']
+    assert not main.evaluation_schedule.is_due(user.id)
+    # the fetch is kept for the next report from around here
+    assert cache.find(user.location.lat, user.location.lon, get_query_distance(3.0)) is not None
+
+def test_failed_fetch_leaves_the_user_for_the_tick(cache):
+    class FailingSource(RecordingSource):
+        def fetch(self, lat, lon, radius_nm):
+            raise ConnectionError("upstream down")
+
+    user = user_at(37.0, -122.0)
+    assert main.evaluate_after_report(FailingSource(), user, None) == []
+    assert main.evaluation_schedule.is_due(user.id, time.monotonic())
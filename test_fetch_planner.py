@@ -0,0 +1,53 @@
+import random
+import numpy as np
+import pytest
+from fetch_planner import Region, plan_regions, fan_out, fan_out_indexed, fan_out_scanned, worth_indexing, REGION_MAX_RADIUS_NM
+from aircraft_batch import AircraftBatch
+from geometry import distance_nm
+
+def assert_covered(circles, regions):
+    assert sorted(key for region in regions for key, lat, lon, radius_nm in region.members) == sorted(c[0] for c in circles)
+    for region in regions:
+        assert region.radius_nm <= REGION_MAX_RADIUS_NM + 1e-9
+        for key, lat, lon, radius_nm in region.members:
+            assert distance_nm(region.lat, region.lon, lat, lon) + radius_nm <= region.radius_nm + 1e-6
+
+def test_regions_cover_every_circle():
+    rng = random.Random(1)
+    circles = [(i, rng.uniform(25, 49), rng.uniform(-124, -67), rng.uniform(20, 40)) for i in range(500)]
+    regions = plan_regions(circles)
+    assert_covered(circles, regions)
+    assert len(regions) < len(circles)
+
+@pytest.mark.parametrize('lat, lon', [(10.0, 179.9), (88.5, 0.0)])
+def test_regions_across_the_antimeridian_and_near_the_pole(lat, lon):
+    circles = [(0, lat, lon, 28.0), (1, lat, -lon if lon else 1.0, 28.0), (2, lat - 0.2, lon, 28.0)]
+    regions = plan_regions(circles)
+    assert_covered(circles, regions)
+    assert len(regions) == 1
+
+def random_batch(rng, count, lat, lon, spread):
+    full = lambda value: np.full(count, value)
+    hexes = np.array([f"{i:06x}" for i in range(count)])
+    lats = np.array([lat + rng.uniform(-spread, spread) for i in range(count)])
+    lons = np.array([lon + rng.uniform(-spread, spread) for i in range(count)])
+    return AircraftBatch(hexes, hexes, lats, lons, full(10000.0), full(300.0), full(90.0))
+
+def test_fan_out_indexes_only_big_batches_for_many_small_circles():
+    rng = random.Random(2)
+    batch = random_batch(rng, 3000, 37.0, -122.0, 1.5)
+    region = Region(37.0, -122.0, 100.0)
+    region.members = [(i, 37.0 + rng.uniform(-1, 1), -122.0 + rng.uniform(-1, 1), 28.0) for i in range(20)]
+    assert worth_indexing(region, len(batch))
+    indexed = fan_out_indexed(region, batch)
+    scanned = fan_out_scanned(region, batch)
+    assert all(np.array_equal(indexed[key].hex, scanned[key].hex) for key in scanned)
+
+    # the same circles over most of a smaller region, or only a few of them
+    crowded = Region(37.0, -122.0, 50.0)
+    crowded.members = region.members
+    assert not worth_indexing(crowded, len(batch))
+    few = Region(37.0, -122.0, 100.0)
+    few.members = region.members[:3]
+    assert not worth_indexing(few, len(batch))
+    assert fan_out(few, batch).keys() == {0, 1, 2}
@@ -0,0 +1,36 @@
+import pytest
+import http_fetch
+from http_fetch import AircraftFetcher
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(http_fetch.time, 'monotonic', lambda: clock[0])
+    return clock
+
+def fetcher_returning(records):
+    fetcher = AircraftFetcher()
+    fetcher.requests = []
+    def request(lat, lon, radius_nm):
+        fetcher.requests.append((lat, lon, radius_nm))
+        return records
+    fetcher.request = request
+    return fetcher
+
+def test_cache_hits_are_aged(clock):
+    fetcher = fetcher_returning([{"hex": "a", "seen_pos": 1.5}, {"hex": "b"}])
+    assert [record.get('seen_pos') for record in fetcher.fetch(37.6, -122.4, 28)] == [1.5, None]
+
+    clock[0] += 4
+    assert [record['seen_pos'] for record in fetcher.fetch(37.6, -122.4, 28)] == [5.5, 4]
+    assert len(fetcher.requests) == 1
+    # the cached records themselves are left as they were fetched
+    clock[0] += 2
+    assert [record['seen_pos'] for record in fetcher.fetch(37.6, -122.4, 28)] == [7.5, 6]
+
+def test_expired_entries_are_fetched_again(clock):
+    fetcher = fetcher_returning([{"hex": "a", "seen_pos": 0.0}])
+    fetcher.fetch(37.6, -122.4, 28)
+    clock[0] += fetcher.cache_ttl + 1
+    assert fetcher.fetch(37.6, -122.4, 28)[0]['seen_pos'] == 0.0
+    assert len(fetcher.requests) == 2
@@ -0,0 +1,15 @@
+import location_api
+from location_api import UserIdCache
+
+def test_unknown_emails_expire_and_are_capped(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr(location_api.time, 'monotonic', lambda: clock[0])
+    cache = UserIdCache(unknown_ttl=60, unknown_max_entries=3)
+
+    for i in range(5):
+        assert cache.get(f"nobody{i}@example.com") is None
+    assert list(cache.unknown) == ["nobody2@example.com", "nobody3@example.com", "nobody4@example.com"]
+
+    clock[0] += 61
+    assert cache.get("someone-else@example.com") is None
+    assert list(cache.unknown) == ["someone-else@example.com"]
@@ -0,0 +1,20 @@
+import pytest
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+import metrics
+
+def query_counts():
+    return {labels[0]: state[2] for labels, state in metrics.db_query_seconds.values.items()}
+
+def test_failed_statements_leave_nothing_on_the_connection():
+    engine = create_engine('sqlite://')
+    metrics.instrument_engine(engine)
+    before = query_counts()
+    with engine.connect() as connection:
+        with pytest.raises(OperationalError):
+            connection.execute(text("SELECT * FROM no_such_table"))
+        connection.rollback()
+        assert connection.execute(text("SELECT 1")).scalar() == 1
+        assert 'query_start' not in connection.info
+    after = query_counts()
+    assert after['SELECT'] == before.get('SELECT', 0) + 1
@@ -0,0 +1,117 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import notifier as notifier_module
+from notifier import Notifier, TopicRateLimiter, MAX_ATTEMPTS
+
+# A stand-in for ntfy that answers each POST with the next scripted (status, headers),
+# then with the default once the script runs out, and records what it was sent
+class ScriptedNtfyHandler(BaseHTTPRequestHandler):
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        stub = self.server
+        with stub.lock:
+            stub.received.append((time.monotonic(), self.path, self.headers.get('Title'), body.decode()))
+            status, headers = stub.script.pop(0) if stub.script else stub.default
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def ntfy():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ScriptedNtfyHandler)
+    server.lock = threading.Lock()
+    server.received = []
+    server.script = []
+    server.default = (200, {})
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def notifier(ntfy, monkeypatch):
+    monkeypatch.setattr(notifier_module, 'BACKOFF_BASE', 0.01)
+    notifier = Notifier(base_url=f"http://127.0.0.1:{ntfy.server_port}/")
+    notifier.start()
+    yield notifier
+    notifier.stop(timeout=5)
+
+def test_delivers(ntfy, notifier):
+    notifier.enqueue('topic', "A title", "Some text")
+    notifier.stop(timeout=5)
+    assert [(path, title, body) for _, path, title, body in ntfy.received] == [('/topic', "A title", "Some text")]
+    assert (notifier.sent, notifier.failed) == (1, 0)
+
+def test_429_waits_for_retry_after(ntfy, notifier):
+    ntfy.script = [(429, {'Retry-After': '1'})]
+    notifier.enqueue('topic', "title", "text")
+    notifier.stop(timeout=5)
+    assert len(ntfy.received) == 2
+    assert ntfy.received[1][0] - ntfy.received[0][0] >= 1
+    assert (notifier.sent, notifier.failed) == (1, 0)
+
+def test_5xx_then_success(ntfy, notifier):
+    ntfy.script = [(503, {}), (502, {})]
+    notifier.enqueue('topic', "title", "text")
+    notifier.stop(timeout=5)
+    assert len(ntfy.received) == 3
+    assert (notifier.sent, notifier.failed) == (1, 0)
+
+def test_gives_up_after_max_attempts(ntfy, notifier):
+    ntfy.default = (500, {})
+    notifier.enqueue('topic', "title", "text")
+    notifier.stop(timeout=5)
+    assert len(ntfy.received) == MAX_ATTEMPTS
+    assert (notifier.sent, notifier.failed) == (0, 1)
+
+def test_4xx_is_not_retried(ntfy, notifier):
+    ntfy.script = [(400, {})]
+    notifier.enqueue('topic', "title", "text")
+    notifier.stop(timeout=5)
+    assert len(ntfy.received) == 1
+    assert (notifier.sent, notifier.failed) == (0, 1)
+
+def test_token_bucket_delays_a_burst(ntfy, notifier):
+    notifier.rate_limiter = TopicRateLimiter(burst=2, refill_seconds=0.5)
+    for i in range(4):
+        notifier.enqueue('busy', "title", f"text {i}")
+    notifier.enqueue('quiet', "title", "text")
+    notifier.stop(timeout=5)
+
+    busy = sorted(received for received, path, _, _ in ntfy.received if path == '/busy')
+    quiet = [received for received, path, _, _ in ntfy.received if path == '/quiet']
+    assert len(busy) == 4 and len(quiet) == 1
+    # the first two go straight out, the rest one refill apart
+    assert busy[1] - busy[0] < 0.25
+    assert busy[2] - busy[0] >= 0.45
+    assert busy[3] - busy[0] >= 0.95
+    # other topics have buckets of their own
+    assert quiet[0] - busy[0] < 0.25
+    assert notifier.sent == 5
+
+def test_stop_drains_the_queue(ntfy, notifier):
+    for i in range(20):
+        notifier.enqueue(f"topic-{i}", "title", "text")
+    notifier.stop(timeout=5)
+    assert len(ntfy.received) == 20
+    assert notifier.sent == 20
+    assert notifier.depth() == 0
+
+def test_stop_gives_up_at_the_timeout(ntfy, notifier, monkeypatch):
+    monkeypatch.setattr(notifier_module, 'BACKOFF_BASE', 60)
+    ntfy.script = [(503, {})]
+    notifier.enqueue('topic', "title", "text")
+    start = time.monotonic()
+    notifier.stop(timeout=1)
+    assert time.monotonic() - start < 2
+    # the retry is still waiting its turn
+    assert len(ntfy.received) == 1
+    assert notifier.depth() == 1
@@ -0,0 +1,30 @@
+from datetime import datetime, timedelta
+import numpy as np
+from schedule import EvaluationSchedule, choose_interval, STALE_LOCATION_INTERVAL, EMPTY_SKY_INTERVAL
+
+def no_approaches():
+    return {'min_distance': np.zeros(0), 'time_to_closest': np.zeros(0)}
+
+def test_stale_location_waits():
+    reported_at = datetime.utcnow() - timedelta(minutes=40)
+    assert choose_interval(no_approaches(), 3.0, reported_at) == STALE_LOCATION_INTERVAL
+
+def test_new_users_are_due():
+    schedule = EvaluationSchedule()
+    assert schedule.is_due(1, now=1000.0)
+
+def test_make_due_ends_a_long_interval():
+    schedule = EvaluationSchedule()
+    for user_id, interval in ((1, STALE_LOCATION_INTERVAL), (2, EMPTY_SKY_INTERVAL)):
+        schedule.set_next(user_id, interval, start=1000.0)
+        assert not schedule.is_due(user_id, now=1015.0)
+        schedule.make_due(user_id)
+        assert schedule.is_due(user_id, now=1015.0)
+
+def test_make_due_leaves_other_users_alone():
+    schedule = EvaluationSchedule()
+    schedule.set_next(1, STALE_LOCATION_INTERVAL, start=1000.0)
+    schedule.set_next(2, STALE_LOCATION_INTERVAL, start=1000.0)
+    schedule.make_due(1)
+    assert schedule.is_due(1, now=1015.0)
+    assert not schedule.is_due(2, now=1015.0)
@@ -0,0 +1,87 @@
+from datetime import datetime, timedelta
+import pytest
+from config import Session
+from models import MonitorWorker, ShardLease
+from sharding import ShardCoordinator, shard_for_user, LEASE_DURATION
+
+SHARDS = 16
+
+@pytest.fixture
+def session():
+    session = Session()
+    yield session
+    session.query(ShardLease).delete()
+    session.query(MonitorWorker).delete()
+    session.commit()
+    Session.remove()
+
+def holdings(workers, now):
+    return [{shard for shard in range(SHARDS) if worker.holds(shard, now)} for worker in workers]
+
+# Every shard held by exactly one of the workers
+def assert_partitioned(workers, now):
+    held = holdings(workers, now)
+    assert sum(len(shards) for shards in held) == SHARDS
+    assert set().union(*held) == set(range(SHARDS))
+
+# Each worker refreshes in turn, twice over, so releases from the first round are
+# claimed in the second
+def refresh_all(session, workers, now):
+    for _ in range(2):
+        for worker in workers:
+            worker.refresh(session, now)
+
+def test_workers_split_the_shards(session):
+    now = datetime.utcnow()
+    workers = [ShardCoordinator(f"worker-{i}", SHARDS) for i in range(3)]
+    refresh_all(session, workers, now)
+    assert_partitioned(workers, now)
+    # nobody holds more than their fair share, rounded up
+    assert all(0 < len(shards) <= 6 for shards in holdings(workers, now))
+    # each user is evaluated by exactly one worker
+    for user_id in range(100):
+        assert sum(worker.owns_user(user_id, now) for worker in workers) == 1
+        assert workers[0].owns_user(user_id, now) == workers[0].holds(shard_for_user(user_id, SHARDS), now)
+
+def test_joining_worker_gets_a_share(session):
+    now = datetime.utcnow()
+    first = ShardCoordinator("first", SHARDS)
+    first.refresh(session, now)
+    assert holdings([first], now) == [set(range(SHARDS))]
+
+    second = ShardCoordinator("second", SHARDS)
+    now += timedelta(seconds=15)
+    refresh_all(session, [first, second], now)
+    assert_partitioned([first, second], now)
+    assert [len(shards) for shards in holdings([first, second], now)] == [8, 8]
+
+def test_expired_leases_fail_over(session):
+    now = datetime.utcnow()
+    survivor = ShardCoordinator("survivor", SHARDS)
+    dead = ShardCoordinator("dead", SHARDS)
+    refresh_all(session, [survivor, dead], now)
+    dead_shards = holdings([dead], now)[0]
+    assert dead_shards
+
+    # the dead worker stops refreshing; the survivor keeps going until the leases run out
+    later = now + LEASE_DURATION + timedelta(seconds=1)
+    survivor.refresh(session, now + LEASE_DURATION / 2)
+    survivor.refresh(session, later)
+    assert holdings([survivor], later) == [set(range(SHARDS))]
+    assert not any(dead.holds(shard, later) for shard in dead_shards)
+
+def test_released_shards_are_taken_at_once(session):
+    now = datetime.utcnow()
+    staying = ShardCoordinator("staying", SHARDS)
+    leaving = ShardCoordinator("leaving", SHARDS)
+    refresh_all(session, [staying, leaving], now)
+
+    leaving.release_all(session)
+    assert holdings([leaving], now) == [set()]
+    assert session.query(ShardLease).filter(ShardLease.owner == "leaving").count() == 0
+    assert session.get(MonitorWorker, "leaving") is None
+
+    # well before the released leases would have expired
+    now += timedelta(seconds=1)
+    staying.refresh(session, now)
+    assert holdings([staying], now) == [set(range(SHARDS))]
@@ -0,0 +1,74 @@
+import json
+import os
+import time
+import pytest
+from aircraft_batch import aircraft_batch_from_json
+from sources import AircraftJsonSource, ReplaySource, SbsSource
+
+# BaseStation lines as readsb sends them: callsign, airborne position, then velocity
+SBS_LINES = [
+    "MSG,1,1,1,A1B2C3,1,2024/05/01,12:00:00.000,2024/05/01,12:00:00.000,UAL123  ,,,,,,,,,,,0",
+    "MSG,3,1,1,A1B2C3,1,2024/05/01,12:00:01.000,2024/05/01,12:00:01.000,,12025,,,37.61234,-122.38765,,,0,0,0,0",
+    "MSG,4,1,1,A1B2C3,1,2024/05/01,12:00:02.000,2024/05/01,12:00:02.000,,,245,278.5,,,-832,,,,,0",
+]
+
+def test_sbs_messages_fill_every_field():
+    source = SbsSource('localhost', 30003)
+    now = time.time()
+    for line in SBS_LINES:
+        source.handle_message(line, now)
+
+    batch, dropped = aircraft_batch_from_json(source.snapshot())
+    assert len(batch) == 1
+    assert batch.hex[0] == 'a1b2c3'
+    assert batch.desc[0] == 'UAL123'
+    assert batch.lat[0] == pytest.approx(37.61234)
+    assert batch.lon[0] == pytest.approx(-122.38765)
+    assert batch.alt[0] == 12025
+    assert batch.gs[0] == 245
+    assert batch.track[0] == 278.5
+    assert batch.vertical_rate[0] == -832
+    assert batch.seen_pos[0] == pytest.approx(0, abs=1)
+
+def test_sbs_ground_flag_and_bad_lines():
+    source = SbsSource('localhost', 30003)
+    now = time.time()
+    source.handle_message("MSG,3,1,1,D4E5F6,1,,,,,,0,,,37.6,-122.4,,,0,0,0,-1", now)
+    source.handle_message("MSG,3,1,1,D4E5F6", now)
+    source.handle_message("STA,,1,1,ABCDEF,1,,,,,,,,,,,,,,,,0", now)
+    batch, dropped = aircraft_batch_from_json(source.snapshot())
+    assert len(batch) == 0
+    assert dropped['on_ground'] == 1
+
+def aircraft(hex, lat=37.6, lon=-122.4):
+    return {"hex": hex, "desc": hex.upper(), "lat": lat, "lon": lon, "alt_baro": 5000, "alt_geom": 5000, "gs": 200, "track": 90}
+
+def test_replay_plays_frames_in_order(tmp_path):
+    path = tmp_path / "snapshots.jsonl"
+    path.write_text("".join(json.dumps({"aircraft": [aircraft(hex)]}) + "\n" for hex in ("aaaaaa", "bbbbbb", "cccccc")))
+    source = ReplaySource(str(path))
+    played = []
+    for _ in range(4):
+        played.append([record['hex'] for record in source.fetch(37.6, -122.4, 10)])
+        source.tick()
+    assert played == [["aaaaaa"], ["bbbbbb"], ["cccccc"], ["aaaaaa"]]
+
+def test_replay_trims_to_the_query_circle(tmp_path):
+    path = tmp_path / "snapshots.jsonl"
+    path.write_text(json.dumps({"aircraft": [aircraft("aaaaaa"), aircraft("bbbbbb", lat=38.6)]}) + "\n")
+    assert [record['hex'] for record in ReplaySource(str(path)).fetch(37.6, -122.4, 10)] == ["aaaaaa"]
+
+def test_aircraft_json_is_reread_when_its_mtime_changes(tmp_path):
+    path = tmp_path / "aircraft.json"
+    path.write_text(json.dumps({"aircraft": [aircraft("aaaaaa")]}))
+    os.utime(path, (1000, 1000))
+    source = AircraftJsonSource(str(path))
+    assert [record['hex'] for record in source.fetch(37.6, -122.4, 10)] == ["aaaaaa"]
+
+    # rewritten without the mtime moving: still the copy already loaded
+    path.write_text(json.dumps({"aircraft": [aircraft("bbbbbb")]}))
+    os.utime(path, (1000, 1000))
+    assert [record['hex'] for record in source.fetch(37.6, -122.4, 10)] == ["aaaaaa"]
+
+    os.utime(path, (2000, 2000))
+    assert [record['hex'] for record in source.fetch(37.6, -122.4, 10)] == ["bbbbbb"]
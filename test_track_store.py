@@ -0,0 +1,61 @@
+import numpy as np
+import pytest
+from aircraft_batch import AircraftBatch
+from track_store import TrackStore, MAX_TURN_RATE, TRACK_STALE_SECONDS
+
+def make_batch(hexes, track, alt=10000.0, gs=300.0, vertical_rate=0.0, seen_pos=0.0):
+    count = len(hexes)
+    full = lambda value: np.broadcast_to(np.asarray(value, dtype=float), (count,)).copy()
+    return AircraftBatch(np.array(hexes), np.array(hexes), full(37.0), full(-122.0), full(alt), full(gs),
+                         full(track), full(vertical_rate), np.zeros(count), full(seen_pos))
+
+def test_turn_rate_across_north():
+    store = TrackStore()
+    for second, track in enumerate([350, 0, 10, 20]):
+        batch = make_batch(['a'], track)
+        store.update(batch, 1000 + 10 * second)
+    assert batch.turn_rate[0] == pytest.approx(1.0)
+    # the latest track, not an average
+    assert batch.track[0] == 20
+
+def test_turn_rate_is_clipped():
+    store = TrackStore()
+    store.update(make_batch(['a'], 0), 1000)
+    batch = make_batch(['a'], 170)
+    store.update(batch, 1001)
+    assert batch.turn_rate[0] == MAX_TURN_RATE
+
+def test_vertical_rate_from_altitude_when_not_reported():
+    store = TrackStore()
+    store.update(make_batch(['a', 'b'], 0, alt=10000, vertical_rate=[0, 500]), 1000)
+    batch = make_batch(['a', 'b'], 0, alt=10500, vertical_rate=[0, 500])
+    store.update(batch, 1030)
+    assert batch.vertical_rate == pytest.approx([1000, 500])
+
+def test_old_samples_leave_the_window():
+    store = TrackStore()
+    store.update(make_batch(['a'], 0, gs=100), 1000)
+    batch = make_batch(['a'], 0, gs=300)
+    store.update(batch, 1030)
+    assert batch.gs[0] == 200
+    batch = make_batch(['a'], 0, gs=500)
+    store.update(batch, 1090)
+    assert batch.gs[0] == 400
+
+def test_repeated_position_is_not_new():
+    store = TrackStore()
+    assert store.update(make_batch(['a', 'b'], 0), 1000).tolist() == [True, True]
+    # a reports the same position again, b a newer one
+    assert store.update(make_batch(['a', 'b'], 0, seen_pos=[10, 0]), 1010).tolist() == [False, True]
+
+def test_evicted_rows_are_reused():
+    store = TrackStore(capacity=2)
+    store.update(make_batch(['a', 'b'], 0), 1000)
+    store.update(make_batch(['c'], 0), 1000 + TRACK_STALE_SECONDS)
+    assert len(store) == 3 and store.capacity == 4
+    assert store.evict(1001 + TRACK_STALE_SECONDS) == 2
+    batch = make_batch(['d', 'e'], 90)
+    store.update(batch, 1002 + TRACK_STALE_SECONDS)
+    assert len(store) == 3 and store.capacity == 4
+    # a reused row starts a fresh track
+    assert batch.turn_rate.tolist() == [0, 0]
@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta
+from models import User, LastLocation
+from filter_plan import get_filter_versions, get_plans
+from geometry import Observer
+from config import LOCATION_MAX_AGE_HOURS
+
+# Plain snapshots of what the monitor loop needs about a user, safe to hand to worker
+# threads since nothing on them is tied to a session
+class LocationState:
+    def __init__(self, lat, lon, alt, reported_at):
+        self.lat = lat
+        self.lon = lon
+        self.alt = alt
+        self.reported_at = reported_at
+        # trig for measuring aircraft from here, worked out once per tick
+        self.observer = Observer(lat, lon, alt)
+
+class UserState:
+    def __init__(self, id, email, topic, location, filters):
+        self.id = id
+        self.email = email
+        self.topic = topic
+        self.location = location
+        # the user's compiled FilterPlan
+        self.filters = filters
+
+# Everything needed for a tick in a constant number of queries: users that have a topic
+# and a recent enough location in one, filter versions in another, and the filters of
+# any users whose filters changed since they were last compiled in a third.  Pass
+# user_ids to only load those users, and owns_user to skip users another worker has.
+def load_tick_state(session, user_ids=None, max_location_age=timedelta(hours=LOCATION_MAX_AGE_HOURS), owns_user=None):
+    since = datetime.utcnow() - max_location_age
+    query = session.query(User.id, User.email, User.topic,
+                          LastLocation.lat, LastLocation.lon, LastLocation.alt, LastLocation.reported_at) \
+        .join(LastLocation, LastLocation.user_id == User.id) \
+        .filter(User.topic.isnot(None), User.topic != '', LastLocation.reported_at >= since)
+    if user_ids is not None:
+        query = query.filter(User.id.in_(user_ids))
+    rows = query.all()
+    if owns_user is not None:
+        rows = [row for row in rows if owns_user(row.id)]
+
+    versions = get_filter_versions(session)
+    plans = get_plans(session, {row.id: versions.get(row.id) for row in rows})
+
+    return [
+        UserState(row.id, row.email, row.topic,
+                  LocationState(row.lat, row.lon, row.alt, row.reported_at),
+                  plans[row.id])
+        for row in rows
+    ]
@@ -0,0 +1,156 @@
+import threading
+import time
+import numpy as np
+
+# Positions kept per aircraft
+TRACK_LENGTH = 8
+# Aircraft not seen for this long are dropped
+TRACK_STALE_SECONDS = 120
+# Samples older than this don't count towards the smoothed state
+SMOOTHING_WINDOW_SECONDS = 60
+# Turn rates beyond this are treated as noise (a standard rate turn is 3 degrees/s)
+MAX_TURN_RATE = 6.0  # degrees/s
+# Rows the store starts with; it doubles whenever it runs out
+INITIAL_CAPACITY = 1024
+
+# Tracks for every aircraft we've seen recently.  Each aircraft has a row in a set of
+# (capacity, TRACK_LENGTH) arrays, used as ring buffers of its recent positions, so a
+# whole batch is recorded and smoothed with a handful of array operations.  Rows of
+# evicted aircraft are reused.
+class TrackStore:
+    def __init__(self, capacity=INITIAL_CAPACITY):
+        # ICAO hex -> row
+        self.rows = {}
+        self.free = []
+        self.capacity = 0
+        self.times = np.zeros((0, TRACK_LENGTH))
+        self.lats = np.zeros((0, TRACK_LENGTH))
+        self.lons = np.zeros((0, TRACK_LENGTH))
+        self.alts = np.zeros((0, TRACK_LENGTH))
+        self.speeds = np.zeros((0, TRACK_LENGTH))
+        self.tracks = np.zeros((0, TRACK_LENGTH))
+        self.vertical_rates = np.zeros((0, TRACK_LENGTH))
+        # where each row's next sample goes, and how many it holds
+        self.head = np.zeros(0, dtype=np.int64)
+        self.count = np.zeros(0, dtype=np.int64)
+        self.last_seen = np.zeros(0)
+        self.hexes = np.zeros(0, dtype=object)
+        self.lock = threading.Lock()
+        self.grow(capacity)
+
+    def grow(self, capacity):
+        def extend(array, fill=0):
+            grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+            grown[:len(array)] = array
+            return grown
+
+        self.times = extend(self.times)
+        self.lats = extend(self.lats)
+        self.lons = extend(self.lons)
+        self.alts = extend(self.alts)
+        self.speeds = extend(self.speeds)
+        self.tracks = extend(self.tracks)
+        self.vertical_rates = extend(self.vertical_rates)
+        self.head = extend(self.head)
+        self.count = extend(self.count)
+        self.last_seen = extend(self.last_seen)
+        self.hexes = extend(self.hexes, None)
+        self.free.extend(range(capacity - 1, self.capacity - 1, -1))
+        self.capacity = capacity
+
+    # The row of each hex, giving new aircraft an empty one
+    def rows_for(self, hexes):
+        rows = np.empty(len(hexes), dtype=np.int64)
+        for i, hex in enumerate(hexes):
+            row = self.rows.get(hex)
+            if row is None:
+                if not self.free:
+                    self.grow(self.capacity * 2)
+                row = self.rows[hex] = self.free.pop()
+                self.hexes[row] = hex
+                self.head[row] = 0
+                self.count[row] = 0
+            rows[i] = row
+        return rows
+
+    # Record a batch's positions and replace its single-sample kinematics with smoothed
+    # ones (gs, track, turn_rate and vertical_rate are updated in place).  Returns a mask
+    # of the aircraft that brought a new position.
+    def update(self, batch, now=None):
+        now = now or time.time()
+        with self.lock:
+            rows = self.rows_for(batch.hex)
+            self.last_seen[rows] = now
+            timestamps = now - batch.seen_pos
+
+            # a report is new unless it's no more than half a second after the latest we have
+            latest = self.times[rows, (self.head[rows] - 1) % TRACK_LENGTH]
+            changed = (self.count[rows] == 0) | (timestamps > latest + 0.5)
+            # an aircraft in the batch twice only gets its first position written
+            first = np.zeros(len(rows), dtype=bool)
+            first[np.unique(rows, return_index=True)[1]] = True
+            changed &= first
+
+            written = rows[changed]
+            head = self.head[written]
+            self.times[written, head] = timestamps[changed]
+            self.lats[written, head] = batch.lat[changed]
+            self.lons[written, head] = batch.lon[changed]
+            self.alts[written, head] = batch.alt[changed]
+            self.speeds[written, head] = batch.gs[changed]
+            self.tracks[written, head] = batch.track[changed]
+            self.vertical_rates[written, head] = batch.vertical_rate[changed]
+            self.head[written] = (head + 1) % TRACK_LENGTH
+            self.count[written] = np.minimum(self.count[written] + 1, TRACK_LENGTH)
+
+            batch.gs, batch.track, batch.turn_rate, batch.vertical_rate = self.smooth(rows)
+        return changed
+
+    # Smoothed (gs, track, turn_rate, vertical_rate) arrays for the aircraft in rows
+    def smooth(self, rows):
+        # each row's samples, oldest first, so the latest is always in the last column
+        columns = (self.head[rows, None] + np.arange(TRACK_LENGTH)) % TRACK_LENGTH
+        times = self.times[rows[:, None], columns]
+        speeds = self.speeds[rows[:, None], columns]
+        tracks = self.tracks[rows[:, None], columns]
+        vertical_rates = self.vertical_rates[rows[:, None], columns]
+        alts = self.alts[rows[:, None], columns]
+
+        # the samples within the smoothing window are a run at the end of each row
+        held = np.arange(TRACK_LENGTH) >= TRACK_LENGTH - self.count[rows, None]
+        recent = held & (times[:, -1:] - times <= SMOOTHING_WINDOW_SECONDS)
+        samples = recent.sum(axis=1)
+        gs = np.where(recent, speeds, 0).sum(axis=1) / samples
+        vertical_rate = np.where(recent, vertical_rates, 0).sum(axis=1) / samples
+
+        oldest = TRACK_LENGTH - samples
+        elapsed = times[:, -1] - np.take_along_axis(times, oldest[:, None], axis=1)[:, 0]
+        moving = (samples > 1) & (elapsed > 0)
+        safe_elapsed = np.where(moving, elapsed, 1.0)
+        # sum the track changes between samples, so turns past 180 degrees still count
+        changes = (np.diff(tracks, axis=1) + 180) % 360 - 180
+        change = np.where(recent[:, 1:] & recent[:, :-1], changes, 0).sum(axis=1)
+        turn_rate = np.where(moving, np.clip(change / safe_elapsed, -MAX_TURN_RATE, MAX_TURN_RATE), 0.0)
+
+        # no vertical rate reported, derive one from the altitude change
+        climb = (alts[:, -1] - np.take_along_axis(alts, oldest[:, None], axis=1)[:, 0]) / safe_elapsed * 60
+        unreported = moving & ~(recent & (vertical_rates != 0)).any(axis=1)
+        vertical_rate = np.where(unreported, climb, vertical_rate)
+
+        # keep the latest reported track rather than an average, which would lag in a turn
+        return gs, tracks[:, -1].copy(), turn_rate, vertical_rate
+
+    def evict(self, now=None):
+        cutoff = (now or time.time()) - TRACK_STALE_SECONDS
+        with self.lock:
+            stale = [row for row in self.rows.values() if self.last_seen[row] < cutoff]
+            for row in stale:
+                del self.rows[self.hexes[row]]
+                self.hexes[row] = None
+            self.free.extend(stale)
+        return len(stale)
+
+    def __len__(self):
+        return len(self.rows)
+
+track_store = TrackStore()
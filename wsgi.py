@@ -0,0 +1,10 @@
+from api import app
+import location_api  # registers /pub
+
+# The API on its own, for a production WSGI server:
+#   gunicorn -c gunicorn.conf.py wsgi:app
+# with the monitor loop in a process of its own:
+#   python main.py --worker
+# Location reports reach the monitor through the database, and filter edits through
+# their version in it, so any number of API processes can run beside any number of
+# monitor workers.